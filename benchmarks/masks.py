@@ -0,0 +1,148 @@
+"""Compare the RLE mask conversions with the original implementations.
+
+Usage: python benchmarks/masks.py [--sizes 512 2048 8192] [--batch 32]
+"""
+
+import time
+import argparse
+import statistics
+
+import numpy as np
+
+from qsl import common, rle
+
+
+def legacy_counts2bitmap(counts, dimensions):
+    """The original, run-by-run decoder."""
+    return (
+        np.concatenate(
+            [
+                np.zeros(count, dtype="uint8") + 1 - (index % 2)
+                for index, count in enumerate(counts)
+            ]
+        ).reshape((dimensions["height"], dimensions["width"]))
+        * 255
+    )
+
+
+def legacy_bitmap2counts(bitmap):
+    """The original encoder."""
+    dimensions = {"width": bitmap.shape[1], "height": bitmap.shape[0]}
+    bitmap = bitmap.ravel().astype("uint8")
+    diff = np.diff(bitmap) > 0
+    ends = np.where(diff)[0]
+    offset = 1 if (bitmap[0] == 0) else 0
+    rle = np.zeros(diff.sum() + 1 + offset, dtype="int32")
+    rle[0 + offset] = ends[0] + 1
+    rle[1 + offset : -1] = ends[1:] - ends[:-1]
+    rle[-1] = diff.shape[0] - ends[-1]
+    return {"dimensions": dimensions, "counts": rle.tolist()}
+
+
+def synthetic_mask(size: int, rng, noise: float = 0.02) -> "np.ndarray":
+    """Create a detailed mask: a set of discs with noisy pixels."""
+    y, x = np.ogrid[:size, :size]
+    bitmap = np.zeros((size, size), dtype=bool)
+    for cx, cy, r in rng.random((20, 3)):
+        bitmap |= (x - cx * size) ** 2 + (y - cy * size) ** 2 < (r * size / 4) ** 2
+    if noise:
+        bitmap ^= rng.random((size, size)) < noise
+    return bitmap.astype("uint8")
+
+
+def measure(func, repeats: int) -> float:
+    """Get the median latency of a function in milliseconds."""
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        latencies.append(1000 * (time.perf_counter() - start))
+    return statistics.median(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[512, 2048, 8192])
+    parser.add_argument("--batch", type=int, default=32)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+    rng = np.random.default_rng(42)
+    print(
+        f"{'size':>6} {'runs':>9} {'legacy decode':>14} {'decode':>10} {'64k chunks':>10}"
+        f" {'legacy encode':>14} {'encode':>10}"
+    )
+    for size in args.sizes:
+        bitmap = synthetic_mask(size, rng)
+        mask = common.bitmap2counts(bitmap)
+        assert mask == legacy_bitmap2counts(bitmap)
+        timings = [
+            measure(
+                lambda: legacy_counts2bitmap(
+                    mask["counts"], mask["dimensions"]
+                ),  # noqa: B023
+                args.repeats,
+            ),
+            measure(
+                lambda: common.counts2bitmap(
+                    mask["counts"], mask["dimensions"]
+                ),  # noqa: B023
+                args.repeats,
+            ),
+            measure(
+                lambda: common.counts2bitmap(  # noqa: B023
+                    mask["counts"], mask["dimensions"], chunkSize=1 << 16  # noqa: B023
+                ),
+                args.repeats,
+            ),
+            measure(lambda: legacy_bitmap2counts(bitmap), args.repeats),  # noqa: B023
+            measure(lambda: common.bitmap2counts(bitmap), args.repeats),  # noqa: B023
+        ]
+        print(
+            f"{size:>6} {len(mask['counts']):>9} "
+            + " ".join(
+                f"{timing:>{width - 2}.1f}ms"
+                for timing, width in zip(timings, [14, 10, 10, 14, 10])
+            )
+        )
+    size = args.sizes[0]
+    bitmaps = np.stack([synthetic_mask(size, rng) for _ in range(args.batch)])
+    masks = common.bitmaps2counts(bitmaps)
+    out = np.empty_like(bitmaps)
+    print(f"\nBatch of {args.batch} {size}x{size} masks")
+    print(
+        f"{'legacy decode':>14} {'batch decode':>14} {'legacy encode':>14} {'batch encode':>14}"
+    )
+    timings = [
+        measure(
+            lambda: [legacy_counts2bitmap(m["counts"], m["dimensions"]) for m in masks],
+            args.repeats,
+        ),
+        measure(lambda: common.counts2bitmaps(masks, out=out), args.repeats),
+        measure(lambda: [legacy_bitmap2counts(b) for b in bitmaps], args.repeats),
+        measure(lambda: common.bitmaps2counts(bitmaps), args.repeats),
+    ]
+    print(" ".join(f"{timing:>12.1f}ms" for timing in timings))
+
+    size = args.sizes[-1]
+    masks = [common.bitmap2counts(synthetic_mask(size, rng, noise=0)) for _ in range(2)]
+    print(f"\nOperations on two {size}x{size} masks without noise")
+    print(f"{'decoded IoU':>14} {'RLE IoU':>14} {'RLE merge':>14} {'RLE resize':>14}")
+
+    def decoded_iou():
+        a, b = [common.counts2bitmap(m["counts"], m["dimensions"]) > 0 for m in masks]
+        return (a & b).sum() / (a | b).sum()
+
+    timings = [
+        measure(decoded_iou, args.repeats),
+        measure(lambda: rle.iou_matrix(masks[:1], masks[1:]), args.repeats),
+        measure(lambda: rle.merge(masks), args.repeats),
+        measure(
+            lambda: rle.resize(masks[0], {"width": size // 4, "height": size // 4}),
+            args.repeats,
+        ),
+    ]
+    print(" ".join(f"{timing:>12.1f}ms" for timing in timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""Measure the latency of navigating between items as projects grow.
+
+Usage: python benchmarks/navigation.py [--sizes 1000 10000 100000 1000000]
+"""
+
+import time
+import argparse
+import statistics
+
+from qsl import common
+
+
+def measure(func, repeats: int) -> float:
+    """Get the median latency of a function in milliseconds."""
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        func()
+        latencies.append(1000 * (time.perf_counter() - start))
+    return statistics.median(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--sizes", nargs="+", type=int, default=[1000, 10000, 100000, 1000000]
+    )
+    parser.add_argument("--repeats", type=int, default=50)
+    args = parser.parse_args()
+    print(f"{'items':>10} {'position':>12} {'next':>12} {'prev':>12} {'unlabeled':>12}")
+    for size in args.sizes:
+        labeler = common.BaseMediaLabeler(
+            items=[
+                {
+                    "target": f"images/{idx}.jpg",
+                    "metadata": {"index": idx},
+                    # Leave one in ten items unlabeled.
+                    **({} if idx % 10 == 0 else {"labels": {"image": {}}}),
+                }
+                for idx in range(size)
+            ]
+        )
+        # Navigate somewhere in the middle of a sorted project.
+        labeler.indexState = {
+            **labeler.indexState,
+            "sortModel": [{"field": "index", "sort": "desc"}],
+        }
+        labeler.idx = labeler.sortedIdxs[size // 2]
+        position = measure(
+            lambda: labeler.sortedIdxs.index(labeler.idx), args.repeats  # noqa: B023
+        )
+        forward = measure(labeler.next, args.repeats)
+        backward = measure(labeler.prev, args.repeats)
+        unlabeled = measure(labeler.next_unlabeled, args.repeats)
+        print(
+            f"{size:>10} {position:>10.4f}ms {forward:>10.3f}ms {backward:>10.3f}ms {unlabeled:>10.3f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
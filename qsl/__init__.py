@@ -4,4 +4,5 @@ import importlib.metadata
 __version__ = importlib.metadata.version(__name__)
 
 from .widgets import MediaLabeler
-from .common import counts2bitmap, bitmap2counts
+from .common import counts2bitmap, bitmap2counts, counts2bitmaps, bitmaps2counts
+from .files import configure_s3
@@ -1,10 +1,39 @@
 import os
+import json
 import typing
+import contextlib
+import collections
 import eel
 import bottle
 import importlib.resources
 from . import common, files
 
+# The attributes that the frontend uses (see defaultWidgetState
+# in qslwidgets/src/widget.ts). Nothing else is sent to it.
+SYNCED_FIELDS = frozenset(
+    [
+        "states",
+        "urls",
+        "type",
+        "message",
+        "config",
+        "labels",
+        "action",
+        "preload",
+        "thumbnails",
+        "maxCanvasSize",
+        "maxViewHeight",
+        "idx",
+        "viewState",
+        "indexState",
+        "buttons",
+        "base",
+        "progress",
+        "stats",
+        "mode",
+    ]
+)
+
 
 class MediaLabeler(common.BaseMediaLabeler):
     def __init__(
@@ -12,45 +41,113 @@ class MediaLabeler(common.BaseMediaLabeler):
         items=None,
         jsonpath=None,
         batchSize=None,
+        *,
+        journal=False,
+        asyncWrites=False,
+        cacheDir=None,
+        cacheSize=None,
+        compactMasks=False,
     ):
-        super().__init__(
-            items=items,
-            batchSize=batchSize,
-            jsonpath=jsonpath,
-            base={
-                "url": "http://localhost:8080",
-                "serverRoot": os.getcwd(),
-            },
+        # Changes to synced fields that have not been sent yet, if
+        # we are holding them (see hold_sync).
+        self._pending: typing.Optional[typing.Dict[str, typing.Any]] = None
+        self._action: typing.Optional[str] = None
+        self._syncStats: typing.Dict[str, typing.Dict[str, int]] = (
+            collections.defaultdict(lambda: {"count": 0, "messages": 0, "bytes": 0})
         )
-        self.set_urls_and_type()
+        with self.hold_sync():
+            super().__init__(
+                items=items,
+                batchSize=batchSize,
+                jsonpath=jsonpath,
+                journal=journal,
+                asyncWrites=asyncWrites,
+                cacheDir=cacheDir,
+                cacheSize=cacheSize,
+                compactMasks=compactMasks,
+                base={
+                    "url": "http://localhost:8080",
+                    "serverRoot": os.getcwd(),
+                },
+            )
+            self.set_urls_and_type()
         eel.expose(self.init)
         eel.expose(self.sync)
 
     def init(self, key):
+        if key not in SYNCED_FIELDS:
+            raise ValueError(f"{key} is not available to the frontend.")
         return getattr(self, key)
 
     def sync(self, key, value):
-        setattr(self, key, value)
-        if key == "states":
-            self.targets = [
-                {**state, "target": target.get("target")}
-                for target, state in zip(self.targets, self.states)
-            ]
-            self.set_buttons()
-        if key == "action":
-            if not value:
-                return
-            self.apply_action(value)
+        """Apply a change from the frontend, sending any resulting
+        changes back to it in a single message."""
+        if key not in SYNCED_FIELDS:
+            raise ValueError(f"{key} cannot be set by the frontend.")
+        self._action = value if key == "action" and value else key
+        self._syncStats[self._action]["count"] += 1
+        with self.hold_sync():
+            # The frontend already has this value, so it is not sent back.
+            super().__setattr__(key, value)
+            if key == "states":
+                self.apply_states()
+            if key == "action" and value:
+                self.apply_action(value)
+        self._action = None
+
+    @contextlib.contextmanager
+    def hold_sync(self):
+        """Hold changes to synced fields and send them in a single
+        message when the outermost context manager exits."""
+        if self._pending is not None:
+            yield
+            return
+        self._pending = {}
+        try:
+            yield
+        finally:
+            pending, self._pending = self._pending, None
+            if pending:
+                self.send_state(pending)
+
+    def send_state(self, state: typing.Dict[str, typing.Any]):
+        """Send changes to synced fields to the frontend."""
+        stats = self._syncStats[self._action or "other"]
+        stats["messages"] += 1
+        stats["bytes"] += len(json.dumps(state, default=lambda o: None))
+        eel.sync(state)  # pylint: disable=no-member
+
+    def get_sync_stats(self) -> typing.Dict[str, typing.Dict[str, int]]:
+        """Get the number of times each action (or field changed by the
+        frontend) was handled along with the number of messages and
+        bytes sent to the frontend as a result. Changes made outside of
+        these (e.g., at startup) are counted under "other"."""
+        return {key: dict(value) for key, value in self._syncStats.items()}
 
     def __setattr__(self, key, value):
-        eel.sync(key, value)  # pylint: disable=no-member
         super().__setattr__(key, value)
+        if key not in SYNCED_FIELDS:
+            return
+        if self._pending is None:
+            self.send_state({key: value})
+        else:
+            self._pending[key] = value
 
 
 # pylint: disable=unused-variable
-def start(jsonpath: str, targets: typing.List[str], batchSize: typing.Optional[int]):
+def start(
+    jsonpath: str,
+    targets: typing.List[str],
+    batchSize: typing.Optional[int],
+    *,
+    journal: bool = False,
+    asyncWrites: bool = False,
+    cacheDir: typing.Optional[str] = None,
+    cacheSize: typing.Optional[int] = None,
+    compactMasks: bool = False,
+):
     """Start Eel."""
-    # A bit of a hack so that `files.build_url` works properly
+    # A bit of a hack so that `media.build_url` works properly
     eel.BOTTLE_ROUTES = {
         "/files/<path:path>": (
             lambda path: bottle.static_file(path, root=os.getcwd()),
@@ -73,6 +170,11 @@ def start(jsonpath: str, targets: typing.List[str], batchSize: typing.Optional[i
         ],
         jsonpath=jsonpath,
         batchSize=batchSize,
+        journal=journal,
+        asyncWrites=asyncWrites,
+        cacheDir=cacheDir,
+        cacheSize=cacheSize,
+        compactMasks=compactMasks,
     )
     eel.start(
         "index.html",
@@ -1,5 +1,5 @@
 import click
-from . import app
+from . import app, files, store
 
 
 @click.group()
@@ -11,17 +11,118 @@ def cli():
 @click.argument("project", nargs=1)
 @click.argument("targets", nargs=-1)
 @click.option("-b", "--batch-size", "batchSize", default=None, type=int)
-def label(project, targets, batchSize):
+@click.option(
+    "-j",
+    "--journal",
+    is_flag=True,
+    default=False,
+    help="Append label changes to a journal instead of rewriting the project file.",
+)
+@click.option(
+    "-a",
+    "--async-writes",
+    "asyncWrites",
+    is_flag=True,
+    default=False,
+    help="Write label files on a background thread.",
+)
+@click.option(
+    "--cache-dir",
+    "cacheDir",
+    default=None,
+    help="A directory (within the current directory) in which to cache remote media across sessions.",
+)
+@click.option(
+    "--cache-size",
+    "cacheSize",
+    default=None,
+    type=int,
+    help="The maximum size of the media cache in bytes.",
+)
+@click.option(
+    "--s3-endpoint-url",
+    "s3EndpointUrl",
+    default=None,
+    help="The endpoint for S3 requests (e.g., for a MinIO server).",
+)
+@click.option(
+    "--s3-max-connections",
+    "s3MaxConnections",
+    default=None,
+    type=int,
+    help="The maximum number of concurrent connections to S3.",
+)
+@click.option(
+    "--compact-masks",
+    "compactMasks",
+    is_flag=True,
+    default=False,
+    help="Store mask counts as compact strings instead of lists of integers.",
+)
+def label(
+    project,
+    targets,
+    batchSize,
+    *,
+    journal,
+    asyncWrites,
+    cacheDir,
+    cacheSize,
+    s3EndpointUrl,
+    s3MaxConnections,
+    compactMasks,
+):
     """Launch the labeling application."""
-    if not project.endswith(".json"):
+    if not files.is_json_path(project) and not store.is_sqlite_path(project):
         click.echo(
-            f"The project path must end in *.json. Received {project}.", err=True
+            f"The project path must end in *.json, *.jsonl (optionally followed by .gz or .zst) or *.sqlite. Received {project}.",
+            err=True,
         )
         return
-    app.start(jsonpath=project, targets=targets, batchSize=batchSize)
+    if s3EndpointUrl:
+        files.configure_s3(endpointUrl=s3EndpointUrl)
+    if s3MaxConnections:
+        files.configure_s3(maxPoolConnections=s3MaxConnections)
+    app.start(
+        jsonpath=project,
+        targets=targets,
+        batchSize=batchSize,
+        journal=journal,
+        asyncWrites=asyncWrites,
+        cacheDir=cacheDir,
+        cacheSize=cacheSize,
+        compactMasks=compactMasks,
+    )
+
+
+@click.command()
+@click.argument("source", nargs=1)
+@click.argument("destination", nargs=1)
+@click.option(
+    "-i",
+    "--indent",
+    default=None,
+    type=int,
+    help="The indentation for *.json output. Defaults to minified JSON.",
+)
+@click.option(
+    "--masks",
+    type=click.Choice(["compact", "list"]),
+    default=None,
+    help="Convert mask counts to compact strings or to lists of integers.",
+)
+def convert(source, destination, indent, masks):
+    """Convert a project file to another format (e.g., project.json to project.jsonl.gz)."""
+    files.convert_project(
+        source,
+        destination,
+        indent=indent,
+        compactMasks=None if masks is None else masks == "compact",
+    )
 
 
 cli.add_command(label)
+cli.add_command(convert)
 
 if __name__ == "__main__":
     cli()
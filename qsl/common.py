@@ -1,16 +1,19 @@
 import os
-import math
+import copy
 import json
 import typing
+import hashlib
+import functools
 import logging
-import tempfile
+import warnings
+import collections
 
 try:
     import numpy as np
 except ImportError:
     np = None  # type: ignore
 
-from . import files
+from . import files, index, media, pyramid, rle, stats, store, views
 
 LOGGER = logging.getLogger(__name__)
 
@@ -30,124 +33,73 @@ Target = typing.TypedDict(
 )
 
 
-# Taken from https://stackoverflow.com/questions/952914/how-to-make-a-flat-list-out-of-a-list-of-lists
-def flatten(l: typing.List[typing.Any]):
-    return [item for sublist in l for item in sublist]
-
-
-def items2rows(idxs, items):
-    """Create the media index rows representation for a list of items."""
-    metadata_keys = list(
-        set(flatten([item.get("metadata", {}).keys() for item in items]))
-    )[:5]
-    return [
-        {
-            **{k: metadata.get(k) for k in metadata_keys},
-            "qslId": index,
-            "target": target2repr(target, ttype),
-            "labeled": "Yes" if labels or ignored else "No",
-            "ignored": "Yes" if ignored else "No",
-            "labels": (
-                "; ".join(
-                    f"{k}: {', '.join(v or [])}"
-                    for k, v in labels.get("image", {}).items()
-                )
-                if labels and isinstance(labels, dict)
-                else (len(labels) if isinstance(labels, dict) else "")
-            ),
-        }
-        for index, target, metadata, labels, ttype, ignored in [
-            (
-                idx,
-                item.get("target"),
-                item.get("metadata", {}),
-                item.get("labels", {}),
-                item.get("type", "image"),
-                item.get("ignore", False),
-            )
-            for idx, item in zip(idxs, items)
-        ]
-    ], metadata_keys
+def counts2bitmap(
+    counts: typing.List[int],
+    dimensions: typing.Dict,
+    chunkSize: typing.Optional[int] = None,
+) -> "np.ndarray":
+    """Convert a COCO-style bitmap into a bitmap. Masks are processed
+    chunkSize pixels at a time, which bounds the temporary memory used."""
+    return rle.decode(counts, dimensions, chunkSize=chunkSize)
 
 
-def build_sort_keys(items, column):
-    """Build keys for a list of items to be used for sorting or filtering."""
-    if column == "target":
-        keys = [
-            target2repr(item.get("target"), item.get("type", "image")) for item in items
-        ]
-    elif column == "labeled":
-        keys = [bool(item.get("labels") or item.get("ignored")) for item in items]
-    elif column == "ignored":
-        keys = [bool(item.get("ignore")) for item in items]
-    else:
-        keys = [item.get("metadata", {}).get(column) for item in items]
-    return keys
-
-
-def counts2bitmap(counts: typing.List[int], dimensions: typing.Dict) -> "np.ndarray":
-    """Convert a COCO-style bitmap into a bitmap."""
-    return (
-        np.concatenate(
-            [
-                np.zeros(count, dtype="uint8") + 1 - (index % 2)
-                for index, count in enumerate(counts)
-            ]
-        ).reshape((dimensions["height"], dimensions["width"]))
-        * 255
-    )
+def bitmap2counts(
+    bitmap: "np.ndarray", chunkSize: typing.Optional[int] = None
+) -> typing.Dict:
+    """Convert a bitmap to an RLE counts object."""
+    return rle.encode(bitmap, chunkSize=chunkSize)
 
 
-def bitmap2counts(bitmap: "np.ndarray") -> typing.Dict:
-    """Convert a bitmap to an RLE counts object."""
-    dimensions = {"width": bitmap.shape[1], "height": bitmap.shape[0]}
-    if bitmap.max() == 0:
-        counts = [0, bitmap.shape[0] * bitmap.shape[1]]
-    elif bitmap.min() == 1:
-        counts = [bitmap.shape[0] * bitmap.shape[1], 0]
-    else:
-        bitmap = bitmap.ravel().astype("uint8")
-        diff = np.diff(bitmap) > 0
-        ends = np.where(diff)[0]
-        offset = 1 if (bitmap[0] == 0) else 0
-        rle = np.zeros(diff.sum() + 1 + offset, dtype="int32")
-        rle[0 + offset] = ends[0] + 1
-        rle[1 + offset : -1] = ends[1:] - ends[:-1]
-        rle[-1] = diff.shape[0] - ends[-1]
-        counts = rle.tolist()
-    return {"dimensions": dimensions, "counts": counts}
+def counts2bitmaps(
+    masks: typing.List[typing.Dict],
+    out: typing.Optional["np.ndarray"] = None,
+    chunkSize: typing.Optional[int] = None,
+) -> "np.ndarray":
+    """Convert RLE counts objects with the same dimensions into
+    an (n, height, width) stack of bitmaps (optionally, into a
+    preallocated stack provided as out)."""
+    return rle.decode_batch(masks, out=out, chunkSize=chunkSize)
+
+
+def bitmaps2counts(bitmaps: "np.ndarray") -> typing.List[typing.Dict]:
+    """Convert an (n, height, width) stack of bitmaps to RLE counts objects."""
+    return rle.encode_batch(bitmaps)
 
 
 def deprecate(old, new):
-    """Log a deprecation message."""
-    LOGGER.warning("%s has been deprecated. Use %s instead.", old, new)
+    """Warn the caller of the calling function about a deprecated name."""
+    warnings.warn(
+        f"{old} has been deprecated. Use {new} instead.",
+        DeprecationWarning,
+        stacklevel=3,
+    )
 
 
-def target2repr(target, ttype):
-    """Convert any labling target to a string representation."""
-    if isinstance(target, str):
-        if not target.startswith("data:"):
-            return target
-        return "base64-encoded data"
-    if files.is_array(target):
-        return "numpy array"
-    if ttype == "time-series":
-        return "Time Series"
-    if ttype == "image-group":
-        return f"Group of {len(target.get('images', []))} images"
-    return ""
+def json2digest(value) -> str:
+    """Compute a deterministic digest for a JSON-serializable value."""
+    return hashlib.blake2b(
+        json.dumps(value, sort_keys=True, separators=(",", ":")).encode("utf8"),
+        digest_size=16,
+    ).hexdigest()
 
 
-def entry2hash(entry):
+def entry2hash(entry, cached=False) -> str:
+    """Get a stable key for an item. String targets are their own key. Otherwise,
+    the key is a digest of the target (or metadata). If cached is True, a digest
+    previously stored on the item is used instead of recomputing it."""
     if "target" in entry:
         target = entry["target"]
         if isinstance(target, str):
             return target
         if isinstance(target, dict):
-            return hash(json.dumps(target))
+            if cached and "digest" in entry:
+                return entry["digest"]
+            return json2digest(target)
         raise ValueError("Unsupported target type for hashing.")
     if "metadata" in entry:
-        return hash(json.dumps(entry["metadata"]))
+        if cached and "digest" in entry:
+            return entry["digest"]
+        return json2digest(entry["metadata"])
     raise ValueError(f"Could not hash {entry}.")
 
 
@@ -163,27 +115,31 @@ def merge_item(exists, insert):
 
 def merge_items(exists, insert):
     """Merge two lists of items if there is an
-    unambiguous way to do so."""
+    unambiguous way to do so. Items without string targets
+    keep their digest so that it need not be recomputed
+    the next time the project is loaded."""
     try:
-        exists_key, insert_key = [
-            [entry2hash(entry) for entry in items] for items in [exists, insert]
+        exists_keys = [entry2hash(entry, cached=True) for entry in exists]
+        insert_map = {entry2hash(entry): entry for entry in insert}
+        combined = [
+            (
+                merge_item(exists=entry, insert=insert_map[key])
+                if key in insert_map
+                else entry
+            )
+            for key, entry in zip(exists_keys, exists)
         ]
-        exists_map, insert_map = [
-            {key: entry for entry, key in zip(items, keys)}
-            for items, keys in [(exists, exists_key), (insert, insert_key)]
+        existing = set(exists_keys)
+        added = [key for key in insert_map if key not in existing]
+        combined.extend(insert_map[key] for key in added)
+        combined = [
+            (
+                entry
+                if isinstance(entry.get("target"), str) or "digest" in entry
+                else {**entry, "digest": key}
+            )
+            for entry, key in zip(combined, exists_keys + added)
         ]
-        combined = []
-        for key in exists_key + list(set(insert_key).difference(exists_key)):
-            entry_exists = exists_map.get(key)
-            entry_insert = insert_map.get(key)
-            if entry_exists and not entry_insert:
-                combined.append(entry_exists)
-            elif not entry_exists and entry_insert:
-                combined.append(entry_insert)
-            elif entry_exists and entry_insert:
-                combined.append(merge_item(exists=entry_exists, insert=entry_insert))
-            else:
-                raise ValueError("An error occurred merging lists.")
     except TypeError as exception:
         if "unhashable type" in exception.args[0]:
             raise ValueError(
@@ -193,7 +149,137 @@ def merge_items(exists, insert):
     return combined
 
 
-class BaseMediaLabeler:
+class PersistenceMixin:
+    """Persists a labeler's items and settings to its jsonpath (a JSON
+    project, which may be journaled, or an SQLite database) and to
+    item-level jsonpath files (see BaseMediaLabeler)."""
+
+    items: typing.Any
+    jsonpath: typing.Optional[str]
+    compactMasks: bool
+    jsonIndent: typing.Optional[int]
+    _journal: typing.Optional[files.ProjectJournal]
+    _writer: typing.Optional[files.BackgroundWriter]
+    _savedSettings: typing.Optional[dict]
+    _index: typing.Optional[index.MediaIndex]
+    _stats: typing.Optional[stats.LabelStats]
+    get_settings: typing.Callable[[], dict]
+    update_unlabeled: typing.Callable[[typing.List[int]], None]
+    invalidate_views: typing.Callable[[], None]
+
+    def commit_changes(
+        self, idxs: typing.List[int], items: typing.Optional[typing.List[dict]] = None
+    ):
+        """Bring the in-memory indexes up to date for items whose labels
+        changed and persist the changes. Pass the changed item dictionaries
+        as items so that they are persisted even if they were evicted from
+        a cache in the meantime (i.e., for SQLite projects)."""
+        if items is None:
+            items = [self.items[idx] for idx in idxs]
+        if self._index is not None:
+            self._index.update(idxs)
+        if self._stats is not None:
+            self._stats.update(idxs)
+        self.update_unlabeled(idxs)
+        self.invalidate_views()
+        self.save_to_disk(idxs, items)
+
+    def save_to_disk(
+        self,
+        idxs: typing.Optional[typing.List[int]] = None,
+        items: typing.Optional[typing.List[dict]] = None,
+    ):
+        """Persist the project. When journaling, only the items in idxs
+        (and the settings, if they changed) are appended to the journal.
+        Otherwise, the entire project is rewritten. For SQLite projects,
+        items are the changed items (see SQLiteItems.commit)."""
+        if not self.jsonpath:
+            return
+        settings = self.get_settings()
+        if isinstance(self.items, store.SQLiteItems):
+            if idxs:
+                self.items.commit(idxs, items)
+            if settings != self._savedSettings:
+                self.items.set_settings(settings)
+                self._savedSettings = copy.deepcopy(settings)
+            return
+        if self._journal is None or idxs is None:
+            project = {
+                "items": (
+                    [rle.compact_item(item) for item in self.items]
+                    if self.compactMasks
+                    else self.items
+                ),
+                **settings,
+            }
+            if self._journal is None and self._writer is not None:
+                self._writer.write(project, self.jsonpath, indent=self.jsonIndent)
+            else:
+                if self._journal is not None:
+                    self._journal.wait()
+                files.labels2json(project, self.jsonpath, indent=self.jsonIndent)
+                files.remove_journals(self.jsonpath)
+            self._savedSettings = copy.deepcopy(settings)
+            return
+        records = [
+            {"idx": idx, "item": self.serialize_item(self.items[idx])} for idx in idxs
+        ]
+        if settings != self._savedSettings:
+            records.append({"settings": settings})
+            self._savedSettings = copy.deepcopy(settings)
+        if records:
+            self._journal.append(records)
+
+    def serialize_item(self, item: dict) -> dict:
+        """Get the form of an item that is written to disk."""
+        return rle.compact_item(item) if self.compactMasks else item
+
+    def write_json(self, item: dict, filepath: str):
+        """Write an item-level JSON file, in the background if
+        asyncWrites is enabled."""
+        data = self.serialize_item(item)
+        if self._writer is not None:
+            self._writer.write(data, filepath, indent=self.jsonIndent)
+        else:
+            files.labels2json(data, filepath, indent=self.jsonIndent)
+
+    def remove_json(self, filepath: str):
+        """Remove an item-level JSON file, in the background if
+        asyncWrites is enabled."""
+        if self._writer is not None:
+            self._writer.remove(filepath)
+        elif os.path.isfile(filepath):
+            os.remove(filepath)
+
+    def flush(self):
+        """Block until all pending writes have been completed."""
+        if self._writer is not None:
+            self._writer.flush()
+        if self._journal is not None:
+            self._journal.wait()
+
+    def close(self):
+        """Complete all pending writes and release any resources
+        used for persistence."""
+        writer = getattr(self, "_writer", None)
+        if writer is not None:
+            writer.close()
+            self._writer = None
+        journal = getattr(self, "_journal", None)
+        if journal is not None:
+            journal.wait()
+        if isinstance(getattr(self, "items", None), store.SQLiteItems):
+            self.items.close()
+        parent = getattr(super(), "close", None)
+        if parent is not None:
+            parent()
+
+    def get_write_stats(self) -> typing.Optional[dict]:
+        """Get write latency and queue depth statistics for asyncWrites."""
+        return self._writer.get_stats() if self._writer is not None else None
+
+
+class BaseMediaLabeler(views.ViewMixin, media.MediaMixin, PersistenceMixin):
     """A widget for labeling media."""
 
     def __init__(
@@ -209,15 +295,72 @@ class BaseMediaLabeler:
         maxCanvasSize=512,
         maxViewHeight=512,
         basePath: typing.Optional[str] = None,
+        *,
+        journal=False,
+        asyncWrites=False,
+        loadConcurrency=16,
+        lazyLoad=False,
+        jsonIndent: typing.Optional[int] = 4,
+        compactMasks=False,
+        cacheDir: typing.Optional[str] = None,
+        cacheSize: typing.Optional[int] = None,
+        prefetchAhead=3,
+        prefetchBehind=0,
+        prefetchConcurrency=4,
+        arrayFormat="png",
+        arrayQuality: typing.Optional[int] = None,
+        downscaleArrays=False,
+        encodeConcurrency=4,
+        tileThreshold: typing.Optional[int] = None,
+        tileSize=512,
+        thumbnailSize: typing.Optional[int] = None,
+        thumbnailConcurrency=4,
+        maxPreload: typing.Optional[int] = None,
     ):
         super().__init__()
+        if maxPreload is not None:
+            deprecate("maxPreload", "prefetchAhead")
+            prefetchAhead = maxPreload
         self.base = base
         self.jsonpath = jsonpath
         self.action = ""
         self.preload = []
+        self.thumbnails: typing.List[typing.Optional[str]] = []
         self.tempdir = None
+        self.cacheDir = cacheDir
+        self.cacheSize = cacheSize
+        self._cache = None
+        self._prefetcher = None
+        self._encoder = media.ArrayEncoder(
+            format=arrayFormat, quality=arrayQuality, concurrency=encodeConcurrency
+        )
+        self.downscaleArrays = downscaleArrays
+        self.tileThreshold = tileThreshold
+        self.tileSize = tileSize
+        self._thumbnailer = (
+            media.ThumbnailGenerator(thumbnailSize, concurrency=thumbnailConcurrency)
+            if thumbnailSize
+            else None
+        )
+        # Resolves thumbnail URLs (including any downloads) in the background.
+        self._thumbnailJobs = None
+        self._index: typing.Optional[index.MediaIndex] = None
+        self._stats: typing.Optional[stats.LabelStats] = None
+        self._unlabeled: typing.Dict[str, index.PositionSet] = {}
+        self._views: "collections.OrderedDict[str, index.Ordering]" = (
+            collections.OrderedDict()
+        )
+        self._viewFields: typing.Dict[str, typing.Set[str]] = {}
+        self._staleViews: typing.Set[str] = set()
+        self.prefetchAhead = prefetchAhead
+        self.prefetchBehind = prefetchBehind
+        self.prefetchConcurrency = prefetchConcurrency
         self.viewState = "labeling"
         self.message = ""
+        self._unloaded: typing.Set[int] = set()
+        self.jsonIndent = jsonIndent
+        self.compactMasks = compactMasks
+        self.loadConcurrency = loadConcurrency
 
         # Items needs to be handled specially depending
         # on if labeler-wide or items-specific jsonpaths
@@ -231,21 +374,55 @@ class BaseMediaLabeler:
             assert (
                 jsonpath is None
             ), "You cannot supply both item- and labeler-level JSON paths."
-            items = [
-                merge_item(
-                    exists=files.json_or_none(item["jsonpath"]) or item, insert=item
-                )
-                for item in items
-            ]
+            jsonpaths = [item["jsonpath"] for item in items]
+            if lazyLoad:
+                # Only check which items have labels. The labels themselves
+                # are read when the items are viewed.
+                self._unloaded = {
+                    idx
+                    for idx, exists in enumerate(
+                        files.files_exist(jsonpaths, concurrency=loadConcurrency)
+                    )
+                    if exists
+                }
+                items = [item.copy() for item in items]
+            else:
+                items = [
+                    merge_item(
+                        exists=rle.expand_item(exists) if exists else item, insert=item
+                    )
+                    for exists, item in zip(
+                        files.jsons_or_none(jsonpaths, concurrency=loadConcurrency),
+                        items,
+                    )
+                ]
+        jsondata, replayed = None, 0
         if jsonpath is not None:
             assert all(
                 isinstance(item.get("target"), (type(None), str, dict))
                 for item in items
             ), "Using a jsonpath is incompatible with raw array targets. Please remove the jsonpath argument. You can access labels by looking at `labeler.items`."
-            jsondata = files.json_or_none(jsonpath)
+            if store.is_sqlite_path(jsonpath):
+                items = store.SQLiteItems(jsonpath, compactMasks=compactMasks).merge(
+                    items,
+                    key=entry2hash,
+                    merge=lambda exists, insert: merge_item(
+                        exists=exists, insert=insert
+                    ),
+                    represent=lambda item: views.target2repr(
+                        item.get("target"), item.get("type", "image")
+                    ),
+                )
+                jsondata = items.get_settings()
+            else:
+                jsondata, replayed = files.load_project(jsonpath)
+                if jsondata is not None:
+                    items = merge_items(
+                        exists=[rle.expand_item(item) for item in jsondata["items"]],
+                        insert=items,
+                    )
             if jsondata is not None:
-                items = merge_items(exists=jsondata["items"], insert=items)
-                config = jsondata["config"]
+                config = jsondata.get("config", config)
                 mode = jsondata.get("mode", mode)
                 maxCanvasSize = jsondata.get("maxCanvasSize", maxCanvasSize)
                 maxViewHeight = jsondata.get("maxViewHeight", maxViewHeight)
@@ -263,10 +440,37 @@ class BaseMediaLabeler:
         self.config = config or {"image": [], "regions": []}
         self.items = items
         self.idx = 0
-        self._sortedIdxs = list(range(len(items)))
+        self._sortedIdxs = index.Ordering(range(len(items)), len(items))
+        # The key for the requested view and the key for the view
+        # actually shown (these differ if nothing matched a filter).
+        self._viewKey = self._sortedKey = views.view2key([], None)
+        self._views[self._viewKey] = self._sortedIdxs
+        self._viewFields[self._viewKey] = set()
         self.batchSize = batchSize or 1
-        self.maxPreload = 3
-        self.previousIndexState = {
+        self._journal = (
+            files.ProjectJournal(jsonpath, indent=jsonIndent)
+            if journal and jsonpath and not store.is_sqlite_path(jsonpath)
+            else None
+        )
+        self._savedSettings = None
+        self._writer: typing.Optional[files.BackgroundWriter] = None
+        if isinstance(items, store.SQLiteItems) and jsondata is None:
+            self.save_to_disk()
+        if self._journal is not None:
+            if jsondata is None or len(jsondata["items"]) != len(items):
+                # The item list changed, so journal indexes would
+                # no longer line up with the snapshot.
+                self.save_to_disk()
+            elif replayed:
+                self._savedSettings = copy.deepcopy(self.get_settings())
+                self._journal.compact()
+        elif replayed:
+            # Fold a journal left over from an earlier session into the
+            # project file before any writes are queued.
+            self.save_to_disk()
+        if asyncWrites:
+            self._writer = files.BackgroundWriter()
+        self.previousIndexState: typing.Dict[str, typing.Any] = {
             "rows": [],
             "columns": [],
             "rowCount": 0,
@@ -277,22 +481,11 @@ class BaseMediaLabeler:
         }
         self.indexState = self.previousIndexState
         self.progress = self.get_progress()
+        self.stats: typing.Optional[dict] = None
         self.indexState = self.get_index_state()
         self.advance_to_unlabeled()
         self.update(True)
 
-    def get_temporary_directory(self):
-        if self.tempdir:
-            return self.tempdir.name
-        if self.base["serverRoot"] is not None:
-            self.tempdir = (
-                tempfile.TemporaryDirectory(  # pylint: disable=consider-using-with
-                    prefix="qsl-temp", dir=os.path.expanduser(self.base["serverRoot"])
-                )
-            )
-            return self.tempdir.name
-        return None
-
     @property
     def allowConfigChange(self):
         return self._allowConfigChange
@@ -302,59 +495,29 @@ class BaseMediaLabeler:
         self._allowConfigChange = allowConfigChange
         self.set_buttons()
 
-    @property
-    def sortedIdxs(self):
-        filterChanged = (
-            self.previousIndexState["filterModel"] != self.indexState["filterModel"]
-        )
-        sortChanged = (
-            self.previousIndexState["sortModel"] != self.indexState["sortModel"]
-        )
-        if filterChanged or sortChanged:
-            sortKey = (
-                self.indexState["sortModel"][0]["field"]
-                if self.indexState["sortModel"]
-                else None
-            )
-            unsorted = list(range(len(self.items)))
-            if not sortKey:
-                self._sortedIdxs = unsorted
-            else:
-                sortOrd = self.indexState["sortModel"][0]["sort"]
-                self._sortedIdxs = [
-                    idx
-                    for _, idx in sorted(
-                        zip(
-                            build_sort_keys(items=self.items, column=sortKey), unsorted
-                        ),
-                        reverse=sortOrd != "asc",
-                    )
-                ]
-                self.previousIndexState["sortModel"] = self.indexState["sortModel"]
-        if filterChanged and self.indexState["filterModel"]:
-            LOGGER.info("Applying filters.")
-            filterKey = self.indexState["filterModel"][0]["field"]
-            filterVal = self.indexState["filterModel"][0].get("value", None)
-            if filterVal:
-                LOGGER.info("Applying filter value.")
-                self.indexState = {**self.indexState, "page": 0}
-                rows, _ = items2rows(
-                    idxs=self._sortedIdxs,
-                    items=[self.items[idx] for idx in self._sortedIdxs],
-                )
-                filtered = [
-                    idx
-                    for idx, row in zip(self._sortedIdxs, rows)
-                    if row.get(filterKey) and str(filterVal) in str(row[filterKey])
-                ]
-                if not filtered:
-                    LOGGER.info("Did not find any matching filter criteria.")
-                    self.message = f"No rows matched the filter criteria ({filterKey}: {filterVal})."
-                else:
-                    if self.idx not in filtered:
-                        self.idx = filtered[0]
-                    self._sortedIdxs = filtered
-        return self._sortedIdxs
+    def set_view(
+        self,
+        sortModel: typing.Optional[typing.List[dict]] = None,
+        filterModel: typing.Optional[typing.Union[typing.List[dict], dict]] = None,
+    ):
+        """Sort and filter the items to be labeled.
+
+        Args:
+            sortModel: A list of {"field": ..., "sort": "asc" | "desc"} entries,
+                in order of precedence.
+            filterModel: A list of filter clauses (all of which must match) or
+                a group of the form {"items": [...], "logicOperator": "and" | "or"},
+                where each item is a clause or a nested group. Each clause has
+                a field, an operator and a value (e.g.,
+                {"field": "size", "operator": ">=", "value": 10}).
+        """
+        self.indexState = {
+            **self.indexState,
+            "sortModel": sortModel or [],
+            "filterModel": filterModel or [],
+        }
+        self.previousIndexState = self.indexState
+        self.update(True)
 
     @property
     def targets(self) -> typing.List[Target]:
@@ -368,88 +531,26 @@ class BaseMediaLabeler:
         ]
         self.set_buttons()
 
-    def advance_to_unlabeled(self):
-        unlabeled = next(
-            (
-                idx
-                for idx in self.sortedIdxs
-                if not self.items[idx].get("labels")
-                and not self.items[idx].get("ignore")
-            ),
-            None,
-        )
-        if unlabeled is None:
-            LOGGER.warning(
-                "All items have already been labeled. Starting from beginning."
+    def apply_states(self):
+        """Apply changes to the target states made in the UI (e.g.,
+        selecting or deselecting targets in a batch)."""
+        for target, state in zip(self.targets, self.states):
+            target.update(
+                typing.cast(Target, {k: v for k, v in state.items() if k != "target"})
             )
-            self.idx = self.sortedIdxs[0]
-        else:
-            self.idx = self.sortedIdxs[unlabeled]
-        self.update(True)
-
-    def get_index_state(self, reset_page=False):
-        rowsPerPage = round(self.maxViewHeight / 70)
-        # Recompute sortedIdxs if we have to (which may recompute
-        # page as a side effect).
-        sortedIdxs = self.sortedIdxs
-        page = (
-            math.floor(sortedIdxs.index(self.idx) / rowsPerPage)
-            if reset_page
-            else self.indexState["page"]
-        )
-        startIdx = page * rowsPerPage
-        endIdx = startIdx + rowsPerPage
-        idxs = sortedIdxs[startIdx:endIdx]
-        items = [self.items[idx] for idx in idxs]
-
-        rows, metadata_keys = items2rows(
-            idxs=idxs,
-            items=items,
-        )
-        reserved_keys = ["target", "labeled", "ignored", "labels"]
-        used_reserved_keys = set(metadata_keys).intersection(reserved_keys)
-        assert (
-            not used_reserved_keys
-        ), f"The following metadata keys are not permitted, because they are reserved: {used_reserved_keys}"
-        return {
-            **self.indexState,
-            "page": page,
-            "rowCount": len(self.items),
-            "rowsPerPage": rowsPerPage,
-            "rows": rows,
-            "columns": [
-                {
-                    "field": "target",
-                    "type": "string",
-                    "flex": 1,
-                    "headerName": "Target",
-                },
-                {"field": "labeled", "type": "string", "headerName": "Labeled"},
-                {"field": "ignored", "type": "string", "headerName": "Ignored"},
-                {"field": "labels", "type": "string", "headerName": "Labels"},
-            ]
-            + [
-                {
-                    "field": k,
-                    "type": (
-                        "number"
-                        if all(
-                            k not in item.get("metadata", {})
-                            or isinstance(item["metadata"][k], (float, int))
-                            for item in self.items
-                        )
-                        else "string"
-                    ),
-                    "flex": 1,
-                }
-                for k in metadata_keys
-            ],
-        }
+        self.set_buttons()
 
     def set_buttons(self):
+        unlabeled = self.get_unlabeled()
         self.buttons = {
             "prev": self.idx != self.sortedIdxs[0],
             "next": self.targets[-1]["idx"] != self.sortedIdxs[-1],
+            "prevUnlabeled": unlabeled.prev(self.sortedIdxs.index(self.idx) - 1)
+            is not None,
+            "nextUnlabeled": unlabeled.next(
+                self.sortedIdxs.index(self.targets[-1]["idx"]) + 1
+            )
+            is not None,
             "save": any(t["selected"] for t in self.states),
             "config": self._allowConfigChange,
             "delete": any(
@@ -491,32 +592,6 @@ class BaseMediaLabeler:
             self.idx = self.sortedIdxs[sidx]
         self.update(True)
 
-    @property
-    def idxs(self):
-        includes_nonimage = False
-        sidx_initial = self.sortedIdxs.index(self.idx)
-        for count, sidx in enumerate(
-            range(sidx_initial, min(sidx_initial + self.batchSize, len(self.items)))
-        ):
-            includes_nonimage = (
-                includes_nonimage
-                or self.items[self.sortedIdxs[sidx]].get("type", "image") != "image"
-            )
-            if count == 0:
-                # We can always include at least one.
-                yield self.sortedIdxs[sidx]
-            elif not includes_nonimage:
-                # We can include an arbitrary number of non-videos.
-                yield self.sortedIdxs[sidx]
-            else:
-                # We've hit a video in a batch. Do not allow this.
-                break
-
-    @property
-    def targets_and_items(self):
-        for tIdx, iIdx in enumerate(self.idxs):
-            yield self.targets[tIdx], self.items[iIdx]
-
     def apply_action(self, value):
         if not value:
             return
@@ -525,6 +600,10 @@ class BaseMediaLabeler:
             self.next()
         if value == "prev":
             self.prev()
+        if value == "nextUnlabeled":
+            self.next_unlabeled()
+        if value == "prevUnlabeled":
+            self.prev_unlabeled()
         if value == "delete":
             self.delete()
         if value == "ignore":
@@ -543,6 +622,7 @@ class BaseMediaLabeler:
         self.action = ""
 
     def save(self):
+        changed, changedItems = [], []
         for target, item in self.targets_and_items:
             if target["visible"] and target["selected"]:
                 item["labels"] = self.labels
@@ -551,8 +631,10 @@ class BaseMediaLabeler:
                     target["visible"] = False
                 jsonpath = item.get("jsonpath")
                 if jsonpath:
-                    files.labels2json(item, jsonpath)
-        self.save_to_disk()
+                    self.write_json(item, jsonpath)
+                changed.append(target["idx"])
+                changedItems.append(item)
+        self.commit_changes(changed, changedItems)
         if self.advanceOnSave and (
             not any(t["visible"] or (t["type"] == "video") for t in self.targets)
         ):
@@ -560,32 +642,33 @@ class BaseMediaLabeler:
         else:
             self.update(False)
 
-    def save_to_disk(self):
-        if self.jsonpath:
-            files.labels2json(
-                {
-                    "items": self.items,
-                    "config": self.config,
-                    "maxCanvasSize": self.maxCanvasSize,
-                    "maxViewHeight": self.maxViewHeight,
-                    "mode": self.mode,
-                    "batchSize": self.batchSize,
-                    "allowConfigChange": self.allowConfigChange,
-                    "advanceOnSave": self.advanceOnSave,
-                },
-                self.jsonpath,
-            )
+    def get_settings(self):
+        return {
+            "config": self.config,
+            "maxCanvasSize": self.maxCanvasSize,
+            "maxViewHeight": self.maxViewHeight,
+            "mode": self.mode,
+            "batchSize": self.batchSize,
+            "allowConfigChange": self.allowConfigChange,
+            "advanceOnSave": self.advanceOnSave,
+        }
 
     def delete(self):
+        changed, changedItems = [], []
         for target, item in self.targets_and_items:
             if target["visible"] and target["selected"] and "labels" in item:
                 del item["labels"]
                 jsonpath = item.get("jsonpath")
-                if jsonpath and os.path.isfile(jsonpath):
-                    os.remove(jsonpath)
+                if jsonpath:
+                    self.remove_json(jsonpath)
+                changed.append(target["idx"])
+                changedItems.append(item)
+        if changed:
+            self.commit_changes(changed, changedItems)
         self.update(False)
 
     def ignore(self):
+        changed, changedItems = [], []
         for target, item in self.targets_and_items:
             if target["visible"] and target["selected"]:
                 item["ignore"] = True
@@ -594,26 +677,36 @@ class BaseMediaLabeler:
                     del item["labels"]
                 jsonpath = item.get("jsonpath")
                 if jsonpath:
-                    files.labels2json(item, jsonpath)
-        self.save_to_disk()
+                    self.write_json(item, jsonpath)
+                changed.append(target["idx"])
+                changedItems.append(item)
+        self.commit_changes(changed, changedItems)
         if not any(t["visible"] or (t["type"] == "video") for t in self.targets):
             self.next()
         else:
             self.update(False)
 
     def unignore(self):
+        changed, changedItems = [], []
         for target, item in self.targets_and_items:
             if target["visible"] and target["selected"]:
                 item["ignore"] = False
                 jsonpath = item.get("jsonpath")
-                if jsonpath:
-                    files.labels2json(item, jsonpath)
-        self.save_to_disk()
+                # Label files are only kept for labeled or ignored
+                # items (which lazyLoad relies on to track progress).
+                if jsonpath and "labels" in item:
+                    self.write_json(item, jsonpath)
+                elif jsonpath:
+                    self.remove_json(jsonpath)
+                changed.append(target["idx"])
+                changedItems.append(item)
+        self.commit_changes(changed, changedItems)
         self.update(False)
 
     def update(self, reset: bool):
         if reset:
             self.viewState = "transitioning"
+        self.load_items(list(self.idxs))
         self.targets = [
             {
                 "idx": iIdx,
@@ -644,47 +737,123 @@ class BaseMediaLabeler:
                 )
             ),
         )
-        sIdx = self.sortedIdxs.index(self.idx)
-        if self.base and sIdx + 1 < len(self.sortedIdxs):
-            preload = []
-            for iIdx in self.sortedIdxs[sIdx + 1 :]:
-                preloadCandidate = self.items[iIdx]
-                if preloadCandidate.get("type", "image") != "image":
-                    continue
-                preloadUrl = files.build_url(
-                    preloadCandidate.get("target"),
-                    base=self.base,
-                    allow_base64=False,
-                    get_tempdir=self.get_temporary_directory,
-                    basePath=self.basePath,
-                )
-                if preloadUrl:
-                    preload.append(preloadUrl)
-                if len(preload) == self.maxPreload:
-                    break
-            self.preload = preload
+        if self.base:
+            self.preload = self.prefetch(self.sortedIdxs.index(self.idx))
         progress_before = self.progress
         progress_after = self.get_progress()
         if progress_after == 100 and progress_before < 100:
             self.message = "All items have been labeled."
         self.progress = progress_after
+        if self._stats is not None:
+            self.stats = self._stats.get()
         self.viewState = "labeling"
 
     def get_progress(self):
-        return (
-            100
-            * sum(
-                [
-                    (
-                        1
-                        if item.get("labels") is not None or item.get("ignore", False)
-                        else 0
-                    )
-                    for item in self.items
-                ]
-            )
-            / len(self.items)
+        if isinstance(self.items, store.SQLiteItems) and self._stats is None:
+            return 100 * self.items.count_labeled() / len(self.items)
+        return 100 * self.get_stats_tracker().labeled / len(self.items)
+
+    def get_stats_tracker(self) -> stats.LabelStats:
+        """Get the label statistics tracker, building it if necessary. For
+        SQLite projects, it is only built once statistics are requested."""
+        if self._stats is None:
+            # Items that have not been loaded yet are counted as labeled
+            # because they have a label file on disk.
+            self._stats = stats.LabelStats(self.items, unloaded=self._unloaded)
+        return self._stats
+
+    def get_label_stats(self) -> dict:
+        """Get the number of labeled and ignored items and the counts
+        for each image-level label and region type."""
+        return self.get_stats_tracker().get()
+
+    def prefetch(self, sIdx: int) -> typing.List[str]:
+        """Start downloading remote images near the current position in the
+        background (replacing any earlier, stale prefetches) and get the URLs
+        for the upcoming images that are ready to be preloaded."""
+        sortedIdxs = self.sortedIdxs
+        # The current batch starts at sIdx and has already been loaded.
+        ahead = self.get_image_targets(
+            (sortedIdxs[i] for i in range(sIdx + len(self.targets), len(sortedIdxs))),
+            self.prefetchAhead,
         )
+        behind = self.get_image_targets(
+            (sortedIdxs[i] for i in range(sIdx - 1, -1, -1)), self.prefetchBehind
+        )
+        prefetcher = self.get_prefetcher()
+        prefetcher.schedule(
+            [
+                (
+                    target,
+                    functools.partial(
+                        media.build_url,
+                        target,
+                        base=self.base,
+                        allow_base64=False,
+                        get_cache=self.get_media_cache,
+                        basePath=self.basePath,
+                        encoder=self.get_array_encoder(),
+                        **self.get_tile_settings(target),
+                    ),
+                )
+                for target in ahead + behind
+                if media.is_remote(target) or self.is_tileable(target)
+            ]
+        )
+        self.encode_arrays(ahead)
+        if self.uses_thumbnails():
+            # Upcoming batches are shown as thumbnails, so
+            # those are preloaded instead of the images.
+            jobs = self.schedule_thumbnails(
+                [t.get("target") for t in self.targets] + ahead
+            )
+            return [url for url in (jobs.result(target) for target in ahead) if url]
+        preload = []
+        for target in ahead:
+            if media.is_remote(target) or self.is_tileable(target):
+                url = prefetcher.result(target)
+                if url and url.endswith(pyramid.SUFFIX):
+                    # Tiles are loaded as they are viewed.
+                    continue
+            else:
+                url = media.build_url(
+                    target,
+                    base=self.base,
+                    allow_base64=False,
+                    get_cache=self.get_media_cache,
+                    basePath=self.basePath,
+                    sendMedia=self.get_media_sender(),
+                    encoder=self.get_array_encoder(),
+                )
+            if url:
+                preload.append(url)
+        return preload
+
+    def load_items(self, idxs: typing.List[int]):
+        """Read the item-level JSON files for items that were
+        not loaded at startup (i.e., when using lazyLoad)."""
+        idxs = [idx for idx in idxs if idx in self._unloaded]
+        if not idxs:
+            return
+        LOGGER.debug("Loading labels for %d items.", len(idxs))
+        for idx, exists in zip(
+            idxs,
+            files.jsons_or_none(
+                [self.items[idx]["jsonpath"] for idx in idxs],
+                concurrency=self.loadConcurrency,
+            ),
+        ):
+            self.items[idx] = merge_item(
+                exists=rle.expand_item(exists) if exists else self.items[idx],
+                insert=self.items[idx],
+            )
+            self._unloaded.discard(idx)
+        if self._index is not None:
+            self._index.update(idxs)
+        if self._stats is not None:
+            self._stats.update(idxs)
+        self.update_unlabeled(idxs)
+        self.invalidate_views()
 
     def set_urls_and_type(self):
         if self.base:
@@ -707,21 +876,11 @@ class BaseMediaLabeler:
                     {
                         "video1": {
                             **target["video1"],
-                            "target": files.build_url(
-                                target["video1"]["target"],
-                                base=self.base,
-                                get_tempdir=self.get_temporary_directory,
-                                basePath=self.basePath,
-                            ),
+                            "target": self.build_url(target["video1"]["target"]),
                         },
                         "video2": {
                             **target["video2"],
-                            "target": files.build_url(
-                                target["video2"]["target"],
-                                base=self.base,
-                                get_tempdir=self.get_temporary_directory,
-                                basePath=self.basePath,
-                            ),
+                            "target": self.build_url(target["video2"]["target"]),
                         },
                     }
                 ]
@@ -734,24 +893,16 @@ class BaseMediaLabeler:
                         "images": [
                             {
                                 **image,
-                                "target": files.build_url(
-                                    image.get("target"),
-                                    base=self.base,
-                                    get_tempdir=self.get_temporary_directory,
-                                    basePath=self.basePath,
-                                ),
+                                "target": self.build_url(image.get("target")),
                             }
                             for image in target.get("images")
                         ],
                     }
                 ]
             else:
+                self.encode_arrays(t.get("target") for t in self.targets)
                 self.urls = [
-                    files.build_url(
-                        target=t.get("target"),
-                        base=self.base,
-                        get_tempdir=self.get_temporary_directory,
-                        basePath=self.basePath,
-                    )
+                    self.build_url(t.get("target"), tile=self.type == "image")
                     for t in self.targets
                 ]
+            self.thumbnails = self.get_thumbnails()
@@ -0,0 +1,89 @@
+import json
+import typing
+
+# A patch is a list of operations, each of which is one of
+# ["set", path, value], ["delete", path] or ["truncate", path, length],
+# where path is a list of dictionary keys and list positions. Setting
+# the position just past the end of a list appends to it.
+Operation = typing.List[typing.Any]
+
+
+def snapshot(value):
+    """Get a JSON-normalized copy of a value (e.g., tuples become lists)
+    that is safe to compare against later versions of the value."""
+    return json.loads(json.dumps(value))
+
+
+def is_nested(value) -> bool:
+    """Check whether a list holds records (i.e., dictionaries or lists)
+    that are worth diffing element by element. Other lists (e.g.,
+    mask counts or points) are replaced wholesale."""
+    return isinstance(value, list) and any(
+        isinstance(entry, (dict, list)) for entry in value
+    )
+
+
+def diff(old, new, path: typing.Tuple = ()) -> typing.List[Operation]:
+    """Get the operations that turn old into new. Both values must be
+    JSON-normalized (see snapshot)."""
+    if old == new:
+        return []
+    if isinstance(old, dict) and isinstance(new, dict):
+        operations: typing.List[Operation] = []
+        for key, value in new.items():
+            if key in old:
+                operations.extend(diff(old[key], value, path + (key,)))
+            else:
+                operations.append(["set", [*path, key], value])
+        operations.extend(["delete", [*path, key]] for key in old if key not in new)
+        return operations
+    if (
+        isinstance(old, list)
+        and isinstance(new, list)
+        and (is_nested(old) or is_nested(new))
+    ):
+        operations = []
+        for position, (before, after) in enumerate(zip(old, new)):
+            operations.extend(diff(before, after, path + (position,)))
+        if len(new) < len(old):
+            operations.append(["truncate", list(path), len(new)])
+        operations.extend(
+            ["set", [*path, position], new[position]]
+            for position in range(len(old), len(new))
+        )
+        return operations
+    return [["set", list(path), new]]
+
+
+def apply(value, operations: typing.List[Operation]):
+    """Apply a patch to a value in place, returning the patched value
+    (which is only a different object if the root itself was set)."""
+    for operation in operations:
+        kind, path = operation[0], operation[1]
+        if kind == "set" and not path:
+            value = operation[2]
+            continue
+        container = value
+        for key in path[:-1] if kind != "truncate" else path:
+            container = container[key]
+        if kind == "truncate":
+            del container[operation[2] :]
+        elif kind == "delete":
+            del container[path[-1]]
+        elif kind == "set":
+            if isinstance(container, list) and path[-1] == len(container):
+                container.append(operation[2])
+            else:
+                container[path[-1]] = operation[2]
+        else:
+            raise ValueError(f"Unsupported patch operation: {kind}")
+    return value
+
+
+def encode(old, new) -> typing.Optional[typing.List[Operation]]:
+    """Get a patch from old to new (both JSON-normalized), or None if
+    sending new in full would be no larger."""
+    operations = diff(old, new)
+    if operations and len(json.dumps(operations)) >= len(json.dumps(new)):
+        return None
+    return operations
@@ -1,14 +1,21 @@
+import io
 import os
-import shutil
+import re
+import gzip
+import time
+import atexit
 import glob
 import json
 import typing
 import base64
+import hashlib
 import fnmatch
 import pathlib
 import logging
+import tempfile
+import contextlib
 import threading
-import urllib.parse as up
+import concurrent.futures
 
 import filetype
 
@@ -17,18 +24,32 @@ try:
 except ImportError:
     np = None  # type: ignore
 
-try:
-    import cv2
-except ImportError:
-    cv2 = None  # type: ignore
 try:
     import boto3
     import botocore
 except ImportError:
     boto3, botocore = None, None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type: ignore
+
+from . import rle
 
 LOGGER = logging.getLogger(__name__)
-TLS = threading.local()
+# Read the umask (which can only be read by setting it) once, at import
+# time, since changing it is not thread-safe.
+UMASK = os.umask(0o022)
+os.umask(UMASK)
+S3_LOCK = threading.Lock()
+S3_CLIENTS: typing.Dict[typing.Any, typing.Any] = {}
+S3_SETTINGS: typing.Dict[str, typing.Any] = {
+    "endpointUrl": None,
+    "maxPoolConnections": 32,
+    "retries": 5,
+    "connectTimeout": 10,
+    "readTimeout": 60,
+}
 BASE64_PATTERN = "data:{type};charset=utf-8;base64,{data}"
 IMAGE_EXTENSIONS = [
     "3gp",
@@ -55,78 +76,393 @@ def is_array(value: typing.Any):
 def get_s3_files_for_pattern(client, pattern: str) -> typing.List[str]:
     """Get a list of S3 keys given a potential wildcard pattern
     (e.g., 's3://bucket/a/b/*/*.jpg')"""
+    return list(iter_s3_files_for_pattern(client, pattern))
+
+
+def iter_s3_files_for_pattern(
+    client, pattern: str, concurrency=16
+) -> typing.Iterator[str]:
+    """Yield the S3 URIs matching a potential wildcard pattern
+    (e.g., 's3://bucket/*/2024/*.jpg') in order. As with glob, a
+    wildcard matches within a single segment of the key (use ** to
+    match any number of segments). Only the prefixes that match each
+    segment are listed, with sibling prefixes listed concurrently."""
     if "*" not in pattern:
-        return [pattern]
-    segments = pattern.replace("s3://", "").split("/")
-    bucket = segments[0]
-    keypat = "/".join(segments[1:])
-    prefix = "/".join(
-        segments[
-            1 : 1
-            + next((i for i, s in enumerate(segments[1:]) if "*" in s), len(segments))
-        ]
-    )
-    keys = []
-    for page in client.get_paginator("list_objects_v2").paginate(
-        Bucket=bucket, Prefix=prefix
-    ):
-        if "Contents" not in page:
-            break
-        keys.extend(
-            [
-                e["Key"]
-                for e in page["Contents"]
-                if (e["Key"] != prefix or e["Key"] == keypat)
+        yield pattern
+        return
+    bucket, keypat = parse_s3_uri(pattern)
+    segments = keypat.split("/")
+    prefixes = [""]
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        while len(segments) > 1 and "**" not in segments[0]:
+            segment = segments.pop(0)
+            if "*" not in segment:
+                prefixes = [prefix + segment + "/" for prefix in prefixes]
+                continue
+            prefixes = [
+                child
+                for children in pool.map(
+                    lambda prefix, segment=segment: list_s3_prefixes(
+                        client, bucket, prefix, segment
+                    ),
+                    prefixes,
+                )
+                for child in children
             ]
+            if not prefixes:
+                return
+        remainder = "/".join(segments)
+        if len(prefixes) == 1:
+            yield from list_s3_matches(client, bucket, prefixes[0], remainder)
+            return
+        for keys in pool.map(
+            lambda prefix: list(list_s3_matches(client, bucket, prefix, remainder)),
+            prefixes,
+        ):
+            yield from keys
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def literal_prefix(pattern: str) -> str:
+    """Get the part of a wildcard pattern before the first special character."""
+    return re.split(r"[*?[]", pattern, maxsplit=1)[0]
+
+
+def list_s3(client, bucket: str, prefix: str, delimited: bool):
+    """Yield the pages of an S3 listing."""
+    kwargs = {"Bucket": bucket, "Prefix": prefix}
+    if delimited:
+        kwargs["Delimiter"] = "/"
+    yield from client.get_paginator("list_objects_v2").paginate(**kwargs)
+
+
+def list_s3_prefixes(
+    client, bucket: str, prefix: str, segment: str
+) -> typing.List[str]:
+    """List the prefixes directly below a prefix whose
+    final segment matches a wildcard pattern."""
+    return [
+        entry["Prefix"]
+        for page in list_s3(client, bucket, prefix + literal_prefix(segment), True)
+        for entry in page.get("CommonPrefixes", [])
+        if fnmatch.fnmatchcase(entry["Prefix"][len(prefix) : -1], segment)
+    ]
+
+
+def list_s3_matches(
+    client, bucket: str, prefix: str, pattern: str
+) -> typing.Iterator[str]:
+    """Yield the URIs for the keys below a prefix that match a wildcard
+    pattern, only listing recursively if the pattern spans segments."""
+    regex = glob2regex(pattern)
+    delimited = "/" not in pattern and "**" not in pattern
+    matched, deeper = False, False
+    for page in list_s3(client, bucket, prefix + literal_prefix(pattern), delimited):
+        deeper = deeper or bool(page.get("CommonPrefixes"))
+        for entry in page.get("Contents", []):
+            name = entry["Key"][len(prefix) :]
+            # Skip "directory" placeholder keys.
+            if name and not name.endswith("/") and regex.match(name):
+                matched = True
+                yield f"s3://{bucket}/{entry['Key']}"
+    if delimited and deeper and not matched:
+        LOGGER.warning(
+            "No keys matched %s directly below s3://%s/%s, but there are deeper keys. "
+            "Wildcards only match within a segment; use ** to match nested keys.",
+            pattern,
+            bucket,
+            prefix,
         )
-    return [f"s3://{bucket}/{key}" for key in keys if fnmatch.fnmatch(key, keypat)]
+
+
+def glob2regex(pattern: str) -> typing.Pattern:
+    """Compile a wildcard pattern in which *, ? and [...] match within a
+    single segment of a key and a ** segment matches any number of
+    segments, including none."""
+    segments = pattern.split("/")
+    parts = []
+    for index, segment in enumerate(segments):
+        last = index == len(segments) - 1
+        if segment == "**":
+            parts.append(".*" if last else "(?:[^/]+/)*")
+            continue
+        parts.append(segment2regex(segment) + ("" if last else "/"))
+    return re.compile("".join(parts) + r"\Z")
+
+
+def closing_bracket(segment: str, start: int) -> int:
+    """Find the end of a character class that starts at position start
+    (after the opening bracket), or -1 if it is not closed."""
+    if segment[start : start + 1] == "!":
+        start += 1
+    if segment[start : start + 1] == "]":
+        start += 1
+    return segment.find("]", start)
+
+
+def segment2regex(segment: str) -> str:
+    """Translate a wildcard pattern for a single segment to a regular
+    expression that does not match across segments."""
+    parts = []
+    position = 0
+    while position < len(segment):
+        character = segment[position]
+        position += 1
+        if character == "*":
+            parts.append("[^/]*")
+        elif character == "?":
+            parts.append("[^/]")
+        elif character == "[" and closing_bracket(segment, position) >= 0:
+            end = closing_bracket(segment, position)
+            contents = segment[position:end].replace("\\", "\\\\")
+            position = end + 1
+            if contents.startswith("!"):
+                contents = "^" + contents[1:]
+            elif contents.startswith("^"):
+                contents = "\\" + contents
+            parts.append("[" + contents + "]")
+        else:
+            parts.append(re.escape(character))
+    return "".join(parts)
+
+
+def configure_s3(client=None, **settings):
+    """Configure S3 access for all labelers. Provide a client to use
+    it instead of creating one (e.g., for a local stand-in such as MinIO)
+    or override any of the settings in S3_SETTINGS (e.g., endpointUrl,
+    maxPoolConnections, retries, connectTimeout and readTimeout)."""
+    unknown = set(settings).difference(S3_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown S3 settings: {', '.join(sorted(unknown))}.")
+    with S3_LOCK:
+        S3_SETTINGS.update(settings)
+        S3_CLIENTS.clear()
+        S3_CLIENTS[None] = client
 
 
 def get_s3():
-    """Provide an s3 client"""
-    if boto3 is None:
-        raise ImportError("You must `pip install boto3 botocore` to use S3 files.")
-    if not hasattr(TLS, "aws_session"):
-        TLS.aws_session = boto3.session.Session()
-    return TLS.aws_session.client(
-        "s3", config=botocore.config.Config(signature_version="s3v4")
-    )
+    """Provide an s3 client. Clients are thread-safe, so one client (and
+    its connection pool) is shared by all threads for each configuration."""
+    with S3_LOCK:
+        if S3_CLIENTS.get(None) is not None:
+            return S3_CLIENTS[None]
+        key = tuple(sorted(S3_SETTINGS.items()))
+        if key not in S3_CLIENTS:
+            if boto3 is None:
+                raise ImportError(
+                    "You must `pip install boto3 botocore` to use S3 files."
+                )
+            # Sessions are not thread-safe, so each client gets its own.
+            S3_CLIENTS[key] = boto3.session.Session().client(
+                "s3",
+                endpoint_url=S3_SETTINGS["endpointUrl"],
+                config=botocore.config.Config(
+                    signature_version="s3v4",
+                    max_pool_connections=S3_SETTINGS["maxPoolConnections"],
+                    retries={
+                        "max_attempts": S3_SETTINGS["retries"],
+                        "mode": "standard",
+                    },
+                    connect_timeout=S3_SETTINGS["connectTimeout"],
+                    read_timeout=S3_SETTINGS["readTimeout"],
+                ),
+            )
+        return S3_CLIENTS[key]
 
 
 def filepaths_from_patterns(patterns: typing.List[str], s3=None) -> typing.List[str]:
     """Create filepaths from patterns."""
-    filepaths = []
+    return list(iter_filepaths_from_patterns(patterns, s3=s3))
+
+
+def iter_filepaths_from_patterns(
+    patterns: typing.List[str], s3=None
+) -> typing.Iterator[str]:
+    """Yield filepaths for patterns as they are found."""
     for file_or_pattern in patterns:
         if file_or_pattern.startswith("s3://"):
             if s3 is None:
                 s3 = get_s3()
-            filepaths.extend(
-                get_s3_files_for_pattern(client=s3, pattern=file_or_pattern)
-            )
+            yield from iter_s3_files_for_pattern(client=s3, pattern=file_or_pattern)
         elif file_or_pattern.startswith("http://") or file_or_pattern.startswith(
             "https://"
         ):
             # We have no way of handling wildcards for HTTP URLs.
-            filepaths.append(file_or_pattern)
+            yield file_or_pattern
         else:
-            filepaths.extend(glob.glob(file_or_pattern, recursive=True))
-    return filepaths
+            yield from glob.iglob(file_or_pattern, recursive=True)
 
 
 def json_or_none(filepath: str):
-    """Try to load JSON from a path, returning None upon failure."""
+    """Try to load JSON from a path, returning None upon failure. Compressed
+    (*.gz, *.zst) and JSON-lines (*.jsonl) files are also supported."""
+    if not os.path.isfile(filepath):
+        return None
     try:
-        labels = (
-            json.loads(pathlib.Path(filepath).read_text(encoding="utf8"))
-            if os.path.isfile(filepath)
-            else None
-        )
-    except json.JSONDecodeError:
+        with open_text(filepath) as f:
+            labels = read_json(f, filepath)
+    except (json.JSONDecodeError, EOFError, UnicodeDecodeError, gzip.BadGzipFile):
         os.remove(filepath)
         labels = None
     return labels
 
 
+def get_compression(filepath: str) -> typing.Optional[str]:
+    """Get the compression implied by a file extension."""
+    lower = filepath.lower()
+    if lower.endswith(".gz"):
+        return "gzip"
+    if lower.endswith((".zst", ".zstd")):
+        return "zstd"
+    return None
+
+
+def is_jsonlines(filepath: str) -> bool:
+    """Check whether a file extension implies the JSON-lines
+    project format (a settings line followed by one line per item)."""
+    lower = filepath.lower()
+    if get_compression(lower):
+        lower = os.path.splitext(lower)[0]
+    return lower.endswith((".jsonl", ".ndjson"))
+
+
+def is_json_path(filepath: str) -> bool:
+    """Check whether a path has one of the supported JSON extensions."""
+    lower = filepath.lower()
+    if get_compression(lower):
+        lower = os.path.splitext(lower)[0]
+    return lower.endswith((".json", ".jsonl", ".ndjson"))
+
+
+def wrap_stream(raw: typing.BinaryIO, filepath: str, mode: str) -> io.TextIOWrapper:
+    """Wrap a binary stream in a text stream, (de)compressing
+    according to the file extension."""
+    compression = get_compression(filepath)
+    stream: typing.Any = raw
+    if compression == "gzip":
+        stream = gzip.GzipFile(fileobj=raw, mode=mode + "b")
+    elif compression == "zstd":
+        if zstandard is None:
+            raise ImportError("You must `pip install zstandard` to use *.zst files.")
+        stream = (
+            zstandard.ZstdDecompressor().stream_reader(raw, closefd=False)
+            if mode == "r"
+            else zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+        )
+    return io.TextIOWrapper(stream, encoding="utf8")
+
+
+@contextlib.contextmanager
+def open_text(filepath: str):
+    """Open a (possibly compressed) file for reading text."""
+    with open(filepath, "rb") as raw:
+        yield wrap_stream(raw, filepath, "r")
+
+
+def read_json(f: typing.TextIO, filepath: str):
+    """Read JSON from a text stream using the format implied by filepath."""
+    if not is_jsonlines(filepath):
+        return read_json_stream(f)
+    lines = (line for line in f if line.strip())
+    header = json.loads(next(lines, "{}"))
+    return {**header, "items": [json.loads(line) for line in lines]}
+
+
+def read_json_stream(f: typing.TextIO, chunkSize=1 << 20):
+    """Parse a JSON object from a text stream. The values of an "items" array
+    are decoded one at a time, so the raw text and the parsed items are never
+    both held in memory in full."""
+    decoder = json.JSONDecoder()
+    state: typing.Dict[str, typing.Any] = {"buffer": "", "pos": 0, "eof": False}
+
+    def fill():
+        chunk = f.read(chunkSize)
+        state["eof"] = not chunk
+        state["buffer"] = state["buffer"][state["pos"] :] + chunk
+        state["pos"] = 0
+        return bool(chunk)
+
+    def peek():
+        while True:
+            buffer, pos = state["buffer"], state["pos"]
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            state["pos"] = pos
+            if pos < len(buffer):
+                return buffer[pos]
+            if not fill():
+                raise json.JSONDecodeError("Unexpected end of file", buffer, pos)
+
+    def expect(chars):
+        char = peek()
+        if char not in chars:
+            raise json.JSONDecodeError(
+                f"Expected one of {chars}", state["buffer"], state["pos"]
+            )
+        state["pos"] += 1
+        return char
+
+    def value():
+        peek()
+        while True:
+            try:
+                decoded, end = decoder.raw_decode(state["buffer"], state["pos"])
+                # A value that runs to the end of the buffer (e.g., a
+                # number) may continue in the next chunk.
+                if end < len(state["buffer"]) or state["eof"]:
+                    state["pos"] = end
+                    return decoded
+            except json.JSONDecodeError:
+                if state["eof"]:
+                    raise
+            fill()
+
+    if peek() != "{":
+        return json.loads(state["buffer"][state["pos"] :] + f.read())
+    expect("{")
+    result: typing.Dict[str, typing.Any] = {}
+    if peek() == "}":
+        return result
+    while True:
+        key = value()
+        expect(":")
+        if key == "items" and peek() == "[":
+            expect("[")
+            items: typing.List[typing.Any] = []
+            if peek() == "]":
+                expect("]")
+            else:
+                items.append(value())
+                while expect(",]") == ",":
+                    items.append(value())
+            result[key] = items
+        else:
+            result[key] = value()
+        if expect(",}") == "}":
+            return result
+
+
+def jsons_or_none(filepaths: typing.List[str], concurrency=16) -> typing.List:
+    """Load JSON from many paths using a pool of threads, returning
+    None for any path that could not be loaded."""
+    return pool_map(json_or_none, filepaths, concurrency)
+
+
+def files_exist(filepaths: typing.List[str], concurrency=16) -> typing.List[bool]:
+    """Check whether many files exist using a pool of threads."""
+    return pool_map(os.path.isfile, filepaths, concurrency)
+
+
+def pool_map(func, values: typing.List, concurrency: int) -> typing.List:
+    """Map a function over values using a bounded pool of threads."""
+    if concurrency <= 1 or len(values) <= 1:
+        return [func(value) for value in values]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+        return list(pool.map(func, values))
+
+
 def file2str(filepath: str):
     """Given a file, convert it to a base64 string."""
     if os.stat(filepath).st_size > 10e6:
@@ -143,17 +479,6 @@ def file2str(filepath: str):
     )
 
 
-# pylint: disable=no-member
-def arr2str(image: "np.ndarray"):
-    """Given an image array, convert it to a base64 string."""
-    if cv2 is None:
-        raise ValueError("Labeling arrays requires OpenCV.")
-    return BASE64_PATTERN.format(
-        type="image/png",
-        data=base64.b64encode(cv2.imencode(".png", image)[1].tobytes()).decode("utf8"),
-    )
-
-
 def get_relpath(filepath, directory):
     """Convert a filepath to a relative path to a directory."""
     relpath = os.path.relpath(filepath, directory)
@@ -162,88 +487,432 @@ def get_relpath(filepath, directory):
     return relpath
 
 
-def build_url(
-    target: typing.Union[str, "np.ndarray"],
-    base: dict,
-    get_tempdir: typing.Callable[[], str],
-    allow_base64=True,
-    basePath: typing.Optional[str] = None,
+def str2digest(*parts) -> str:
+    """Compute a deterministic digest for a series of values."""
+    return hashlib.blake2b(
+        "\0".join(map(str, parts)).encode("utf8"), digest_size=16
+    ).hexdigest()
+
+
+def parse_s3_uri(uri: str) -> typing.Tuple[str, str]:
+    """Split an S3 URI into its bucket and key."""
+    segments = uri[len("s3://") :].split("/")
+    return segments[0], "/".join(segments[1:])
+
+
+def remove_if_exists(filepath: str) -> bool:
+    """Remove a file, tolerating it having already been removed."""
+    try:
+        os.remove(filepath)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def labels2json(labels, filepath, indent: typing.Optional[int] = 4):
+    """Write labels to a JSON file. The extension of filepath determines
+    the format (*.json or *.jsonl) and compression (*.gz or *.zst).
+    If indent is None, minified JSON is written."""
+    os.replace(write_json_temporary(labels, filepath, indent=indent), filepath)
+
+
+def write_json_temporary(
+    labels, filepath: str, indent: typing.Optional[int] = 4, fsync=False
 ) -> str:
-    """Build a notebook file URL using notebook configuration and a filepath or URL."""
-    if target is None:
-        return None
-    missing_base = not base or not base.get("serverRoot") or not base.get("url")
-    tfilepath = None
-    if isinstance(target, str) and (
-        target.lower().startswith("http://")
-        or target.lower().startswith("https://")
-        or target.startswith("data:")
-    ):
-        return target
-    if is_array(target):
-        tdir = get_tempdir()
-        target = typing.cast("np.ndarray", target)
-        if tdir is None or missing_base:
-            return arr2str(target)
-        tfilepath = os.path.join(tdir, str(hash(target.data.tobytes())) + ".png")
-        if not os.path.isfile(tfilepath):
-            cv2.imwrite(tfilepath, target)
+    """Write labels to a temporary file in the same directory as filepath,
+    returning the temporary path so that it can be renamed into place."""
+    return write_temporary(
+        lambda f: dump_json(labels, f, filepath=filepath, indent=indent),
+        filepath,
+        fsync=fsync,
+    )
 
-    if isinstance(target, str) and target.lower().startswith("s3://"):
-        s3 = get_s3()
-        tdir = get_tempdir()
-        segments = target.lower().replace("s3://", "").split("/")
-        bucket = segments[0]
-        key = "/".join(segments[1:])
-        if tdir is None or missing_base:
-            return s3.generate_presigned_url(
-                "get_object",
-                Params={"Bucket": bucket, "Key": key},
-                ExpiresIn=3600,
-            )
-        tfilepath = os.path.join(
-            tdir,
-            str(hash(target)) + os.path.splitext(segments[-1])[1],
-        )
-        if not os.path.isfile(tfilepath):
-            s3.download_file(Bucket=bucket, Key=key, Filename=tfilepath)
-    if isinstance(target, str) and basePath:
-        target = os.path.join(basePath, target)
-    if isinstance(target, str) and os.path.isfile(target):
-        if missing_base:
-            return file2str(target) if allow_base64 else None
-        if (
-            ".." in get_relpath(target, os.path.expanduser(base["serverRoot"]))
-            and get_tempdir() is not None
-        ):
-            tdir = get_tempdir()
-            tfilepath = os.path.join(
-                tdir, str(hash(target)) + os.path.splitext(target)[1]
-            )
-            if not os.path.isfile(tfilepath):
-                shutil.copy(target, tfilepath)
-        else:
-            tfilepath = target
-    if tfilepath is not None:
-        return up.urljoin(
-            base["url"],
-            os.path.join(
-                "files",
-                up.quote(
-                    get_relpath(tfilepath, os.path.expanduser(base["serverRoot"]))
+
+def dump_json(labels, f: typing.TextIO, filepath: str, indent: typing.Optional[int]):
+    """Write labels to a text stream incrementally, without building
+    the entire serialized string in memory."""
+    if is_jsonlines(filepath) and isinstance(labels, dict) and "items" in labels:
+        f.write(json.dumps({k: v for k, v in labels.items() if k != "items"}) + "\n")
+        for item in labels["items"]:
+            f.write(json.dumps(item) + "\n")
+    elif indent is None and isinstance(labels, dict):
+        # Serializing one value at a time allows us to use the (much faster)
+        # C encoder, which is only used for one-shot, unindented encoding.
+        f.write("{")
+        for idx, (key, value) in enumerate(labels.items()):
+            f.write(("," if idx else "") + json.dumps(key) + ":")
+            if key == "items" and isinstance(value, list):
+                f.write("[")
+                for iidx, item in enumerate(value):
+                    f.write(
+                        ("," if iidx else "") + json.dumps(item, separators=(",", ":"))
+                    )
+                f.write("]")
+            else:
+                f.write(json.dumps(value, separators=(",", ":")))
+        f.write("}")
+    else:
+        for chunk in json.JSONEncoder(indent=indent).iterencode(labels):
+            f.write(chunk)
+
+
+def write_temporary(
+    write: typing.Callable[[typing.TextIO], None], filepath: str, fsync=False
+) -> str:
+    """Write to a temporary file in the same directory as filepath
+    (compressing according to its extension) and return its path."""
+    dirname = os.path.dirname(filepath)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    fd, temppath = tempfile.mkstemp(
+        dir=dirname or None, prefix=os.path.basename(filepath) + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "wb") as raw:
+            f = wrap_stream(raw, filepath, "w")
+            write(f)
+            f.flush()
+            stream = f.detach()
+            if stream is not raw:
+                # Finish the compressed stream without closing the file.
+                stream.close()
+            if fsync:
+                raw.flush()
+                os.fsync(raw.fileno())
+        match_mode(temppath, filepath)
+    except BaseException:
+        os.remove(temppath)
+        raise
+    return temppath
+
+
+def match_mode(temppath: str, filepath: str):
+    """Give a temporary file (which mkstemp makes private to its owner) the
+    permissions of the file it will replace or, if there is none, those of
+    a newly created file."""
+    try:
+        mode = os.stat(filepath).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = 0o666 & ~UMASK
+    os.chmod(temppath, mode)
+
+
+def convert_project(
+    source: str,
+    destination: str,
+    indent: typing.Optional[int] = 4,
+    compactMasks: typing.Optional[bool] = None,
+) -> str:
+    """Convert a project file (including any journal) to the format
+    implied by the destination extension. If compactMasks is True (False),
+    mask counts are converted to compact strings (lists of integers).
+    Otherwise, they are left as they are."""
+    project, _ = load_project(source)
+    if project is None:
+        raise ValueError(f"Could not load a project from {source}.")
+    if compactMasks is not None:
+        convert = rle.compact_item if compactMasks else rle.expand_item
+        project = {**project, "items": [convert(item) for item in project["items"]]}
+    labels2json(project, destination, indent=indent)
+    return destination
+
+
+def fsync_directory(dirname: str):
+    """Make renames within a directory durable (where supported)."""
+    try:
+        fd = os.open(dirname or ".", os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class BackgroundWriter:
+    """Writes JSON files on a background thread. Repeated writes to
+    the same path are coalesced so that only the latest version is
+    written, each batch is fsynced together and every file is written
+    atomically using a temporary file and a rename."""
+
+    REMOVE = object()
+
+    def __init__(self, fsync=True):
+        self.fsync = fsync
+        self.condition = threading.Condition()
+        self.pending: typing.Dict[str, typing.Tuple[typing.Any, float]] = {}
+        self.busy = False
+        self.closed = False
+        self.stats = {
+            "written": 0,
+            "removed": 0,
+            "coalesced": 0,
+            "errors": 0,
+            "batches": 0,
+            "lastLatency": 0.0,
+            "maxLatency": 0.0,
+            "totalLatency": 0.0,
+        }
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    @property
+    def depth(self) -> int:
+        """The number of files waiting to be written."""
+        with self.condition:
+            return len(self.pending) + (1 if self.busy else 0)
+
+    def get_stats(self) -> dict:
+        """Get write statistics, including latency (from the first request
+        to write a version of a file to it being on disk) and queue depth."""
+        with self.condition:
+            completed = self.stats["written"] + self.stats["removed"]
+            return {
+                **self.stats,
+                "meanLatency": (
+                    self.stats["totalLatency"] / completed if completed else 0.0
                 ),
-            ),
-        )
-    raise ValueError(f"Failed to load file at target: {target}")
+                "queueDepth": len(self.pending),
+            }
+
+    def write(self, labels, filepath: str, indent: typing.Optional[int] = 4):
+        """Queue labels to be written to a JSON file."""
+        self.enqueue(filepath, (labels, indent))
+
+    def remove(self, filepath: str):
+        """Queue the removal of a file."""
+        self.enqueue(filepath, self.REMOVE)
+
+    def enqueue(self, filepath: str, payload):
+        """Queue a write or removal, replacing any queued for the same file."""
+        with self.condition:
+            if self.closed:
+                raise ValueError("Cannot write using a closed writer.")
+            if filepath in self.pending:
+                self.stats["coalesced"] += 1
+                queued = self.pending[filepath][1]
+            else:
+                queued = time.monotonic()
+            self.pending[filepath] = (payload, queued)
+            self.condition.notify_all()
 
+    def run(self):
+        """Write queued batches on the writer thread until closed."""
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                batch, self.pending = self.pending, {}
+                self.busy = True
+            try:
+                self.write_batch(batch)
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
 
-def labels2json(labels, filepath):
-    """Write labels to a JSON file."""
+    def write_batch(self, batch: typing.Dict[str, typing.Tuple[typing.Any, float]]):
+        """Write a batch of files, renaming them into place only once
+        all of them have been written (and fsynced)."""
+        renames, completed = [], []
+        for filepath, (payload, queued) in batch.items():
+            try:
+                if payload is self.REMOVE:
+                    if os.path.isfile(filepath):
+                        os.remove(filepath)
+                    completed.append(("removed", filepath, queued))
+                    continue
+                labels, indent = payload
+                try:
+                    temppath = write_json_temporary(
+                        labels, filepath, indent=indent, fsync=self.fsync
+                    )
+                except RuntimeError:
+                    # The payload was modified while we were serializing
+                    # it, so try again (unless a newer version has been queued).
+                    with self.condition:
+                        self.pending.setdefault(filepath, (payload, queued))
+                    continue
+                renames.append((temppath, filepath, queued))
+            except OSError:
+                LOGGER.exception("Failed to write %s.", filepath)
+                self.stats["errors"] += 1
+        for temppath, filepath, queued in renames:
+            try:
+                os.replace(temppath, filepath)
+                completed.append(("written", filepath, queued))
+            except OSError:
+                LOGGER.exception("Failed to write %s.", filepath)
+                self.stats["errors"] += 1
+        if self.fsync:
+            for dirname in set(os.path.dirname(f) for _, f, _ in completed):
+                fsync_directory(dirname)
+        now = time.monotonic()
+        with self.condition:
+            self.stats["batches"] += 1
+            for kind, _, queued in completed:
+                latency = now - queued
+                self.stats[kind] += 1
+                self.stats["lastLatency"] = latency
+                self.stats["totalLatency"] += latency
+                self.stats["maxLatency"] = max(self.stats["maxLatency"], latency)
+            LOGGER.debug(
+                "Wrote %d files (queue depth: %d).", len(completed), len(self.pending)
+            )
+
+    def flush(self):
+        """Block until all queued writes are on disk."""
+        with self.condition:
+            while self.pending or self.busy:
+                self.condition.wait()
+
+    def close(self):
+        """Flush all queued writes and stop the writer thread."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        atexit.unregister(self.flush)
+
+
+def journal_paths(filepath: str) -> typing.Tuple[str, str]:
+    """Get the paths for the active journal and the journal
+    segment that is being compacted for a project file."""
+    return filepath + ".journal", filepath + ".journal.compacting"
+
+
+def append_journal(records: typing.List[dict], filepath: str):
+    """Append records to a JSON-lines journal file."""
     dirname = os.path.dirname(filepath)
     if dirname:
         os.makedirs(dirname, exist_ok=True)
-    with open(filepath, "w", encoding="utf8") as f:
-        f.write(json.dumps(labels, indent=4))
+    with open(filepath, "a", encoding="utf8") as f:
+        f.write("".join(json.dumps(record) + "\n" for record in records))
+
+
+def read_journal(filepath: str) -> typing.List[dict]:
+    """Read the records from a journal file. A truncated final
+    record (e.g., from a crash mid-write) is ignored."""
+    records: typing.List[dict] = []
+    if not os.path.isfile(filepath):
+        return records
+    with open(filepath, "r", encoding="utf8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                LOGGER.warning("Ignoring truncated journal record in %s.", filepath)
+                break
+    return records
+
+
+def replay_journal(project: dict, records: typing.List[dict]) -> dict:
+    """Apply journal records to a project. Records either replace
+    a single item or update the project-level settings."""
+    items = project.setdefault("items", [])
+    for record in records:
+        if "idx" in record:
+            if record["idx"] < len(items):
+                items[record["idx"]] = record["item"]
+            elif record["idx"] == len(items):
+                items.append(record["item"])
+            else:
+                raise ValueError(
+                    f"Journal record for item {record['idx']} does not match the project with {len(items)} items."
+                )
+        if "settings" in record:
+            project.update(record["settings"])
+    return project
+
+
+def flatten_journals(filepath: str) -> typing.List[dict]:
+    """Read all journal records for a project file in the order they were written."""
+    active, compacting = journal_paths(filepath)
+    return read_journal(compacting) + read_journal(active)
+
+
+def load_project(filepath: str) -> typing.Tuple[typing.Optional[dict], int]:
+    """Load a project snapshot and replay any journal records on top of it,
+    returning the project and the number of records that were replayed."""
+    project = json_or_none(filepath)
+    records = flatten_journals(filepath)
+    if not records:
+        return project, 0
+    return replay_journal(project or {"items": []}, records), len(records)
+
+
+def remove_journals(filepath: str):
+    """Remove all journal files for a project file."""
+    for journal in journal_paths(filepath):
+        if os.path.isfile(journal):
+            os.remove(journal)
+
+
+class ProjectJournal:
+    """An append-only journal for a project file. Each mutation is
+    appended as a small record and the journal is periodically folded
+    into the project snapshot by a background thread."""
+
+    def __init__(
+        self,
+        filepath: str,
+        compactEvery: int = 1000,
+        indent: typing.Optional[int] = 4,
+    ):
+        self.filepath = filepath
+        self.compactEvery = compactEvery
+        self.indent = indent
+        self.lock = threading.Lock()
+        self.count = len(read_journal(journal_paths(filepath)[0]))
+        self.thread: typing.Optional[threading.Thread] = None
+
+    def append(self, records: typing.List[dict]):
+        """Append records to the journal, compacting if required."""
+        with self.lock:
+            append_journal(records, journal_paths(self.filepath)[0])
+            self.count += len(records)
+        if self.count >= self.compactEvery:
+            self.compact()
+
+    def compact(self, wait=False):
+        """Fold the journal into the snapshot. The active journal is
+        rotated so that appends can continue while compaction runs."""
+        if self.thread is None or not self.thread.is_alive():
+            active, compacting = journal_paths(self.filepath)
+            with self.lock:
+                if os.path.isfile(active) and not os.path.isfile(compacting):
+                    os.replace(active, compacting)
+                    self.count = 0
+            if os.path.isfile(compacting):
+                self.thread = threading.Thread(
+                    target=compact_project,
+                    args=(self.filepath, self.indent),
+                    daemon=True,
+                )
+                self.thread.start()
+        if wait:
+            self.wait()
+
+    def wait(self):
+        """Wait for any running compaction to finish."""
+        if self.thread is not None:
+            self.thread.join()
+
+
+def compact_project(filepath: str, indent: typing.Optional[int] = 4):
+    """Fold the journal segment that is being compacted into the
+    project snapshot."""
+    compacting = journal_paths(filepath)[1]
+    project = replay_journal(
+        json_or_none(filepath) or {"items": []}, read_journal(compacting)
+    )
+    labels2json(project, filepath, indent=indent)
+    os.remove(compacting)
 
 
 def guess_type(target: typing.Union[str, "np.ndarray"]):
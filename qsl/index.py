@@ -0,0 +1,640 @@
+import sys
+import json
+import typing
+import logging
+import collections
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # type: ignore
+
+LOGGER = logging.getLogger(__name__)
+
+
+def value2key(value):
+    """Get a hashable key for a media index value."""
+    if isinstance(value, str):
+        return value
+    try:
+        hash(value)
+        # Avoid conflating True with 1.
+        return (isinstance(value, bool), value)
+    except TypeError:
+        return (False, json.dumps(value, sort_keys=True))
+
+
+def is_number(value) -> bool:
+    """Check whether a value is a (non-boolean) number."""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def value2sortable(value) -> typing.Tuple[int, typing.Any]:
+    """Get a key for sorting values of mixed types (numbers before strings)."""
+    if isinstance(value, (int, float)):
+        return (0, value)
+    return (1, str(value))
+
+
+# A hidden media index column holding the image-level labels
+# of each item as (name, value) pairs.
+CLASSES = "$classes"
+# Filter operators that compare numbers, along with their vectorized forms.
+NUMERIC_OPERATORS: typing.Dict[
+    str, typing.Callable[[typing.Any, float], typing.Any]
+] = {
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+}
+# Filter operators that do not take a value.
+UNARY_OPERATORS = {"isEmpty", "isNotEmpty"}
+
+
+def is_equal(value, operand) -> bool:
+    """Check whether a value equals an operand, which may be given as text."""
+    return value is not None and (value == operand or str(value) == str(operand))
+
+
+def has_class(value, operand) -> bool:
+    """Check whether a media index value for CLASSES includes a label. The
+    operand is either a label value (e.g., "Dog") or a name and value
+    (e.g., {"name": "Type", "value": "Dog"})."""
+    if isinstance(operand, dict):
+        return (operand["name"], str(operand["value"])) in (value or ())
+    return any(label == str(operand) for _, label in value or ())
+
+
+def is_between(value, operand) -> bool:
+    """Check whether a value is a number in an inclusive range, either
+    end of which may be None."""
+    low, high = operand
+    return (
+        is_number(value)
+        and (low is None or value >= float(low))
+        and (high is None or value <= float(high))
+    )
+
+
+# Filter operators that do not compare numbers.
+MATCHERS: typing.Dict[str, typing.Callable[[typing.Any, typing.Any], bool]] = {
+    "contains": lambda value, operand: bool(value) and str(operand) in str(value),
+    "equals": is_equal,
+    "isAnyOf": lambda value, operand: any(
+        is_equal(value, option) for option in operand
+    ),
+    "startsWith": lambda value, operand: value is not None
+    and str(value).startswith(str(operand)),
+    "endsWith": lambda value, operand: value is not None
+    and str(value).endswith(str(operand)),
+    "isEmpty": lambda value, _: value is None or value == "",
+    "isNotEmpty": lambda value, _: not (value is None or value == ""),
+    "hasClass": has_class,
+    "between": is_between,
+}
+
+
+def matches(value, operator: str, operand) -> bool:
+    """Check whether a media index value satisfies a filter clause."""
+    if operator in MATCHERS:
+        return MATCHERS[operator](value, operand)
+    if operator in NUMERIC_OPERATORS:
+        return is_number(value) and bool(
+            NUMERIC_OPERATORS[operator](value, float(operand))
+        )
+    raise ValueError(f"Unsupported filter operator: {operator}")
+
+
+def parse_filter(filterModel) -> typing.Optional[dict]:
+    """Normalize a filter model into a group of the form {"items": [...],
+    "logicOperator": "and" | "or"}, where each item is either a clause
+    ({"field": ..., "operator": ..., "value": ...}) or a nested group.
+    A list of clauses is treated as their conjunction. Clauses that are
+    missing a value (e.g., while they are being edited) are dropped and
+    None is returned if nothing is left to filter on."""
+    if isinstance(filterModel, list):
+        filterModel = {"items": filterModel}
+    logic = str(
+        filterModel.get("logicOperator", filterModel.get("linkOperator", "and"))
+    ).lower()
+    if logic not in ("and", "or"):
+        raise ValueError(f"Unsupported filter logic operator: {logic}")
+    items: typing.List[dict] = []
+    for entry in filterModel.get("items", []):
+        if "items" in entry:
+            group = parse_filter(entry)
+            if group is not None:
+                items.append(group)
+            continue
+        operator = entry.get("operator") or "contains"
+        value = entry.get("value")
+        if not entry.get("field") or (
+            operator not in UNARY_OPERATORS and value in (None, "", [])
+        ):
+            continue
+        items.append({"field": entry["field"], "operator": operator, "value": value})
+    return {"items": items, "logicOperator": logic} if items else None
+
+
+def filter_fields(group: typing.Optional[dict]) -> typing.Set[str]:
+    """Get the columns used by a (parsed) filter."""
+    if group is None:
+        return set()
+    return set().union(
+        *(
+            filter_fields(entry) if "items" in entry else {entry["field"]}
+            for entry in group["items"]
+        )
+    )
+
+
+def evaluate_filter(
+    group: dict,
+    match: typing.Callable[[dict], typing.Any],
+    conjunction: typing.Callable[[typing.List[typing.Any]], typing.Any],
+    disjunction: typing.Callable[[typing.List[typing.Any]], typing.Any],
+):
+    """Evaluate a (parsed) filter, using match to evaluate each clause and
+    conjunction / disjunction to combine the results for each group."""
+    results = [
+        (
+            evaluate_filter(entry, match, conjunction, disjunction)
+            if "items" in entry
+            else match(entry)
+        )
+        for entry in group["items"]
+    ]
+    return (disjunction if group["logicOperator"] == "or" else conjunction)(results)
+
+
+class SearchIndex:
+    """A trigram index for finding the strings that contain a query. The
+    postings for each trigram (the ids of the strings containing it) are
+    stored as slices of one sorted array, so a query only has to look at
+    the strings that contain all of its trigrams. Strings added after the
+    index is built are checked directly."""
+
+    def __init__(self, texts: typing.List[typing.Optional[str]]):
+        self.encoded = [text.encode("utf8") if text else None for text in texts]
+        self.added: typing.List[int] = []
+        self.short = [
+            key
+            for key, encoded in enumerate(self.encoded)
+            if encoded is not None and len(encoded) < 3
+        ]
+        lengths = np.fromiter(
+            (len(encoded or b"") for encoded in self.encoded),
+            dtype=np.int64,
+            count=len(self.encoded),
+        )
+        buffer = np.frombuffer(
+            b"".join(encoded or b"" for encoded in self.encoded), dtype=np.uint8
+        ).astype(np.uint64)
+        owners = np.repeat(np.arange(len(self.encoded), dtype=np.uint64), lengths)
+        # Only keep trigrams that do not span two strings.
+        valid = owners[:-2] == owners[2:]
+        keys = (
+            (buffer[:-2] << np.uint64(48))
+            | (buffer[1:-1] << np.uint64(40))
+            | (buffer[2:] << np.uint64(32))
+            | owners[:-2]
+        )[valid]
+        keys.sort()
+        if len(keys):
+            keys = keys[np.concatenate([[True], keys[1:] != keys[:-1]])]
+        grams = keys >> np.uint64(32)
+        # There may be no trigrams at all (e.g., if every string is
+        # shorter than three bytes), in which case the index is empty.
+        starts = np.flatnonzero(
+            np.concatenate([[len(grams) > 0], grams[1:] != grams[:-1]])
+        )
+        self.grams = grams[starts]
+        self.offsets = np.append(starts, len(keys))
+        self.ids = (keys & np.uint64(0xFFFFFFFF)).astype(np.int64)
+
+    def add(self, text: typing.Optional[str]):
+        """Add a string, using the next available id."""
+        self.added.append(len(self.encoded))
+        self.encoded.append(text.encode("utf8") if text else None)
+
+    def posting(self, gram: bytes) -> "np.ndarray":
+        """Get the ids of the indexed strings that contain a trigram."""
+        value = int.from_bytes(gram, "big")
+        position = np.searchsorted(self.grams, value)
+        if position == len(self.grams) or self.grams[position] != value:
+            return self.ids[:0]
+        return self.ids[self.offsets[position] : self.offsets[position + 1]]
+
+    def search(self, query: str) -> "np.ndarray":
+        """Get a boolean mask of the strings that contain a query."""
+        encoded = query.encode("utf8")
+        mask = np.zeros(len(self.encoded), dtype=bool)
+        if len(encoded) >= 3:
+            postings = sorted(
+                (self.posting(encoded[i : i + 3]) for i in range(len(encoded) - 2)),
+                key=len,
+            )
+            mask[postings[0]] = True
+            for posting in postings[1:]:
+                if not mask.any():
+                    break
+                # Keep only the strings that contain every trigram.
+                contains = np.zeros(len(self.encoded), dtype=bool)
+                contains[posting] = True
+                mask &= contains
+            if len(postings) > 1:
+                # Containing every trigram does not guarantee
+                # containing the query, so check the candidates.
+                keys = np.flatnonzero(mask)
+                texts = typing.cast(typing.List[bytes], self.encoded)
+                mask[keys] = np.fromiter(
+                    (encoded in texts[key] for key in keys.tolist()),
+                    dtype=bool,
+                    count=len(keys),
+                )
+        else:
+            # Short queries can appear in any trigram that contains
+            # them (or in a string that is shorter than a trigram).
+            for position, gram in enumerate(self.grams.tolist()):
+                if encoded in gram.to_bytes(3, "big"):
+                    mask[
+                        self.ids[self.offsets[position] : self.offsets[position + 1]]
+                    ] = True
+            for key in self.short:
+                mask[key] = encoded in typing.cast(bytes, self.encoded[key])
+        for key in self.added:
+            mask[key] = encoded in (self.encoded[key] or b"")
+        return mask
+
+
+class Column:
+    """A dictionary-encoded media index column. Each row stores a code
+    referring to one of the distinct values in the column (or -1 for
+    missing values), so sorting and filtering only have to consider
+    each distinct value once."""
+
+    def __init__(self, values: typing.Iterable):
+        self.categories: typing.List[typing.Any] = []
+        self.lookup: typing.Dict[typing.Any, int] = {}
+        self.ranks: typing.Optional["np.ndarray"] = None
+        self.order: typing.Optional["np.ndarray"] = None
+        self.search: typing.Optional[SearchIndex] = None
+        self.codes = np.fromiter(
+            (self.encode(value) for value in values), dtype=np.int32
+        )
+
+    def encode(self, value) -> int:
+        """Get the code for a value, adding it to the categories if needed."""
+        if value is None:
+            return -1
+        key = value2key(value)
+        code = self.lookup.get(key)
+        if code is None:
+            code = self.lookup[key] = len(self.categories)
+            self.categories.append(value)
+            self.ranks = None
+            if self.search is not None:
+                self.search.add(str(value) if value else None)
+        return code
+
+    def set(self, idx: int, value):
+        """Change the value for a row."""
+        code = self.encode(value)
+        if self.codes[idx] != code:
+            self.codes[idx] = code
+            self.order = None
+
+    def get_ranks(self) -> "np.ndarray":
+        """Get the sort rank for each category, with an extra
+        entry at the end (for missing values) that sorts first."""
+        if self.ranks is None:
+            if all(is_number(value) for value in self.categories):
+                permutation = np.argsort(
+                    np.array(self.categories, dtype="float64"), kind="stable"
+                )
+            else:
+                permutation = np.array(
+                    sorted(
+                        range(len(self.categories)),
+                        key=(
+                            self.categories.__getitem__
+                            if all(isinstance(v, str) for v in self.categories)
+                            else lambda code: value2sortable(self.categories[code])
+                        ),
+                    ),
+                    dtype=np.int64,
+                )
+            ranks = np.empty(len(self.categories) + 1, dtype=np.int64)
+            ranks[permutation] = np.arange(len(self.categories))
+            ranks[-1] = -1
+            self.ranks = ranks
+            self.order = None
+        return self.ranks
+
+    def argsort(self) -> "np.ndarray":
+        """Get the row indexes in ascending order, with ties in row order."""
+        ranks = self.get_ranks()
+        if self.order is None:
+            self.order = np.argsort(ranks[self.codes], kind="stable")
+        return self.order
+
+    def sort_keys(self) -> typing.List["np.ndarray"]:
+        """Get arrays that sort the rows in ascending order (most significant
+        last, as for np.lexsort), with missing values first."""
+        return [self.get_ranks()[self.codes]]
+
+    def mask(self, predicate: typing.Callable[[typing.Any], bool]) -> "np.ndarray":
+        """Get a boolean mask of the rows whose value satisfies a predicate."""
+        table = np.array(
+            [bool(predicate(value)) for value in self.categories + [None]],
+            dtype=bool,
+        )
+        return table[self.codes]
+
+    def search_mask(self, text: str) -> "np.ndarray":
+        """Get a boolean mask of the rows whose value is set and
+        contains a string, using a search index over the categories."""
+        if self.search is None:
+            self.search = SearchIndex(
+                [str(value) if value else None for value in self.categories]
+            )
+        return np.append(self.search.search(text), False)[self.codes]
+
+
+class NumericColumn:
+    """A media index column in which every value is a number (or missing)."""
+
+    def __init__(self, values: typing.List[typing.Any]):
+        if all(value is not None and isinstance(value, int) for value in values):
+            self.values = np.array(values, dtype="int64")
+            self.missing = np.zeros(len(values), dtype=bool)
+        else:
+            self.values = np.array(
+                [np.nan if value is None else value for value in values],
+                dtype="float64",
+            )
+            self.missing = np.isnan(self.values)
+        self.order: typing.Optional["np.ndarray"] = None
+
+    def argsort(self) -> "np.ndarray":
+        """Get the row indexes in ascending order (with missing values
+        first), with ties in row order."""
+        if self.order is None:
+            present = np.flatnonzero(~self.missing)
+            self.order = np.concatenate(
+                [
+                    np.flatnonzero(self.missing),
+                    present[np.argsort(self.values[present], kind="stable")],
+                ]
+            )
+        return self.order
+
+    def sort_keys(self) -> typing.List["np.ndarray"]:
+        """Get arrays that sort the rows in ascending order (most significant
+        last, as for np.lexsort), with missing values first."""
+        return [
+            np.where(self.missing, 0, self.values),
+            (~self.missing).astype("int64"),
+        ]
+
+    def compare(self, operator: str, operand) -> "np.ndarray":
+        """Get a boolean mask of the rows whose value satisfies a
+        numeric comparison (see NUMERIC_OPERATORS) or range."""
+        if operator == "between":
+            low, high = operand
+            mask = ~self.missing
+            if low is not None:
+                mask &= self.values >= float(low)
+            if high is not None:
+                mask &= self.values <= float(high)
+            return mask
+        return ~self.missing & NUMERIC_OPERATORS[operator](self.values, float(operand))
+
+    def mask(self, predicate: typing.Callable[[typing.Any], bool]) -> "np.ndarray":
+        """Get a boolean mask of the rows whose value satisfies a predicate."""
+        distinct, codes = np.unique(self.values[~self.missing], return_inverse=True)
+        table = np.array([bool(predicate(value)) for value in distinct.tolist()])
+        mask = np.full(len(self.values), bool(predicate(None)))
+        if len(distinct):
+            mask[~self.missing] = table[codes]
+        return mask
+
+
+class MediaIndex:
+    """Columnar arrays for the media index columns, used to sort and
+    filter items using vectorized operations. Columns are built when
+    they are first used. The mutable columns (those derived from labels)
+    must be updated whenever items change."""
+
+    def __init__(
+        self,
+        items: typing.Sequence[dict],
+        getters: typing.Dict[str, typing.Callable[[dict], typing.Any]],
+        mutable: typing.Iterable[str],
+    ):
+        self.items = items
+        self.getters = getters
+        self.mutable = set(mutable)
+        self.columns: typing.Dict[str, typing.Union[Column, NumericColumn]] = {}
+
+    def get_getter(self, name: str) -> typing.Callable[[dict], typing.Any]:
+        """Get the function that extracts a column value from an item."""
+        if name in self.getters:
+            return self.getters[name]
+        return lambda item: item.get("metadata", {}).get(name)
+
+    def column(self, name: str) -> typing.Union[Column, NumericColumn]:
+        """Get a column, building it if necessary."""
+        if name not in self.columns:
+            LOGGER.debug("Building media index column %s.", name)
+            getter = self.get_getter(name)
+            values = [getter(item) for item in self.items]
+            self.columns[name] = (
+                NumericColumn(values)
+                if name not in self.mutable
+                and all(value is None or is_number(value) for value in values)
+                else Column(values)
+            )
+        return self.columns[name]
+
+    def update(self, idxs: typing.Iterable[int]):
+        """Refresh the mutable columns for items that have changed."""
+        for name in self.mutable.intersection(self.columns):
+            column = typing.cast(Column, self.columns[name])
+            getter = self.get_getter(name)
+            for idx in idxs:
+                column.set(idx, getter(self.items[idx]))
+
+    def sort(self, name: str, reverse: bool) -> "np.ndarray":
+        """Get item indexes sorted by a column. Ties are broken using
+        the item index (in descending order if reverse is True)."""
+        order = self.column(name).argsort()
+        return order[::-1] if reverse else order
+
+    def multisort(self, keys: typing.List[typing.Tuple[str, bool]]) -> "np.ndarray":
+        """Get item indexes sorted by several (name, reverse) column keys, in
+        order of precedence. Ties are broken using the item index (in the
+        direction of the first key)."""
+        if len(keys) == 1:
+            return self.sort(*keys[0])
+        arrays = []
+        for name, reverse in reversed(keys):
+            for array in self.column(name).sort_keys():
+                arrays.append(-array if reverse else array)
+        tiebreak = np.arange(len(self.items))
+        return np.lexsort([-tiebreak if keys[0][1] else tiebreak] + arrays)
+
+    def match(self, clause: dict) -> "np.ndarray":
+        """Get a boolean mask of the items that satisfy a filter clause."""
+        operator, operand = clause["operator"], clause["value"]
+        column = self.column(clause["field"])
+        if isinstance(column, Column) and operator == "contains":
+            return column.search_mask(str(operand))
+        if isinstance(column, NumericColumn) and (
+            operator in NUMERIC_OPERATORS or operator == "between"
+        ):
+            return column.compare(operator, operand)
+        return column.mask(lambda value: matches(value, operator, operand))
+
+    def evaluate(self, group: dict) -> "np.ndarray":
+        """Get a boolean mask of the items that satisfy a (parsed) filter."""
+        return evaluate_filter(
+            group,
+            self.match,
+            conjunction=np.logical_and.reduce,
+            disjunction=np.logical_or.reduce,
+        )
+
+
+class Ordering(collections.abc.Sequence):
+    """A sequence of item indexes (e.g., the sorted and filtered items)
+    together with its inverse permutation, so that the position of an
+    item in the sequence can be found in constant time."""
+
+    def __init__(self, idxs: typing.Iterable[int], length: int):
+        if np is None:
+            self.idxs: typing.Any = list(idxs)
+            self.positions: typing.Any = {
+                idx: position for position, idx in enumerate(self.idxs)
+            }
+            return
+        self.idxs = np.asarray(
+            idxs if isinstance(idxs, np.ndarray) else list(idxs), dtype=np.int64
+        )
+        self.positions = np.full(length, -1, dtype=np.int64)
+        self.positions[self.idxs] = np.arange(len(self.idxs))
+
+    def __len__(self):
+        return len(self.idxs)
+
+    def __getitem__(self, position):  # type: ignore[override]
+        if isinstance(position, slice):
+            return [int(idx) for idx in self.idxs[position]]
+        return int(self.idxs[position])
+
+    def __iter__(self):
+        return iter(self.idxs.tolist() if np is not None else self.idxs)
+
+    def __contains__(self, idx):
+        return self.position(idx) is not None
+
+    def position(self, idx: int) -> typing.Optional[int]:
+        """Get the position of an item, or None if it is not in the sequence."""
+        if np is None:
+            return self.positions.get(idx)
+        if not 0 <= idx < len(self.positions) or self.positions[idx] < 0:
+            return None
+        return int(self.positions[idx])
+
+    def index(self, value, start: int = 0, stop: int = sys.maxsize) -> int:
+        """Get the position of an item (between start and stop, if given),
+        raising ValueError if it is not in the sequence."""
+        position = self.position(value)
+        start, stop, _ = slice(start, stop).indices(len(self))
+        if position is None or not start <= position < stop:
+            raise ValueError(f"{value} is not in the sequence.")
+        return position
+
+
+class PositionSet:
+    """A set of positions in [0, length) (e.g., the positions of unlabeled
+    items in an Ordering), stored as a Fenwick tree over a membership
+    bitmap so that items can be added and removed and the next or
+    previous member can be found in logarithmic time."""
+
+    def __init__(self, mask: typing.Sequence[bool]):
+        self.length = len(mask)
+        self.members = bytearray(bool(m) for m in mask)
+        if np is not None:
+            # tree[i] holds the count for positions (i - lowbit(i), i].
+            counts = np.zeros(self.length + 1, dtype=np.int64)
+            counts[1:] = np.cumsum(np.frombuffer(self.members, dtype=np.uint8))
+            nodes = np.arange(self.length + 1)
+            tree = counts - counts[nodes - (nodes & -nodes)]
+            self.tree = tree.tolist()
+        else:
+            self.tree = [0] + list(self.members)
+            for node in range(1, self.length + 1):
+                parent = node + (node & -node)
+                if parent <= self.length:
+                    self.tree[parent] += self.tree[node]
+        self.size = sum(self.members)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, position):
+        return 0 <= position < self.length and bool(self.members[position])
+
+    def change(self, position: int, delta: int):
+        """Apply a change in membership count at a position."""
+        node = position + 1
+        while node <= self.length:
+            self.tree[node] += delta
+            node += node & -node
+        self.size += delta
+
+    def add(self, position: int):
+        """Add a position to the set."""
+        if not self.members[position]:
+            self.members[position] = 1
+            self.change(position, 1)
+
+    def discard(self, position: int):
+        """Remove a position from the set, if present."""
+        if self.members[position]:
+            self.members[position] = 0
+            self.change(position, -1)
+
+    def count(self, position: int) -> int:
+        """Count the members before a position."""
+        total = 0
+        node = min(max(position, 0), self.length)
+        while node > 0:
+            total += self.tree[node]
+            node -= node & -node
+        return total
+
+    def find(self, k: int) -> int:
+        """Get the position of the k-th (zero-indexed) member."""
+        node = 0
+        step = 1 << self.length.bit_length()
+        while step:
+            if node + step <= self.length and self.tree[node + step] <= k:
+                node += step
+                k -= self.tree[node]
+            step >>= 1
+        return node
+
+    def next(self, position: int) -> typing.Optional[int]:
+        """Get the first member at or after a position."""
+        k = self.count(position)
+        return self.find(k) if k < self.size else None
+
+    def prev(self, position: int) -> typing.Optional[int]:
+        """Get the last member at or before a position."""
+        k = self.count(position + 1)
+        return self.find(k - 1) if k > 0 else None
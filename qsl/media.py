@@ -0,0 +1,885 @@
+import os
+import base64
+import shutil
+import time
+import typing
+import hashlib
+import logging
+import pathlib
+import warnings
+import tempfile
+import threading
+import functools
+import collections
+import multiprocessing
+import urllib.parse as up
+import concurrent.futures
+
+import filetype
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # type: ignore
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None  # type: ignore
+
+from . import files, pyramid
+
+LOGGER = logging.getLogger(__name__)
+# URLs for media that is sent to the frontend as binary
+# buffers rather than served by the notebook server.
+MEDIA_SCHEME = "qsl-media:"
+# Sends media (identified by a key and loaded on demand as a
+# (data, mime type) pair) to the frontend and returns its URL.
+MediaSender = typing.Callable[[str, typing.Callable[[], typing.Tuple[bytes, str]]], str]
+
+
+def is_remote(target) -> bool:
+    """Check whether a target must be downloaded before it can be served."""
+    return isinstance(target, str) and target.lower().startswith("s3://")
+
+
+def file2bytes(filepath: str) -> typing.Tuple[bytes, str]:
+    """Read a file along with its mime type."""
+    kind = filetype.guess(filepath)
+    with open(filepath, "rb") as f:
+        return f.read(), kind.mime if kind else "application/octet-stream"
+
+
+# The extension, mime type and OpenCV quality flag for each format
+# in which arrays can be encoded.
+ARRAY_FORMATS = {
+    "png": (".png", "image/png", None),
+    "jpeg": (".jpg", "image/jpeg", "IMWRITE_JPEG_QUALITY"),
+    "webp": (".webp", "image/webp", "IMWRITE_WEBP_QUALITY"),
+}
+
+
+# pylint: disable=no-member
+class ArrayEncoder:
+    """Encodes image arrays for display as PNG, JPEG or WebP files (with
+    an optional quality from 0 to 100), downscaling arrays larger than
+    maxSize, if set. Encoding can run ahead of time on a pool of threads
+    (OpenCV releases the GIL while encoding) using submit, in which case
+    encode waits for the result instead of encoding again."""
+
+    # The number of encoded arrays to keep.
+    CACHE_SIZE = 64
+
+    def __init__(
+        self,
+        format="png",  # pylint: disable=redefined-builtin
+        quality: typing.Optional[int] = None,
+        maxSize: typing.Optional[int] = None,
+        concurrency=4,
+    ):
+        if format not in ARRAY_FORMATS:
+            raise ValueError(
+                f"Unsupported array format: {format}. Use one of {list(ARRAY_FORMATS)}."
+            )
+        self.format = format
+        self.quality = quality
+        self.maxSize = maxSize
+        self.concurrency = concurrency
+        self.pool: typing.Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self.lock = threading.Lock()
+        self.encoded: "collections.OrderedDict[str, concurrent.futures.Future]" = (
+            collections.OrderedDict()
+        )
+
+    @property
+    def extension(self) -> str:
+        """The file extension for encoded arrays."""
+        return ARRAY_FORMATS[self.format][0]
+
+    def digest(self, array: "np.ndarray") -> str:
+        """Get a deterministic key for an array as encoded by this encoder.
+        For the default settings, this is the same as array2digest."""
+        digest = array2digest(array)
+        if (self.format, self.quality, self.maxSize) == ("png", None, None):
+            return digest
+        return files.str2digest(digest, self.format, self.quality, self.maxSize)
+
+    def convert(self, array: "np.ndarray") -> typing.Tuple[bytes, str]:
+        """Encode an array, returning the data and its mime type."""
+        if cv2 is None:
+            raise ValueError("Labeling arrays requires OpenCV.")
+        height, width = array.shape[:2]
+        if self.maxSize and max(height, width) > self.maxSize:
+            scale = self.maxSize / max(height, width)
+            array = cv2.resize(
+                array,
+                (max(1, round(width * scale)), max(1, round(height * scale))),
+                interpolation=cv2.INTER_AREA,
+            )
+        extension, mime, flag = ARRAY_FORMATS[self.format]
+        params = (
+            [getattr(cv2, flag), int(self.quality)]
+            if flag and self.quality is not None
+            else []
+        )
+        return cv2.imencode(extension, array, params)[1].tobytes(), mime
+
+    def schedule(
+        self, array: "np.ndarray", digest: str, pool=None
+    ) -> concurrent.futures.Future:
+        """Get the future for an encoded array, starting the encoding (on
+        the pool, if provided, or immediately otherwise) if necessary."""
+        with self.lock:
+            future = self.encoded.get(digest)
+            if future is not None and not future.cancelled():
+                self.encoded.move_to_end(digest)
+                return future
+            if pool is None:
+                future = concurrent.futures.Future()
+            else:
+                future = pool.submit(self.convert, array)
+            self.encoded[digest] = future
+            while len(self.encoded) > self.CACHE_SIZE:
+                self.encoded.popitem(last=False)
+        if pool is None:
+            try:
+                future.set_result(self.convert(array))
+            except Exception as exception:  # pylint: disable=broad-exception-caught
+                future.set_exception(exception)
+        return future
+
+    def submit(self, arrays: typing.List[typing.Tuple["np.ndarray", str]]):
+        """Start encoding (array, digest) pairs in the background."""
+        if self.pool is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.concurrency, thread_name_prefix="qsl-encode"
+            )
+        for array, digest in arrays:
+            self.schedule(array, digest, pool=self.pool)
+
+    def encode(
+        self, array: "np.ndarray", digest: typing.Optional[str] = None
+    ) -> typing.Tuple[bytes, str]:
+        """Encode an array, returning the data and its mime type."""
+        return self.schedule(array, digest or self.digest(array)).result()
+
+    def close(self):
+        """Stop the encoding threads."""
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+
+def arr2str(image: "np.ndarray", encoder: typing.Optional[ArrayEncoder] = None):
+    """Given an image array, convert it to a base64 string."""
+    data, mime = (encoder or ArrayEncoder()).encode(image)
+    return files.BASE64_PATTERN.format(
+        type=mime,
+        data=base64.b64encode(data).decode("utf8"),
+    )
+
+
+class MediaCache:
+    """A content-addressed cache of media files on disk. Files are named
+    using a digest of their source (e.g., S3 URI and ETag), so the cache
+    can be reused across sessions and by multiple labelers at once. If
+    maxSize (in bytes) is set, the least recently used files are evicted."""
+
+    TEMP_PREFIX = ".tmp-"
+
+    def __init__(self, directory: str, maxSize: typing.Optional[int] = None):
+        self.directory = os.path.expanduser(directory)
+        self.maxSize = maxSize
+        self.lock = threading.Lock()
+        self.resolved: typing.Dict[str, str] = {}
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        os.makedirs(self.directory, exist_ok=True)
+        self.size = self.scan()[1] if maxSize else 0
+
+    def scan(self) -> typing.Tuple[typing.List[typing.Tuple[float, int, str]], int]:
+        """List the cached files as (last used, size, path) tuples and
+        compute their total size."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                # Another labeler evicted the file.
+                continue
+            if entry.name.startswith(self.TEMP_PREFIX):
+                if time.time() - stat.st_mtime > 3600:
+                    # Left over from an interrupted download or tiling.
+                    if entry.is_dir():
+                        shutil.rmtree(entry.path, ignore_errors=True)
+                    else:
+                        files.remove_if_exists(entry.path)
+                continue
+            if not entry.is_file():
+                continue
+            entries.append((stat.st_mtime, self.entry_size(entry.path), entry.path))
+        return entries, sum(size for _, size, _ in entries)
+
+    def entry_size(self, filepath: str) -> int:
+        """Get the size of a cached file, including the tiles
+        for a pyramid manifest."""
+        size = os.stat(filepath).st_size
+        if filepath.endswith(pyramid.SUFFIX):
+            size += (files.json_or_none(filepath) or {}).get("bytes", 0)
+        return size
+
+    def fetch(
+        self,
+        key: str,
+        extension: str,
+        fill: typing.Callable[[str], typing.Any],
+        source: typing.Optional[str] = None,
+    ) -> str:
+        """Get the path to a cached file, using fill (which receives a
+        temporary path with the same extension) to populate it on a miss.
+        If source is provided, the path is remembered for the session."""
+        filepath = os.path.join(self.directory, key + extension)
+        try:
+            # We use the modification time to track use because
+            # access times are often disabled.
+            os.utime(filepath)
+        except FileNotFoundError:
+            pass
+        else:
+            with self.lock:
+                self.stats["hits"] += 1
+            if source is not None:
+                self.resolved[source] = filepath
+            return filepath
+        with self.lock:
+            self.stats["misses"] += 1
+        fd, temppath = tempfile.mkstemp(
+            dir=self.directory, prefix=self.TEMP_PREFIX, suffix=extension
+        )
+        os.close(fd)
+        try:
+            fill(temppath)
+            files.match_mode(temppath, filepath)
+            os.replace(temppath, filepath)
+        except BaseException:
+            files.remove_if_exists(temppath)
+            raise
+        if source is not None:
+            self.resolved[source] = filepath
+        if self.maxSize:
+            with self.lock:
+                self.size += self.entry_size(filepath)
+            if self.size > self.maxSize:
+                self.evict(keep=filepath)
+        return filepath
+
+    def lookup(self, source: str) -> typing.Optional[str]:
+        """Get the cached path for a source that was fetched earlier
+        in this session, if it is still in the cache."""
+        filepath = self.resolved.get(source)
+        if filepath is None:
+            return None
+        if not os.path.isfile(filepath):
+            del self.resolved[source]
+            return None
+        with self.lock:
+            self.stats["hits"] += 1
+        return filepath
+
+    def evict(self, keep: typing.Optional[str] = None):
+        """Remove the least recently used files until the cache is under its maximum size."""
+        entries, size = self.scan()
+        for _, filesize, filepath in sorted(entries):
+            if not self.maxSize or size <= self.maxSize:
+                break
+            if filepath == keep:
+                continue
+            if filepath.endswith(pyramid.SUFFIX):
+                shutil.rmtree(pyramid.tile_directory(filepath), ignore_errors=True)
+            if files.remove_if_exists(filepath):
+                with self.lock:
+                    self.stats["evictions"] += 1
+            size -= filesize
+        with self.lock:
+            self.size = size
+
+
+class Prefetcher:
+    """Resolves media URLs on a pool of threads so that downloads
+    for upcoming items do not block navigation. Each call to schedule
+    replaces the current window, cancelling work that is no longer needed."""
+
+    def __init__(self, concurrency=4):
+        self.pool = concurrent.futures.ThreadPoolExecutor(
+            max_workers=concurrency, thread_name_prefix="qsl-prefetch"
+        )
+        self.lock = threading.Lock()
+        self.futures: typing.Dict[str, concurrent.futures.Future] = {}
+        self.stats = {"scheduled": 0, "cancelled": 0, "completed": 0, "errors": 0}
+
+    def schedule(
+        self,
+        jobs: typing.List[typing.Tuple[str, typing.Callable[[], typing.Optional[str]]]],
+    ):
+        """Start resolving the given (key, function) pairs, cancelling any
+        queued work for keys that are not in the new window."""
+        keys = set(key for key, _ in jobs)
+        with self.lock:
+            for key in list(self.futures):
+                if key in keys:
+                    continue
+                future = self.futures.pop(key)
+                # Downloads that have already started are allowed to
+                # finish so that they end up in the cache.
+                if future.cancel():
+                    self.stats["cancelled"] += 1
+            for key, func in jobs:
+                if key in self.futures:
+                    continue
+                future = self.pool.submit(func)
+                future.add_done_callback(self.record)
+                self.futures[key] = future
+                self.stats["scheduled"] += 1
+
+    def record(self, future: concurrent.futures.Future):
+        """Count (and log) the outcome of a completed prefetch."""
+        if future.cancelled():
+            return
+        exception = future.exception()
+        with self.lock:
+            self.stats["errors" if exception else "completed"] += 1
+        if exception:
+            LOGGER.warning("Failed to prefetch media: %s", exception)
+
+    def result(self, key: str, wait=False) -> typing.Optional[str]:
+        """Get the result of a prefetch, if it has completed successfully.
+        If wait is True, block until a pending prefetch completes."""
+        with self.lock:
+            future = self.futures.get(key)
+        if future is None or future.cancelled() or (not wait and not future.done()):
+            return None
+        if future.exception() is not None:
+            return None
+        return future.result()
+
+    def close(self):
+        """Cancel pending work and stop the pool."""
+        with self.lock:
+            self.futures.clear()
+        self.pool.shutdown(wait=False, cancel_futures=True)
+
+
+def array2digest(target: "np.ndarray") -> str:
+    """Compute a deterministic digest for an array. Contiguous arrays
+    are hashed in place, without copying their data."""
+    if not target.flags.c_contiguous:
+        target = np.ascontiguousarray(target)
+    return files.str2digest(
+        hashlib.blake2b(target.data.cast("B"), digest_size=16).hexdigest(),
+        target.shape,
+        target.dtype,
+    )
+
+
+def inline_url(
+    target: typing.Union[str, "np.ndarray"],
+    allow_base64=True,
+    sendMedia: typing.Optional[MediaSender] = None,
+    encoder: typing.Optional[ArrayEncoder] = None,
+) -> typing.Optional[str]:
+    """Get a URL for an array or local file that does not rely on the
+    notebook server. The media is sent using sendMedia, if provided, or
+    encoded as a base64 URL otherwise (for files, only if allow_base64)."""
+    if files.is_array(target):
+        array = typing.cast("np.ndarray", target)
+        arrayEncoder = encoder or ArrayEncoder()
+        digest = arrayEncoder.digest(array)
+        if sendMedia is not None:
+            return sendMedia(digest, lambda: arrayEncoder.encode(array, digest))
+        return arr2str(array, encoder=arrayEncoder)
+    filepath = typing.cast(str, target)
+    source = os.path.abspath(filepath)
+    if sendMedia is not None:
+        stat = os.stat(source)
+        return sendMedia(
+            files.str2digest(source, stat.st_mtime_ns, stat.st_size),
+            lambda: file2bytes(source),
+        )
+    return files.file2str(filepath) if allow_base64 else None
+
+
+def build_url(
+    target: typing.Union[str, "np.ndarray"],
+    base: dict,
+    get_cache: typing.Callable[[], typing.Optional[MediaCache]],
+    allow_base64=True,
+    basePath: typing.Optional[str] = None,
+    *,
+    sendMedia: typing.Optional[MediaSender] = None,
+    encoder: typing.Optional[ArrayEncoder] = None,
+    tileThreshold: typing.Optional[int] = None,
+    tileSize: int = 512,
+    thumbnailer: typing.Optional["ThumbnailGenerator"] = None,
+) -> typing.Optional[str]:
+    """Build a notebook file URL using notebook configuration and a filepath or URL.
+    If there is no notebook configuration, local files and arrays are sent using
+    sendMedia, if provided, or encoded as base64 URLs otherwise. Arrays are
+    encoded using encoder (PNG files by default). If tileThreshold is set,
+    served images whose width or height exceed it are replaced by the manifest
+    for a cached tile pyramid (see tile_if_large). If thumbnailer is set, served
+    images are replaced by their cached thumbnails."""
+    if target is None:
+        return None
+    missing_base = not base or not base.get("serverRoot") or not base.get("url")
+    tfilepath = None
+    if isinstance(target, str) and (
+        target.lower().startswith("http://")
+        or target.lower().startswith("https://")
+        or target.startswith("data:")
+    ):
+        return target
+    if files.is_array(target):
+        cache = get_cache()
+        if cache is None or missing_base:
+            return inline_url(
+                target, sendMedia=sendMedia if missing_base else None, encoder=encoder
+            )
+        array = typing.cast("np.ndarray", target)
+        arrayEncoder = encoder or ArrayEncoder()
+        digest = arrayEncoder.digest(array)
+        tfilepath = cache.fetch(
+            digest,
+            arrayEncoder.extension,
+            lambda path: pathlib.Path(path).write_bytes(
+                arrayEncoder.encode(array, digest)[0]
+            ),
+        )
+
+    if isinstance(target, str) and target.lower().startswith("s3://"):
+        s3 = files.get_s3()
+        cache = get_cache()
+        bucket, key = files.parse_s3_uri(target)
+        if cache is None or missing_base:
+            return s3.generate_presigned_url(
+                "get_object",
+                Params={"Bucket": bucket, "Key": key},
+                ExpiresIn=3600,
+            )
+        tfilepath = cache.lookup(target) or cache.fetch(
+            files.str2digest(
+                target, s3.head_object(Bucket=bucket, Key=key).get("ETag", "")
+            ),
+            os.path.splitext(key)[1],
+            lambda path: s3.download_file(Bucket=bucket, Key=key, Filename=path),
+            source=target,
+        )
+    if isinstance(target, str) and basePath:
+        target = os.path.join(basePath, target)
+    if isinstance(target, str) and os.path.isfile(target):
+        if missing_base:
+            return inline_url(target, allow_base64=allow_base64, sendMedia=sendMedia)
+        if (
+            ".." in files.get_relpath(target, os.path.expanduser(base["serverRoot"]))
+            and get_cache() is not None
+        ):
+            source = os.path.abspath(target)
+            stat = os.stat(source)
+            tfilepath = typing.cast(MediaCache, get_cache()).fetch(
+                files.str2digest(source, stat.st_mtime_ns, stat.st_size),
+                os.path.splitext(target)[1],
+                lambda path: shutil.copy(source, path),
+            )
+        else:
+            tfilepath = target
+    if tfilepath is not None:
+        if tileThreshold is not None:
+            tfilepath = tile_if_large(tfilepath, get_cache(), tileThreshold, tileSize)
+        if thumbnailer is not None and get_cache() is not None:
+            tfilepath = thumbnailer.thumbnail(
+                tfilepath, typing.cast(MediaCache, get_cache())
+            )
+        return up.urljoin(
+            base["url"],
+            os.path.join(
+                "files",
+                up.quote(
+                    files.get_relpath(tfilepath, os.path.expanduser(base["serverRoot"]))
+                ),
+            ),
+        )
+    raise ValueError(f"Failed to load file at target: {target}")
+
+
+def tile_if_large(
+    filepath: str,
+    cache: typing.Optional[MediaCache],
+    threshold: int,
+    tileSize: int = 512,
+) -> str:
+    """Get the path to the manifest for a tile pyramid of an image whose
+    width or height exceeds threshold, building the pyramid in the cache
+    if necessary. Other files (and all files, if there is no cache or the
+    pyramid cannot be built) are returned as is."""
+    dimensions = pyramid.image_dimensions(filepath)
+    if cache is None or dimensions is None or max(dimensions) <= threshold:
+        return filepath
+    source = os.path.abspath(filepath)
+    key = derived_digest(source, cache, tileSize)
+    try:
+        return cache.fetch(
+            key,
+            pyramid.SUFFIX,
+            lambda path: pyramid.build(
+                source,
+                path,
+                os.path.join(cache.directory, key + pyramid.TILE_DIRECTORY_SUFFIX),
+                tileSize=tileSize,
+            ),
+        )
+    except Exception as exception:  # pylint: disable=broad-exception-caught
+        # e.g., OpenCV cannot decode images above its pixel limit.
+        LOGGER.warning("Failed to tile %s, showing it as is: %s", filepath, exception)
+        return filepath
+
+
+def derived_digest(source: str, cache: MediaCache, *parts) -> str:
+    """Compute the cache key for a file derived from source (e.g., a
+    thumbnail) using the given settings."""
+    stat = os.stat(source)
+    # Files in the cache are named by their contents but their
+    # modification times change as they are used.
+    return files.str2digest(
+        source,
+        stat.st_size,
+        (
+            None
+            if os.path.dirname(source) == os.path.abspath(cache.directory)
+            else stat.st_mtime_ns
+        ),
+        *parts,
+    )
+
+
+def write_thumbnail(source: str, destination: str, size: int, quality: int = 85):
+    """Write a JPEG thumbnail of an image that fits within size x size
+    pixels. JPEG files are decoded at a reduced resolution, if possible."""
+    if cv2 is None:
+        raise ValueError("Generating thumbnails requires OpenCV.")
+    dimensions = pyramid.image_dimensions(source)
+    flag = cv2.IMREAD_COLOR
+    if dimensions is not None:
+        for factor, reduced in [
+            (8, cv2.IMREAD_REDUCED_COLOR_8),
+            (4, cv2.IMREAD_REDUCED_COLOR_4),
+            (2, cv2.IMREAD_REDUCED_COLOR_2),
+        ]:
+            if max(dimensions) >= factor * size:
+                flag = reduced
+                break
+    image = cv2.imread(source, flag)
+    if image is None:
+        raise ValueError(f"Failed to read image at {source}.")
+    height, width = image.shape[:2]
+    if max(height, width) > size:
+        scale = size / max(height, width)
+        image = cv2.resize(
+            image,
+            (max(1, round(width * scale)), max(1, round(height * scale))),
+            interpolation=cv2.INTER_AREA,
+        )
+    if not cv2.imwrite(destination, image, [cv2.IMWRITE_JPEG_QUALITY, quality]):
+        raise ValueError(f"Failed to write thumbnail to {destination}.")
+
+
+class ThumbnailGenerator:
+    """Renders JPEG thumbnails (fitting within size x size pixels) of image
+    files into a media cache. Decoding and resizing are CPU-bound, so they
+    run on a pool of processes, which is started when first needed."""
+
+    def __init__(self, size: int, quality=85, concurrency=4):
+        self.size = size
+        self.quality = quality
+        self.concurrency = concurrency
+        self.pool: typing.Optional[concurrent.futures.ProcessPoolExecutor] = None
+        self.lock = threading.Lock()
+
+    def render(self, source: str, destination: str):
+        """Write a thumbnail on the pool of processes, waiting for it."""
+        with self.lock:
+            if self.pool is None:
+                # Forking a process that runs threads is unsafe.
+                self.pool = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.concurrency,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            pool = self.pool
+        pool.submit(
+            write_thumbnail, source, destination, self.size, self.quality
+        ).result()
+
+    def thumbnail(self, filepath: str, cache: MediaCache) -> str:
+        """Get the path to the cached thumbnail for an image, rendering
+        it if necessary. Images that are already small enough (and files
+        that are not PNG, JPEG or TIFF images) are returned as is."""
+        dimensions = pyramid.image_dimensions(filepath)
+        if dimensions is None or max(dimensions) <= self.size:
+            return filepath
+        source = os.path.abspath(filepath)
+        return cache.fetch(
+            derived_digest(source, cache, "thumbnail", self.size, self.quality),
+            ".jpg",
+            lambda path: self.render(source, path),
+        )
+
+    def close(self):
+        """Stop the worker processes."""
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = None
+
+
+class MediaMixin:
+    """Builds the URLs for a labeler's targets, caching, prefetching,
+    encoding, tiling and rendering thumbnails for media as configured
+    (see common.BaseMediaLabeler)."""
+
+    base: typing.Any
+    basePath: typing.Optional[str]
+    batchSize: int
+    items: typing.Any
+    maxCanvasSize: int
+    targets: typing.List[typing.Any]
+    type: str
+    tempdir: typing.Optional["tempfile.TemporaryDirectory[str]"]
+    cacheDir: typing.Optional[str]
+    cacheSize: typing.Optional[int]
+    prefetchAhead: int
+    prefetchConcurrency: int
+    downscaleArrays: bool
+    tileThreshold: typing.Optional[int]
+    tileSize: int
+    _cache: typing.Optional[MediaCache]
+    _prefetcher: typing.Optional[Prefetcher]
+    _encoder: ArrayEncoder
+    _thumbnailer: typing.Optional[ThumbnailGenerator]
+    _thumbnailJobs: typing.Optional[Prefetcher]
+
+    @property
+    def maxPreload(self) -> int:
+        """Deprecated alias for prefetchAhead."""
+        warnings.warn(
+            "maxPreload has been deprecated. Use prefetchAhead instead.",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+        return self.prefetchAhead
+
+    @maxPreload.setter
+    def maxPreload(self, maxPreload: int):
+        warnings.warn(
+            "maxPreload has been deprecated. Use prefetchAhead instead.",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+        self.prefetchAhead = maxPreload
+
+    def get_media_cache(self) -> typing.Optional[MediaCache]:
+        """Get the cache for downloaded, copied and encoded media. Unless
+        cacheDir is set, it is a temporary directory in the server root."""
+        if self._cache is not None:
+            return self._cache
+        if self.cacheDir:
+            serverRoot = self.base and self.base.get("serverRoot")
+            if serverRoot and files.get_relpath(
+                self.cacheDir, os.path.expanduser(serverRoot)
+            ).startswith(".."):
+                LOGGER.warning(
+                    "cacheDir %s is outside the notebook server root %s, so "
+                    "cached media cannot be served.",
+                    self.cacheDir,
+                    serverRoot,
+                )
+            self._cache = MediaCache(self.cacheDir, maxSize=self.cacheSize)
+        elif self.base["serverRoot"] is not None:
+            self.tempdir = (
+                tempfile.TemporaryDirectory(  # pylint: disable=consider-using-with
+                    prefix="qsl-temp", dir=os.path.expanduser(self.base["serverRoot"])
+                )
+            )
+            self._cache = MediaCache(self.tempdir.name, maxSize=self.cacheSize)
+        return self._cache
+
+    def get_prefetcher(self) -> Prefetcher:
+        """Get the pool used to download upcoming media in the background."""
+        if self._prefetcher is None:
+            self._prefetcher = Prefetcher(concurrency=self.prefetchConcurrency)
+        return self._prefetcher
+
+    def get_array_encoder(self) -> ArrayEncoder:
+        """Get the encoder for array targets, which downscales them
+        to maxCanvasSize if downscaleArrays is set."""
+        self._encoder.maxSize = self.maxCanvasSize if self.downscaleArrays else None
+        return self._encoder
+
+    def get_temporary_directory(self):
+        cache = self.get_media_cache()
+        return cache.directory if cache is not None else None
+
+    def get_cache_stats(self) -> typing.Optional[dict]:
+        """Get hit, miss and eviction counts for the media cache."""
+        return dict(self._cache.stats) if self._cache is not None else None
+
+    def get_image_targets(self, idxs: typing.Iterable[int], count: int) -> list:
+        """Get the targets for up to count image items."""
+        targets: typing.List[typing.Any] = []
+        if count <= 0:
+            return targets
+        for idx in idxs:
+            item = self.items[idx]
+            if item.get("type", "image") != "image" or item.get("target") is None:
+                continue
+            targets.append(item["target"])
+            if len(targets) == count:
+                break
+        return targets
+
+    def build_url(self, target, allow_base64=True, tile=False):
+        """Build the URL for a target, waiting for (rather than repeating)
+        a download (or tiling) that is already being prefetched. If tile
+        is True, the target may be tiled (see is_tileable)."""
+        tiling = tile and self.is_tileable(target)
+        if self._prefetcher is not None and (is_remote(target) or tiling):
+            url = self._prefetcher.result(target, wait=True)
+            if url is not None:
+                return url
+        return build_url(
+            target,
+            base=self.base,
+            allow_base64=allow_base64,
+            get_cache=self.get_media_cache,
+            basePath=self.basePath,
+            sendMedia=self.get_media_sender(),
+            encoder=self.get_array_encoder(),
+            **(self.get_tile_settings(target) if tile else {}),
+        )
+
+    def uses_thumbnails(self) -> bool:
+        """Check whether batches of images are shown as thumbnails."""
+        return (
+            self._thumbnailer is not None
+            and self.batchSize > 1
+            and bool(self.base)
+            and bool(self.base.get("url"))
+            and bool(self.base.get("serverRoot"))
+        )
+
+    def schedule_thumbnails(self, targets: typing.List[typing.Any]) -> Prefetcher:
+        """Start building the thumbnail URLs for the given file (and S3)
+        targets in the background, cancelling any queued work for others."""
+        if self._thumbnailJobs is None:
+            self._thumbnailJobs = Prefetcher(
+                concurrency=typing.cast(
+                    ThumbnailGenerator, self._thumbnailer
+                ).concurrency
+            )
+        self._thumbnailJobs.schedule(
+            [
+                (
+                    target,
+                    functools.partial(
+                        build_url,
+                        target,
+                        base=self.base,
+                        allow_base64=False,
+                        get_cache=self.get_media_cache,
+                        basePath=self.basePath,
+                        thumbnailer=self._thumbnailer,
+                    ),
+                )
+                for target in targets
+                if isinstance(target, str)
+                and not target.lower().startswith(("http://", "https://", "data:"))
+            ]
+        )
+        return self._thumbnailJobs
+
+    def get_thumbnails(self) -> typing.List[typing.Optional[str]]:
+        """Get the thumbnail URLs for the current batch (where None means
+        the image itself is shown), rendering them concurrently."""
+        if self.type != "image" or not self.uses_thumbnails():
+            return []
+        targets = [t.get("target") for t in self.targets]
+        jobs = self.schedule_thumbnails(targets)
+        return [
+            jobs.result(target, wait=True) if isinstance(target, str) else None
+            for target in targets
+        ]
+
+    def is_tileable(self, target) -> bool:
+        """Check whether a target may be shown using a tile pyramid, which
+        is only done for file (or S3) targets when labeling one at a time."""
+        return (
+            self.tileThreshold is not None
+            and self.batchSize == 1
+            and isinstance(target, str)
+            and not target.lower().startswith(("http://", "https://", "data:"))
+        )
+
+    def get_tile_settings(self, target) -> dict:
+        """Get the tiling arguments for build_url."""
+        if not self.is_tileable(target):
+            return {}
+        return {"tileThreshold": self.tileThreshold, "tileSize": self.tileSize}
+
+    def get_media_sender(self) -> typing.Optional[MediaSender]:
+        """Get a function for sending media directly to the frontend, for
+        use when it cannot be served by the notebook server. By default,
+        media is sent as base64 URLs instead."""
+        return None
+
+    def has_media(self, key: str, extension: str) -> bool:
+        """Check whether encoded media is already available to the
+        frontend (i.e., in the media cache) without encoding it again."""
+        missing_base = (
+            not self.base or not self.base.get("serverRoot") or not self.base.get("url")
+        )
+        return (
+            not missing_base
+            and self._cache is not None
+            and os.path.isfile(os.path.join(self._cache.directory, key + extension))
+        )
+
+    def encode_arrays(self, targets: typing.Iterable[typing.Any]):
+        """Start encoding any array targets that are not already
+        available on the encoder's pool of threads."""
+        encoder = self.get_array_encoder()
+        pending = []
+        for target in targets:
+            if not files.is_array(target):
+                continue
+            digest = encoder.digest(target)
+            if not self.has_media(digest, encoder.extension):
+                pending.append((target, digest))
+        if len(pending) > 1:
+            encoder.submit(pending)
+
+    def close(self):
+        """Stop any background media work and release the
+        resources used for it."""
+        prefetcher = getattr(self, "_prefetcher", None)
+        if prefetcher is not None:
+            prefetcher.close()
+            self._prefetcher = None
+        encoder = getattr(self, "_encoder", None)
+        if encoder is not None:
+            encoder.close()
+        thumbnailJobs = getattr(self, "_thumbnailJobs", None)
+        if thumbnailJobs is not None:
+            thumbnailJobs.close()
+            self._thumbnailJobs = None
+        thumbnailer = getattr(self, "_thumbnailer", None)
+        if thumbnailer is not None:
+            thumbnailer.close()
+        parent = getattr(super(), "close", None)
+        if parent is not None:
+            parent()
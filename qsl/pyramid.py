@@ -0,0 +1,174 @@
+import os
+import json
+import math
+import shutil
+import struct
+import typing
+import tempfile
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None  # type: ignore
+try:
+    import pyvips
+except ImportError:
+    pyvips = None  # type: ignore
+
+# Pyramids are described by a manifest (named using this suffix) next to
+# a directory of tiles in the Deep Zoom layout, i.e., <level>/<col>_<row>.jpg
+# where level 0 is a single pixel and the last level is full resolution.
+SUFFIX = ".pyramid.json"
+TILE_DIRECTORY_SUFFIX = "_files"
+# JPEG start of frame markers, which hold the image dimensions.
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+def image_dimensions(filepath: str) -> typing.Optional[typing.Tuple[int, int]]:
+    """Read the (width, height) of a PNG, JPEG or TIFF image from
+    its header, without decoding it. Returns None for other files."""
+    with open(filepath, "rb") as f:
+        head = f.read(24)
+        if head[:8] == b"\x89PNG\r\n\x1a\n" and len(head) == 24:
+            return typing.cast(typing.Tuple[int, int], struct.unpack(">II", head[16:]))
+        if head[:2] == b"\xff\xd8":
+            f.seek(2)
+            while True:
+                marker = f.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                if marker[1] in JPEG_SOF_MARKERS:
+                    height, width = struct.unpack(">3xHH", f.read(7))
+                    return width, height
+                (length,) = struct.unpack(">H", f.read(2))
+                f.seek(length - 2, 1)
+        if head[:4] in (b"II*\0", b"MM\0*"):
+            endian = "<" if head[:2] == b"II" else ">"
+            f.seek(struct.unpack(endian + "I", head[4:8])[0])
+            (count,) = struct.unpack(endian + "H", f.read(2))
+            dimensions = {}
+            for _ in range(count):
+                tag, kind, _, value = struct.unpack(endian + "HHI4s", f.read(12))
+                if tag in (256, 257):
+                    dimensions[tag] = struct.unpack(
+                        endian + ("H" if kind == 3 else "I"),
+                        value[:2] if kind == 3 else value,
+                    )[0]
+            if len(dimensions) == 2:
+                return dimensions[256], dimensions[257]
+    return None
+
+
+def tile_directory(manifest: str) -> str:
+    """Get the tile directory for a pyramid manifest."""
+    return manifest[: -len(SUFFIX)] + TILE_DIRECTORY_SUFFIX
+
+
+def directory_size(directory: str) -> int:
+    """Get the total size of the files in a directory."""
+    return sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(directory)
+        for name in names
+    )
+
+
+# pylint: disable=no-member
+def write_tiles_opencv(
+    source: str, directory: str, tileSize: int, quality: int
+) -> typing.Tuple[int, int]:
+    """Write the tiles for every level of a pyramid, halving the image
+    in memory for each level, and return the (width, height) of the
+    image. The full image must fit in memory."""
+    if cv2 is None:
+        raise ValueError("Tiling images requires OpenCV.")
+    image = cv2.imread(source, cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Failed to read image at {source}.")
+    dimensions = (image.shape[1], image.shape[0])
+    level = math.ceil(math.log2(max(dimensions)))
+    while True:
+        os.makedirs(os.path.join(directory, str(level)))
+        height, width = image.shape[:2]
+        for row in range(math.ceil(height / tileSize)):
+            for col in range(math.ceil(width / tileSize)):
+                cv2.imwrite(
+                    os.path.join(directory, str(level), f"{col}_{row}.jpg"),
+                    image[
+                        row * tileSize : (row + 1) * tileSize,
+                        col * tileSize : (col + 1) * tileSize,
+                    ],
+                    [cv2.IMWRITE_JPEG_QUALITY, quality],
+                )
+        if level == 0:
+            return dimensions
+        level -= 1
+        image = cv2.resize(
+            image,
+            (math.ceil(width / 2), math.ceil(height / 2)),
+            interpolation=cv2.INTER_AREA,
+        )
+
+
+def write_tiles_vips(
+    source: str, directory: str, tileSize: int, quality: int
+) -> typing.Tuple[int, int]:
+    """Write the tiles for a pyramid using libvips, which streams the
+    image rather than reading it into memory, and return the (width,
+    height) of the image."""
+    image = pyvips.Image.new_from_file(source, access="sequential")
+    if image.format != "uchar":
+        image = image.scaleimage()
+    base = directory[: -len(TILE_DIRECTORY_SUFFIX)]
+    image.dzsave(
+        base,
+        tile_size=tileSize,
+        overlap=0,
+        depth="onepixel",
+        suffix=f".jpg[Q={quality}]",
+    )
+    for extra in [base + ".dzi", os.path.join(directory, "vips-properties.xml")]:
+        if os.path.isfile(extra):
+            os.remove(extra)
+    return image.width, image.height
+
+
+def build(source: str, manifest: str, directory: str, tileSize=512, quality=90) -> dict:
+    """Build a tile pyramid for an image, writing its tiles to directory
+    and its manifest to the given path, and return the manifest contents.
+    The tile directory is referenced relative to the manifest, so they
+    should be in the same directory. libvips is used, if it is
+    installed, and OpenCV otherwise."""
+    staging = tempfile.mkdtemp(
+        dir=os.path.dirname(os.path.abspath(directory)), prefix=".tmp-"
+    )
+    try:
+        tiles = os.path.join(staging, "tiles" + TILE_DIRECTORY_SUFFIX)
+        width, height = (
+            write_tiles_vips if pyvips is not None else write_tiles_opencv
+        )(source, tiles, tileSize, quality)
+        size = directory_size(tiles)
+        if os.path.isdir(directory):
+            # Another labeler built the same pyramid.
+            shutil.rmtree(tiles)
+        else:
+            os.replace(tiles, directory)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    maxLevel = math.ceil(math.log2(max(width, height)))
+    # The largest level that fits in a single tile serves as an overview.
+    overview = maxLevel - max(0, math.ceil(math.log2(max(width, height) / tileSize)))
+    name = os.path.basename(directory)
+    contents = {
+        "width": width,
+        "height": height,
+        "tileSize": tileSize,
+        "maxLevel": maxLevel,
+        "tiles": name,
+        "extension": ".jpg",
+        "overview": f"{name}/{overview}/0_0.jpg",
+        "bytes": size,
+    }
+    with open(manifest, "w", encoding="utf8") as f:
+        json.dump(contents, f)
+    return contents
@@ -0,0 +1,432 @@
+import typing
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # type: ignore
+
+# Masks are run-length encoded in row-major order as alternating
+# runs of foreground and background pixels, starting with foreground
+# (which may be an empty run). Decoded masks use 255 for foreground.
+FOREGROUND = 255
+# The default number of pixels to process at a time. Working on
+# cache-sized chunks is faster than processing large masks at once.
+CHUNK_SIZE = 1 << 18
+
+
+def run_values(length: int) -> "np.ndarray":
+    """Get the pixel value for each of a sequence of runs."""
+    values = np.zeros(length, dtype="uint8")
+    values[::2] = FOREGROUND
+    return values
+
+
+def decode_into(
+    counts: typing.Sequence[int],
+    flat: "np.ndarray",
+    chunkSize: typing.Optional[int] = None,
+):
+    """Decode RLE counts into a flat (one-dimensional) uint8 array,
+    expanding at most chunkSize pixels at a time."""
+    runs = np.asarray(counts, dtype="int64")
+    ends = np.cumsum(runs)
+    if runs.size == 0 or ends[-1] != flat.size:
+        raise ValueError(
+            f"The counts cover {ends[-1] if runs.size else 0} pixels but the mask has {flat.size}."
+        )
+    values = run_values(len(runs))
+    step = chunkSize or CHUNK_SIZE
+    for start in range(0, flat.size, step):
+        stop = min(start + step, flat.size)
+        # The runs that contain the first and last pixels in the chunk.
+        first = np.searchsorted(ends, start, side="right")
+        last = np.searchsorted(ends, stop - 1, side="right") + 1
+        lengths = np.minimum(ends[first:last], stop) - np.maximum(
+            ends[first:last] - runs[first:last], start
+        )
+        flat[start:stop] = np.repeat(values[first:last], lengths)
+
+
+def decode(
+    counts: typing.Sequence[int],
+    dimensions: typing.Dict,
+    chunkSize: typing.Optional[int] = None,
+) -> "np.ndarray":
+    """Decode RLE counts into a (height, width) uint8 bitmap."""
+    bitmap = np.empty((dimensions["height"], dimensions["width"]), dtype="uint8")
+    decode_into(counts, bitmap.reshape(-1), chunkSize=chunkSize)
+    return bitmap
+
+
+def decode_batch(
+    masks: typing.Sequence[typing.Dict],
+    out: typing.Optional["np.ndarray"] = None,
+    chunkSize: typing.Optional[int] = None,
+) -> "np.ndarray":
+    """Decode several masks with the same dimensions into an (n, height,
+    width) uint8 stack, which may be preallocated and passed as out."""
+    if not masks:
+        raise ValueError("At least one mask is required.")
+    dimensions = masks[0]["dimensions"]
+    shape = (len(masks), dimensions["height"], dimensions["width"])
+    if any(mask["dimensions"] != dimensions for mask in masks):
+        raise ValueError("All masks in a batch must have the same dimensions.")
+    if out is None:
+        out = np.empty(shape, dtype="uint8")
+    elif out.shape != shape or out.dtype != np.uint8 or not out.flags.c_contiguous:
+        raise ValueError(f"out must be a contiguous uint8 array of shape {shape}.")
+    for mask, bitmap in zip(masks, out):
+        decode_into(mask["counts"], bitmap.reshape(-1), chunkSize=chunkSize)
+    return out
+
+
+def changes(flat: "np.ndarray", chunkSize: typing.Optional[int] = None) -> "np.ndarray":
+    """Get the positions in a flat array at which the value changes
+    between zero and nonzero, looking at chunkSize pixels at a time."""
+    step = chunkSize or CHUNK_SIZE
+    found = []
+    for start in range(0, max(flat.size - 1, 0), step):
+        # Overlap chunks by one pixel to catch changes at their borders.
+        foreground = flat[start : start + step + 1] != 0
+        found.append(np.flatnonzero(foreground[1:] != foreground[:-1]) + start + 1)
+    return np.concatenate(found) if found else np.zeros(0, dtype="int64")
+
+
+def positions2counts(
+    positions: "np.ndarray", size: int, foreground: bool
+) -> typing.List[int]:
+    """Convert the positions of changes in a flat mask into RLE counts."""
+    counts = np.diff(positions, prepend=0, append=size).tolist()
+    if not foreground:
+        counts.insert(0, 0)
+    if len(counts) == 1:
+        # Always include the (empty) background run.
+        counts.append(0)
+    return counts
+
+
+def encode(bitmap: "np.ndarray", chunkSize: typing.Optional[int] = None) -> typing.Dict:
+    """Encode a (height, width) bitmap, in which any nonzero value is
+    foreground, as RLE counts."""
+    flat = bitmap.reshape(-1)
+    return {
+        "dimensions": {"width": bitmap.shape[1], "height": bitmap.shape[0]},
+        "counts": positions2counts(
+            changes(flat, chunkSize=chunkSize), flat.size, bool(flat[0])
+        ),
+    }
+
+
+def encode_batch(bitmaps: "np.ndarray") -> typing.List[typing.Dict]:
+    """Encode an (n, height, width) stack of bitmaps as RLE counts,
+    finding the runs for the entire stack at once."""
+    bitmaps = np.asarray(bitmaps)
+    n, height, width = bitmaps.shape
+    size = height * width
+    flat = bitmaps.reshape(-1)
+    positions = changes(flat)
+    # Changes at the first pixel of a mask belong to no mask.
+    starts = np.arange(n + 1) * size
+    lower = np.searchsorted(positions, starts[:-1], side="right")
+    upper = np.searchsorted(positions, starts[1:], side="left")
+    return [
+        {
+            "dimensions": {"width": width, "height": height},
+            "counts": positions2counts(
+                positions[lower[i] : upper[i]] - starts[i], size, bool(flat[starts[i]])
+            ),
+        }
+        for i in range(n)
+    ]
+
+
+# The operations below work directly on the runs of a mask, so their
+# cost depends on the number of runs rather than the number of pixels.
+
+
+def check_dimensions(masks: typing.Sequence[typing.Dict]) -> typing.Dict:
+    """Get the dimensions shared by a set of masks."""
+    dimensions = masks[0]["dimensions"]
+    if any(mask["dimensions"] != dimensions for mask in masks):
+        raise ValueError("All masks must have the same dimensions.")
+    return dimensions
+
+
+def intervals(mask: typing.Dict) -> typing.Tuple["np.ndarray", "np.ndarray"]:
+    """Get the flat start and (exclusive) end positions of the
+    foreground runs in a mask."""
+    counts = np.asarray(mask["counts"], dtype="int64")
+    ends = np.cumsum(counts)[::2]
+    lengths = counts[::2]
+    nonempty = lengths > 0
+    return (ends - lengths)[nonempty], ends[nonempty]
+
+
+def segments(
+    spans: typing.Sequence[typing.Tuple["np.ndarray", "np.ndarray"]],
+    weights: typing.Sequence[int],
+) -> typing.Tuple["np.ndarray", "np.ndarray"]:
+    """Split the flat positions covered by several sets of intervals into
+    segments. Returns the start of each segment (each one ends where the
+    next one begins) and the sum of the weights of the intervals that
+    cover it. Positions before the first segment are not covered."""
+    positions = np.concatenate([array for span in spans for array in span])
+    deltas = np.concatenate(
+        [
+            np.repeat([weight, -weight], [len(starts), len(ends)])
+            for (starts, ends), weight in zip(spans, weights)
+        ]
+    )
+    order = np.argsort(positions, kind="stable")
+    positions = positions[order]
+    depths = np.cumsum(deltas[order])
+    # Keep the depth after the last event at each position.
+    last = np.append(positions[1:] != positions[:-1], True)[: len(positions)]
+    return positions[last], depths[last]
+
+
+def spans2mask(
+    spans: typing.Sequence[typing.Tuple["np.ndarray", "np.ndarray"]],
+    weights: typing.Sequence[int],
+    predicate: typing.Callable[["np.ndarray"], "np.ndarray"],
+    dimensions: typing.Dict,
+) -> typing.Dict:
+    """Build a mask from the segments (see segments) of several sets
+    of intervals whose summed weight satisfies a predicate."""
+    size = dimensions["width"] * dimensions["height"]
+    points, depths = segments(spans, weights)
+    selected = predicate(depths)
+    flips = points[np.diff(selected.astype("int8"), prepend=0) != 0]
+    flips = flips[flips < size]
+    foreground = bool(len(flips)) and flips[0] == 0
+    return {
+        "dimensions": dict(dimensions),
+        "counts": positions2counts(
+            flips[1:] if foreground else flips, size, foreground
+        ),
+    }
+
+
+def select(
+    masks: typing.Sequence[typing.Dict],
+    weights: typing.Sequence[int],
+    predicate: typing.Callable[["np.ndarray"], "np.ndarray"],
+) -> typing.Dict:
+    """Build a mask from the pixels where the summed weight
+    of the masks that cover them satisfies a predicate."""
+    return spans2mask(
+        [intervals(mask) for mask in masks],
+        weights,
+        predicate,
+        check_dimensions(masks),
+    )
+
+
+def group_offsets(lengths: "np.ndarray") -> "np.ndarray":
+    """Get the offset of each element within its group when groups
+    with the given lengths are laid out one after another."""
+    return np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+
+def area(mask: typing.Dict) -> int:
+    """Get the number of foreground pixels in a mask."""
+    return int(np.asarray(mask["counts"], dtype="int64")[::2].sum())
+
+
+def bbox(mask: typing.Dict) -> typing.Optional[typing.Tuple[int, int, int, int]]:
+    """Get the (x, y, width, height) bounding box of the foreground
+    pixels in a mask, or None if the mask is empty."""
+    starts, ends = intervals(mask)
+    if starts.size == 0:
+        return None
+    width = mask["dimensions"]["width"]
+    first, last = starts // width, (ends - 1) // width
+    # Runs that wrap onto another row touch both the left and right edges.
+    wraps = last > first
+    x1 = int(np.where(wraps, 0, starts % width).min())
+    x2 = int(np.where(wraps, width - 1, (ends - 1) % width).max())
+    y1, y2 = int(first.min()), int(last.max())
+    return (x1, y1, x2 - x1 + 1, y2 - y1 + 1)
+
+
+def merge(masks: typing.Sequence[typing.Dict]) -> typing.Dict:
+    """Get the union of several masks."""
+    return select(masks, [1] * len(masks), lambda depths: depths > 0)
+
+
+def intersect(masks: typing.Sequence[typing.Dict]) -> typing.Dict:
+    """Get the intersection of several masks."""
+    return select(masks, [1] * len(masks), lambda depths: depths == len(masks))
+
+
+def subtract(mask: typing.Dict, other: typing.Dict) -> typing.Dict:
+    """Remove the foreground pixels of another mask from a mask."""
+    return select([mask, other], [1, 2], lambda depths: depths == 1)
+
+
+def intersection_area(mask: typing.Dict, other: typing.Dict) -> int:
+    """Get the number of foreground pixels that two masks share."""
+    dimensions = check_dimensions([mask, other])
+    points, depths = segments([intervals(mask), intervals(other)], [1, 1])
+    lengths = np.diff(points, append=dimensions["width"] * dimensions["height"])
+    return int(lengths[depths == 2].sum())
+
+
+def boxes_overlap(
+    box: typing.Tuple[int, int, int, int], other: typing.Tuple[int, int, int, int]
+) -> bool:
+    """Check whether two (x, y, width, height) bounding boxes overlap."""
+    return (
+        box[0] < other[0] + other[2]
+        and other[0] < box[0] + box[2]
+        and box[1] < other[1] + other[3]
+        and other[1] < box[1] + box[3]
+    )
+
+
+def iou_matrix(
+    masks: typing.Sequence[typing.Dict], others: typing.Sequence[typing.Dict]
+) -> "np.ndarray":
+    """Get the intersection over union between each pair of masks in
+    two sets (e.g., labels and predictions) as a (len(masks), len(others))
+    array. Pairs whose bounding boxes do not overlap are skipped."""
+    ious = np.zeros((len(masks), len(others)), dtype="float64")
+    if len(masks) == 0 or len(others) == 0:
+        return ious
+    check_dimensions(list(masks) + list(others))
+    areas = [area(mask) for mask in masks]
+    otherAreas = [area(other) for other in others]
+    boxes = [bbox(mask) for mask in masks]
+    otherBoxes = [bbox(other) for other in others]
+    for i, (mask, box) in enumerate(zip(masks, boxes)):
+        for j, (other, otherBox) in enumerate(zip(others, otherBoxes)):
+            if box is None or otherBox is None or not boxes_overlap(box, otherBox):
+                continue
+            shared = intersection_area(mask, other)
+            ious[i, j] = shared / (areas[i] + otherAreas[j] - shared)
+    return ious
+
+
+def resize(mask: typing.Dict, dimensions: typing.Dict) -> typing.Dict:
+    """Resize a mask to new dimensions using nearest-neighbor sampling."""
+    width, height = mask["dimensions"]["width"], mask["dimensions"]["height"]
+    newWidth, newHeight = dimensions["width"], dimensions["height"]
+    starts, ends = intervals(mask)
+    # Split runs into pieces that each lie within a single row.
+    first, last = starts // width, (ends - 1) // width
+    pieces = np.repeat(np.arange(len(starts)), last - first + 1)
+    rows = first[pieces] + group_offsets(last - first + 1)
+    x1 = np.where(rows == first[pieces], starts[pieces] % width, 0)
+    x2 = np.where(rows == last[pieces], (ends[pieces] - 1) % width + 1, width)
+    # The source row and column sampled for each row and column of the result.
+    sourceRows = ((np.arange(newHeight) + 0.5) * height / newHeight).astype("int64")
+    sourceCols = ((np.arange(newWidth) + 0.5) * width / newWidth).astype("int64")
+    # Copy each piece to every row of the result that samples its row.
+    lower = np.searchsorted(sourceRows, rows, side="left")
+    copies = np.searchsorted(sourceRows, rows, side="right") - lower
+    copied = np.repeat(np.arange(len(rows)), copies)
+    offsets = (np.repeat(lower, copies) + group_offsets(copies)) * newWidth
+    newX1 = np.searchsorted(sourceCols, x1[copied], side="left")
+    newX2 = np.searchsorted(sourceCols, x2[copied], side="left")
+    nonempty = newX2 > newX1
+    return spans2mask(
+        [(offsets[nonempty] + newX1[nonempty], offsets[nonempty] + newX2[nonempty])],
+        [1],
+        lambda depths: depths > 0,
+        {"width": newWidth, "height": newHeight},
+    )
+
+
+def counts2string(counts: typing.Sequence[int]) -> str:
+    """Encode RLE counts as a compact string using the LEB128-style scheme
+    from the COCO API. Each count (from the fourth on) is stored as the
+    difference from the count two places before it, split into 5-bit
+    groups with a continuation bit and offset into printable characters."""
+    original = np.asarray(counts, dtype="int64")
+    values = original.copy()
+    values[3:] -= original[1:-2]
+    # The number of 5-bit (two's complement) groups needed for each value.
+    lengths = np.ones(len(values), dtype="int64")
+    for groups in range(1, 13):
+        limit = 1 << (5 * groups - 1)
+        lengths += (values >= limit) | (values < -limit)
+    owners = np.repeat(np.arange(len(values)), lengths)
+    positions = group_offsets(lengths)
+    chars = (values[owners] >> (5 * positions)) & 0x1F
+    chars |= (positions < lengths[owners] - 1) << 5
+    return (chars + 48).astype("uint8").tobytes().decode("ascii")
+
+
+def string2counts(string: str) -> typing.List[int]:
+    """Decode RLE counts from a string created by counts2string."""
+    chars = np.frombuffer(string.encode("ascii"), dtype="uint8").astype("int64") - 48
+    if len(chars) and chars[-1] & 0x20:
+        raise ValueError("The RLE string ends in the middle of a count.")
+    ends = np.flatnonzero((chars & 0x20) == 0) + 1
+    starts = ends - np.diff(ends, prepend=0)
+    lengths = ends - starts
+    values = (
+        np.add.reduceat((chars & 0x1F) << (5 * group_offsets(lengths)), starts)
+        if len(chars)
+        else np.zeros(0, dtype="int64")
+    )
+    # Extend the sign of negative values.
+    negative = (chars[ends - 1] & 0x10) != 0
+    values[negative] -= np.left_shift(1, 5 * lengths[negative])
+    values[1::2] = np.cumsum(values[1::2])
+    values[2::2] = np.cumsum(values[2::2])
+    return values.tolist()
+
+
+def convert_labels(labels, convert: typing.Callable[[typing.Any], typing.Any]):
+    """Apply a function to the counts of every mask in a set of image labels
+    or video frame labels, copying only the parts that contain masks."""
+    if isinstance(labels, list):
+        return [
+            (
+                {**frame, "labels": convert_labels(frame["labels"], convert)}
+                if isinstance(frame, dict) and isinstance(frame.get("labels"), dict)
+                else frame
+            )
+            for frame in labels
+        ]
+    if isinstance(labels, dict) and labels.get("masks"):
+        return {
+            **labels,
+            "masks": [
+                {**mask, "counts": convert(mask["counts"])} for mask in labels["masks"]
+            ],
+        }
+    return labels
+
+
+def compact_counts(counts):
+    """Get the string form of mask counts."""
+    return counts2string(counts) if isinstance(counts, list) else counts
+
+
+def expand_counts(counts):
+    """Get the list form of mask counts."""
+    return string2counts(counts) if isinstance(counts, str) else counts
+
+
+def convert_item(item: dict, convert: typing.Callable[[typing.Any], typing.Any]):
+    """Convert the mask counts in an item's labels and defaults, returning
+    the item itself if it has none."""
+    changed = {
+        key: convert_labels(item[key], convert)
+        for key in ("labels", "defaults")
+        if item.get(key)
+    }
+    changed = {key: value for key, value in changed.items() if value is not item[key]}
+    return {**item, **changed} if changed else item
+
+
+def compact_item(item: dict) -> dict:
+    """Get an item with its mask counts stored as strings."""
+    return convert_item(item, compact_counts)
+
+
+def expand_item(item: dict) -> dict:
+    """Get an item with its mask counts stored as lists of integers."""
+    return convert_item(item, expand_counts)
@@ -0,0 +1,122 @@
+import typing
+import collections
+
+REGION_TYPES = ("boxes", "polygons", "masks")
+
+# A summary of an item's contribution to the statistics, of the
+# form (labeled, ignored, image-level labels, region counts).
+Summary = typing.Tuple[
+    bool,
+    bool,
+    typing.Tuple[typing.Tuple[str, str], ...],
+    typing.Tuple[typing.Tuple[str, int], ...],
+]
+EMPTY: Summary = (False, False, (), ())
+# Items whose labels have not been read yet (i.e., when using lazyLoad)
+# are only known to be labeled.
+UNLOADED: Summary = (True, False, (), ())
+
+
+def summarize(item: dict) -> Summary:
+    """Summarize the labels for an item."""
+    labels = item.get("labels")
+    ignored = bool(item.get("ignore", False))
+    if labels is None:
+        return (True, True, (), ()) if ignored else EMPTY
+    # Video labels are a list of frames, each with image-style labels.
+    frames = (
+        [frame.get("labels") or {} for frame in labels]
+        if isinstance(labels, list)
+        else [labels] if isinstance(labels, dict) else []
+    )
+    classes: typing.List[typing.Tuple[str, str]] = []
+    regions: typing.Counter[str] = collections.Counter()
+    for frame in frames:
+        for name, values in (frame.get("image") or {}).items():
+            classes.extend((name, str(value)) for value in values or [])
+        for region in REGION_TYPES:
+            regions[region] += len(frame.get(region) or [])
+    return (
+        True,
+        ignored,
+        tuple(classes),
+        tuple((region, count) for region, count in regions.items() if count),
+    )
+
+
+class LabelStats:
+    """Counts of labeled and ignored items, image-level label classes and
+    regions, maintained incrementally as items change. The metadata schema
+    (whether each metadata column is numeric) is computed once and cached."""
+
+    def __init__(
+        self,
+        items: typing.Sequence[dict],
+        unloaded: typing.Optional[typing.Set[int]] = None,
+    ):
+        self.items = items
+        self.labeled = 0
+        self.ignored = 0
+        self.classes: typing.Dict[str, typing.Counter[str]] = collections.defaultdict(
+            collections.Counter
+        )
+        self.regions: typing.Counter[str] = collections.Counter()
+        self.schema: typing.Optional[typing.Dict[str, str]] = None
+        unloaded = unloaded or set()
+        self.summaries = [
+            UNLOADED if idx in unloaded else summarize(item)
+            for idx, item in enumerate(items)
+        ]
+        for summary in self.summaries:
+            self.apply(summary, 1)
+
+    def apply(self, summary: Summary, sign: int):
+        """Add (sign=1) or remove (sign=-1) an item's contribution."""
+        if summary is EMPTY:
+            return
+        labeled, ignored, classes, regions = summary
+        self.labeled += sign * labeled
+        self.ignored += sign * ignored
+        for name, value in classes:
+            self.classes[name][value] += sign
+        for region, count in regions:
+            self.regions[region] += sign * count
+
+    def update(self, idxs: typing.Iterable[int]):
+        """Refresh the statistics for items that have changed."""
+        for idx in idxs:
+            summary = summarize(self.items[idx])
+            if summary != self.summaries[idx]:
+                self.apply(self.summaries[idx], -1)
+                self.apply(summary, 1)
+                self.summaries[idx] = summary
+
+    def get_schema(self) -> typing.Dict[str, str]:
+        """Get the type ("number" or "string") of each metadata column.
+        A column is numeric if all of its values are numbers."""
+        if self.schema is None:
+            schema: typing.Dict[str, str] = {}
+            for item in self.items:
+                for key, value in item.get("metadata", {}).items():
+                    if schema.get(key) != "string":
+                        schema[key] = (
+                            "number" if isinstance(value, (float, int)) else "string"
+                        )
+            self.schema = schema
+        return self.schema
+
+    def get(self) -> dict:
+        """Get the statistics as a JSON-serializable dictionary."""
+        return {
+            "total": len(self.items),
+            "labeled": self.labeled,
+            "ignored": self.ignored,
+            "classes": {
+                name: {value: count for value, count in counts.items() if count}
+                for name, counts in self.classes.items()
+                if any(counts.values())
+            },
+            "regions": {
+                region: count for region, count in self.regions.items() if count
+            },
+        }
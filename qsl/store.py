@@ -0,0 +1,301 @@
+import json
+import typing
+import sqlite3
+import logging
+import threading
+import collections
+
+from . import rle
+
+LOGGER = logging.getLogger(__name__)
+SQLITE_EXTENSIONS = (".sqlite", ".sqlite3", ".db")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    idx INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    target TEXT,
+    data TEXT NOT NULL,
+    labels TEXT,
+    ignore INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS items_key ON items (key);
+CREATE INDEX IF NOT EXISTS items_target ON items (target);
+CREATE INDEX IF NOT EXISTS items_labeled ON items ((labels IS NOT NULL OR ignore));
+CREATE TABLE IF NOT EXISTS metadata (
+    idx INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    value,
+    PRIMARY KEY (idx, name)
+);
+CREATE INDEX IF NOT EXISTS metadata_value ON metadata (name, value);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Expressions matching the string values for the reserved
+# media index columns (see views.items2rows).
+COLUMN_EXPRESSIONS = {
+    "target": "items.target",
+    "labeled": "CASE WHEN items.labels IS NOT NULL OR items.ignore THEN 'Yes' ELSE 'No' END",
+    "ignored": "CASE WHEN items.ignore THEN 'Yes' ELSE 'No' END",
+}
+
+
+def is_sqlite_path(filepath: typing.Optional[str]) -> bool:
+    """Check whether a project path refers to an SQLite project."""
+    return bool(filepath) and str(filepath).lower().endswith(SQLITE_EXTENSIONS)
+
+
+def metadata2value(value):
+    """Convert a metadata value into something SQLite can store and compare."""
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return json.dumps(value)
+
+
+class SQLiteItems(collections.abc.Sequence):
+    """A sequence of labeling items backed by an SQLite database. Items
+    are fetched on demand (with a bounded cache) and written back one
+    row at a time. If compactMasks is True, mask counts are stored as
+    compact strings (see rle.counts2string)."""
+
+    def __init__(self, filepath: str, cacheSize: int = 4096, compactMasks=False):
+        self.filepath = filepath
+        self.cacheSize = cacheSize
+        self.compactMasks = compactMasks
+        self.cache: "collections.OrderedDict[int, dict]" = collections.OrderedDict()
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(filepath, check_same_thread=False)
+        self.connection.executescript(SCHEMA)
+        self.length = self.connection.execute("SELECT COUNT(*) FROM items").fetchone()[
+            0
+        ]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):  # type: ignore[override]
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(self.length))]
+        if idx < 0:
+            idx += self.length
+        if not 0 <= idx < self.length:
+            raise IndexError("Item index out of range.")
+        with self.lock:
+            if idx in self.cache:
+                self.cache.move_to_end(idx)
+                return self.cache[idx]
+            row = self.connection.execute(
+                "SELECT data, labels, ignore FROM items WHERE idx = ?", (idx,)
+            ).fetchone()
+            return self.remember(idx, row2item(*row))
+
+    def __iter__(self):
+        for start in range(0, self.length, 1000):
+            with self.lock:
+                rows = self.connection.execute(
+                    "SELECT idx, data, labels, ignore FROM items WHERE idx >= ? AND idx < ? ORDER BY idx",
+                    (start, start + 1000),
+                ).fetchall()
+            for idx, *row in rows:
+                yield self.cache[idx] if idx in self.cache else row2item(*row)
+
+    def remember(self, idx: int, item: dict) -> dict:
+        """Add an item to the cache, evicting the least recently used entry."""
+        self.cache[idx] = item
+        if len(self.cache) > self.cacheSize:
+            self.cache.popitem(last=False)
+        return item
+
+    def get_settings(self) -> typing.Optional[dict]:
+        """Get the project-level settings, if any have been stored."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT name, value FROM settings"
+            ).fetchall()
+        return {name: json.loads(value) for name, value in rows} if rows else None
+
+    def set_settings(self, settings: dict):
+        """Store the project-level settings."""
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)",
+                [(name, json.dumps(value)) for name, value in settings.items()],
+            )
+
+    def merge(
+        self,
+        insert: typing.List[dict],
+        key: typing.Callable[[dict], typing.Any],
+        merge: typing.Callable[[dict, dict], dict],
+        represent: typing.Callable[[dict], str],
+    ):
+        """Merge items into the store, matching existing rows using the key function
+        and adding any new items to the end."""
+        with self.lock, self.connection:
+            existing = dict(self.connection.execute("SELECT key, idx FROM items"))
+            for start in range(0, len(insert), 1000):
+                keyed = [
+                    (str(key(entry)), entry) for entry in insert[start : start + 1000]
+                ]
+                # The rows for existing items are read a chunk at a time.
+                rows = self.read_rows(
+                    sorted(set(existing[k] for k, _ in keyed if k in existing))
+                )
+                for entry_key, entry in keyed:
+                    idx = existing.get(entry_key)
+                    if idx is None:
+                        self.write(self.length, entry, entry_key, represent(entry))
+                        existing[entry_key] = self.length
+                        rows[self.length] = entry
+                        self.length += 1
+                        continue
+                    exists = rows[idx]
+                    merged = merge(exists, entry)
+                    if merged != exists:
+                        self.write(idx, merged, entry_key, represent(merged))
+                        rows[idx] = merged
+            self.cache.clear()
+        return self
+
+    def read_rows(self, idxs: typing.List[int]) -> typing.Dict[int, dict]:
+        """Read the items at the given indexes, bypassing the cache."""
+        rows: typing.Dict[int, dict] = {}
+        for start in range(0, len(idxs), 500):
+            chunk = idxs[start : start + 500]
+            for idx, *row in self.connection.execute(
+                f"SELECT idx, data, labels, ignore FROM items WHERE idx IN ({', '.join('?' * len(chunk))})",
+                chunk,
+            ):
+                rows[idx] = row2item(*row)
+        return rows
+
+    def write(self, idx: int, item: dict, key: str, target: str):
+        """Write a complete item row, including its metadata."""
+        data = {k: v for k, v in item.items() if k not in ["labels", "ignore"]}
+        self.connection.execute(
+            "INSERT OR REPLACE INTO items (idx, key, target, data, labels, ignore) VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                idx,
+                key,
+                target,
+                json.dumps(data),
+                self.labels2text(item),
+                int(bool(item.get("ignore", False))),
+            ),
+        )
+        self.connection.execute("DELETE FROM metadata WHERE idx = ?", (idx,))
+        self.connection.executemany(
+            "INSERT INTO metadata (idx, name, value) VALUES (?, ?, ?)",
+            [
+                (idx, name, metadata2value(value))
+                for name, value in item.get("metadata", {}).items()
+            ],
+        )
+
+    def commit(
+        self, idxs: typing.List[int], items: typing.Optional[typing.List[dict]] = None
+    ):
+        """Write the labels for the given items back to the database in a
+        single transaction. Pass the changed item dictionaries as items, since
+        changes to items that have been evicted from the cache are lost."""
+        with self.lock, self.connection:
+            if items is None:
+                items = [self[idx] for idx in idxs]
+            self.connection.executemany(
+                "UPDATE items SET labels = ?, ignore = ? WHERE idx = ?",
+                [
+                    (
+                        self.labels2text(item),
+                        int(bool(item.get("ignore", False))),
+                        idx,
+                    )
+                    for idx, item in zip(idxs, items)
+                ],
+            )
+
+    def labels2text(self, item: dict) -> typing.Optional[str]:
+        """Serialize the labels for an item, if it has any."""
+        if "labels" not in item:
+            return None
+        return json.dumps(
+            rle.convert_labels(item["labels"], rle.compact_counts)
+            if self.compactMasks
+            else item["labels"]
+        )
+
+    def count_labeled(self) -> int:
+        """Count the number of items that are labeled or ignored."""
+        with self.lock:
+            return self.connection.execute(
+                "SELECT COUNT(*) FROM items WHERE (labels IS NOT NULL OR ignore)"
+            ).fetchone()[0]
+
+    def unlabeled_idxs(self) -> typing.Set[int]:
+        """Get the indexes of items that are neither labeled nor ignored."""
+        with self.lock:
+            return {
+                idx
+                for (idx,) in self.connection.execute(
+                    "SELECT idx FROM items WHERE NOT (labels IS NOT NULL OR ignore)"
+                )
+            }
+
+    def numeric_columns(self, names: typing.List[str]) -> typing.Set[str]:
+        """Determine which of the given metadata columns only contain numbers."""
+        with self.lock:
+            return {
+                name
+                for name in names
+                if not self.connection.execute(
+                    "SELECT 1 FROM metadata WHERE name = ? AND typeof(value) NOT IN ('integer', 'real', 'null') LIMIT 1",
+                    (name,),
+                ).fetchone()
+            }
+
+    def sorted_idxs(self, column: str, reverse: bool) -> typing.List[int]:
+        """Get item indexes sorted by a media index column."""
+        order = "DESC" if reverse else "ASC"
+        with self.lock:
+            if column in COLUMN_EXPRESSIONS:
+                query = f"SELECT idx FROM items ORDER BY {COLUMN_EXPRESSIONS[column]} {order}, idx {order}"
+                rows = self.connection.execute(query)
+            else:
+                rows = self.connection.execute(
+                    f"SELECT items.idx FROM items LEFT JOIN metadata ON metadata.idx = items.idx AND metadata.name = ? ORDER BY metadata.value {order}, items.idx {order}",
+                    (column,),
+                )
+            return [idx for (idx,) in rows]
+
+    def matching_idxs(self, column: str, value: str) -> typing.Set[int]:
+        """Get the indexes of items whose value for a media index
+        column contains the given string."""
+        with self.lock:
+            if column in COLUMN_EXPRESSIONS:
+                rows = self.connection.execute(
+                    f"SELECT idx FROM items WHERE instr({COLUMN_EXPRESSIONS[column]}, ?) > 0",
+                    (value,),
+                )
+            else:
+                rows = self.connection.execute(
+                    "SELECT idx FROM metadata WHERE name = ? AND value IS NOT NULL AND value != '' AND value != 0 AND instr(CAST(value AS TEXT), ?) > 0",
+                    (column, value),
+                )
+            return {idx for (idx,) in rows}
+
+    def close(self):
+        """Close the database connection."""
+        with self.lock:
+            self.connection.close()
+
+
+def row2item(data: str, labels: typing.Optional[str], ignore: int) -> dict:
+    """Convert an items table row into an item dictionary."""
+    item = json.loads(data)
+    if labels is not None:
+        item["labels"] = rle.convert_labels(json.loads(labels), rle.expand_counts)
+    if ignore:
+        item["ignore"] = True
+    return item
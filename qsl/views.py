@@ -0,0 +1,452 @@
+import json
+import math
+import typing
+import logging
+import collections
+
+try:
+    import numpy as np
+except ImportError:
+    np = None  # type: ignore
+
+from . import files, index, stats, store
+
+LOGGER = logging.getLogger(__name__)
+LABEL_COLUMNS = {"labeled", "ignored", "labels", index.CLASSES}
+# The number of sorted and filtered views of the items to keep.
+VIEW_CACHE_SIZE = 8
+
+
+# Taken from https://stackoverflow.com/questions/952914/how-to-make-a-flat-list-out-of-a-list-of-lists
+def flatten(l: typing.List[typing.Any]):
+    return [item for sublist in l for item in sublist]
+
+
+def labels2repr(labels):
+    """Summarize item labels for the media index."""
+    if labels and isinstance(labels, dict):
+        return "; ".join(
+            f"{k}: {', '.join(v or [])}" for k, v in labels.get("image", {}).items()
+        )
+    return len(labels) if isinstance(labels, dict) else ""
+
+
+# Functions for computing the values of the reserved media index columns.
+ROW_GETTERS: typing.Dict[str, typing.Callable[[dict], typing.Any]] = {
+    "target": lambda item: target2repr(item.get("target"), item.get("type", "image")),
+    "labeled": lambda item: "No" if is_unlabeled(item) else "Yes",
+    "ignored": lambda item: "Yes" if item.get("ignore", False) else "No",
+    "labels": lambda item: labels2repr(item.get("labels", {})),
+}
+
+
+# Functions for computing the columns that can be used to sort and filter
+# items, including the hidden column with the image-level labels.
+INDEX_GETTERS: typing.Dict[str, typing.Callable[[dict], typing.Any]] = {
+    **ROW_GETTERS,
+    index.CLASSES: lambda item: stats.summarize(item)[2],
+}
+
+
+def items2rows(idxs, items):
+    """Create the media index rows representation for a list of items."""
+    metadata_keys = list(
+        set(flatten([item.get("metadata", {}).keys() for item in items]))
+    )[:5]
+    return [
+        {
+            **{k: item.get("metadata", {}).get(k) for k in metadata_keys},
+            "qslId": idx,
+            **{column: getter(item) for column, getter in ROW_GETTERS.items()},
+        }
+        for idx, item in zip(idxs, items)
+    ], metadata_keys
+
+
+def build_sort_keys(items, column):
+    """Build keys for a list of items to be used for sorting or filtering."""
+    if column == "target":
+        keys = [
+            target2repr(item.get("target"), item.get("type", "image")) for item in items
+        ]
+    elif column == "labeled":
+        keys = [not is_unlabeled(item) for item in items]
+    elif column == "ignored":
+        keys = [bool(item.get("ignore")) for item in items]
+    else:
+        keys = [item.get("metadata", {}).get(column) for item in items]
+    return keys
+
+
+def sort_idxs(items, column: str, reverse: bool) -> typing.List[int]:
+    """Get item indexes sorted using a media index column."""
+    if isinstance(items, store.SQLiteItems):
+        return items.sorted_idxs(column=column, reverse=reverse)
+    return [
+        idx
+        for _, idx in sorted(
+            zip(build_sort_keys(items=items, column=column), range(len(items))),
+            reverse=reverse,
+        )
+    ]
+
+
+def filter_idxs(items, idxs: typing.List[int], column: str, value) -> typing.List[int]:
+    """Filter item indexes to those where the media index
+    row value for a column contains the given value."""
+    if isinstance(items, store.SQLiteItems):
+        if column == "labels":
+            # The labels column is derived from the label JSON, so we
+            # stream the items rather than querying.
+            matching = {
+                idx
+                for idx, item in enumerate(items)
+                if filter_idxs([item], [0], column, value)
+            }
+        else:
+            matching = items.matching_idxs(column=column, value=str(value))
+        return [idx for idx in idxs if idx in matching]
+    rows, _ = items2rows(idxs=idxs, items=[items[idx] for idx in idxs])
+    return [
+        idx
+        for idx, row in zip(idxs, rows)
+        if row.get(column) and str(value) in str(row[column])
+    ]
+
+
+def keys2sort_key(keys) -> typing.Callable[[int], tuple]:
+    """Get a function that sorts item indexes by their (possibly
+    missing) keys, with missing keys first."""
+    return lambda idx: (keys[idx] is not None, index.value2sortable(keys[idx]))
+
+
+def multisort_idxs(items, sortModel: typing.List[dict]) -> typing.List[int]:
+    """Get item indexes sorted using several media index columns."""
+    if len(sortModel) == 1:
+        return sort_idxs(
+            items, column=sortModel[0]["field"], reverse=sortModel[0]["sort"] != "asc"
+        )
+    # Ties are broken using the item index, in the direction of the first key.
+    idxs = list(range(len(items)))[:: -1 if sortModel[0]["sort"] != "asc" else 1]
+    for entry in reversed(sortModel):
+        keys = build_sort_keys(items=items, column=entry["field"])
+        idxs.sort(key=keys2sort_key(keys), reverse=entry["sort"] != "asc")
+    return idxs
+
+
+def match_idxs(items, clause: dict) -> typing.Set[int]:
+    """Get the indexes of the items that satisfy a filter clause."""
+    field, operator, operand = clause["field"], clause["operator"], clause["value"]
+    if (
+        isinstance(items, store.SQLiteItems)
+        and operator == "contains"
+        and field not in ("labels", index.CLASSES)
+    ):
+        return items.matching_idxs(column=field, value=str(operand))
+    getter = INDEX_GETTERS.get(field, lambda item: item.get("metadata", {}).get(field))
+    return {
+        idx
+        for idx, item in enumerate(items)
+        if index.matches(getter(item), operator, operand)
+    }
+
+
+def view2key(sortModel: typing.List[dict], group: typing.Optional[dict]) -> str:
+    """Get the cache key for a sorted and filtered view of the items."""
+    return json.dumps({"sortModel": sortModel, "filter": group}, sort_keys=True)
+
+
+def is_unlabeled(item: dict) -> bool:
+    """Check whether an item still needs to be labeled. Items with any
+    labels (even empty ones) count as labeled, as in the label statistics
+    and SQLite projects."""
+    return item.get("labels") is None and not item.get("ignore")
+
+
+def target2repr(target, ttype):
+    """Convert any labling target to a string representation."""
+    if isinstance(target, str):
+        if not target.startswith("data:"):
+            return target
+        return "base64-encoded data"
+    if files.is_array(target):
+        return "numpy array"
+    if ttype == "time-series":
+        return "Time Series"
+    if ttype == "image-group":
+        return f"Group of {len(target.get('images', []))} images"
+    return ""
+
+
+class ViewMixin:
+    """Sorts and filters a labeler's items (keeping recently used views),
+    tracks the unlabeled items in each view and builds the rows for the
+    media index (see common.BaseMediaLabeler)."""
+
+    items: typing.Any
+    idx: int
+    indexState: typing.Dict[str, typing.Any]
+    message: str
+    maxViewHeight: int
+    batchSize: int
+    targets: typing.List[typing.Any]
+    _unloaded: typing.Set[int]
+    _index: typing.Optional[index.MediaIndex]
+    _unlabeled: typing.Dict[str, index.PositionSet]
+    _views: "collections.OrderedDict[str, index.Ordering]"
+    _viewFields: typing.Dict[str, typing.Set[str]]
+    _staleViews: typing.Set[str]
+    _viewKey: str
+    _sortedKey: str
+    _sortedIdxs: index.Ordering
+    update: typing.Callable[[bool], None]
+    load_items: typing.Callable[[typing.List[int]], None]
+    get_stats_tracker: typing.Callable[[], stats.LabelStats]
+
+    @property
+    def sortedIdxs(self) -> index.Ordering:
+        sortModel = [
+            entry for entry in self.indexState["sortModel"] if entry.get("field")
+        ]
+        group = index.parse_filter(self.indexState["filterModel"])
+        key = view2key(sortModel, group)
+        if key == self._viewKey:
+            return self._sortedIdxs
+        LOGGER.info("Applying sort and filter models.")
+        for stale in self._staleViews - {key}:
+            self.drop_view(stale)
+        self._staleViews.clear()
+        if json.loads(key)["filter"] != json.loads(self._viewKey)["filter"]:
+            self.indexState = {**self.indexState, "page": 0}
+        self._viewKey = key
+        ordering = self.get_view(key, sortModel, group)
+        if not ordering:
+            LOGGER.info("Did not find any matching filter criteria.")
+            self.message = "No rows matched the filter criteria."
+            key = view2key(sortModel, None)
+            ordering = self.get_view(key, sortModel, None)
+        if self.idx not in ordering:
+            self.idx = ordering[0]
+        self._sortedKey = key
+        self._sortedIdxs = ordering
+        return self._sortedIdxs
+
+    def get_view(
+        self, key: str, sortModel: typing.List[dict], group: typing.Optional[dict]
+    ) -> index.Ordering:
+        """Get a sorted and filtered view of the items, from the cache
+        of recently used views if possible."""
+        if key in self._views:
+            self._views.move_to_end(key)
+            return self._views[key]
+        fields = {entry["field"] for entry in sortModel}.union(
+            index.filter_fields(group)
+        )
+        if self._unloaded and LABEL_COLUMNS.intersection(fields):
+            self.load_items(list(self._unloaded))
+        mediaIndex = self.get_media_index()
+        if mediaIndex is not None:
+            order: typing.Any = (
+                mediaIndex.multisort(
+                    [(entry["field"], entry["sort"] != "asc") for entry in sortModel]
+                )
+                if sortModel
+                else np.arange(len(self.items))
+            )
+            if group is not None:
+                order = order[mediaIndex.evaluate(group)[order]]
+        else:
+            order = (
+                multisort_idxs(self.items, sortModel)
+                if sortModel
+                else range(len(self.items))
+            )
+            if group is not None:
+                matching = index.evaluate_filter(
+                    group,
+                    lambda clause: match_idxs(self.items, clause),
+                    conjunction=lambda sets: set.intersection(*sets),
+                    disjunction=lambda sets: set.union(*sets),
+                )
+                order = [idx for idx in order if idx in matching]
+        ordering = index.Ordering(order, len(self.items))
+        self._views[key] = ordering
+        self._viewFields[key] = fields
+        while len(self._views) > VIEW_CACHE_SIZE:
+            self.drop_view(next(iter(self._views)))
+        return ordering
+
+    def drop_view(self, key: str):
+        """Remove a view from the cache."""
+        self._views.pop(key, None)
+        self._viewFields.pop(key, None)
+        self._unlabeled.pop(key, None)
+
+    def invalidate_views(self):
+        """Drop cached views that depend on labels after items change. The
+        current view is kept until another one is selected so that items
+        do not move around while they are being labeled."""
+        for key, fields in list(self._viewFields.items()):
+            if not LABEL_COLUMNS.intersection(fields):
+                continue
+            if key in (self._viewKey, self._sortedKey):
+                self._staleViews.add(key)
+            else:
+                self.drop_view(key)
+
+    def get_media_index(self) -> typing.Optional[index.MediaIndex]:
+        """Get the columnar index used to sort and filter items in memory.
+        SQLite projects are sorted and filtered using queries instead."""
+        if self._index is None and np is not None and isinstance(self.items, list):
+            self._index = index.MediaIndex(
+                self.items, getters=INDEX_GETTERS, mutable=LABEL_COLUMNS
+            )
+        return self._index
+
+    def get_unlabeled(self) -> index.PositionSet:
+        """Get the positions of unlabeled items in the current view,
+        building them if necessary."""
+        sortedIdxs = self.sortedIdxs
+        if self._sortedKey not in self._unlabeled:
+            if isinstance(self.items, store.SQLiteItems):
+                candidates = self.items.unlabeled_idxs()
+                mask = [idx in candidates for idx in sortedIdxs]
+            else:
+                mask = [
+                    idx not in self._unloaded and is_unlabeled(self.items[idx])
+                    for idx in sortedIdxs
+                ]
+            self._unlabeled[self._sortedKey] = index.PositionSet(mask)
+        return self._unlabeled[self._sortedKey]
+
+    def update_unlabeled(self, idxs: typing.List[int]):
+        """Keep the unlabeled positions in sync with changed items."""
+        for key, positions in self._unlabeled.items():
+            ordering = self._views[key]
+            for idx in idxs:
+                position = ordering.position(idx)
+                if position is None:
+                    continue
+                if idx not in self._unloaded and is_unlabeled(self.items[idx]):
+                    positions.add(position)
+                else:
+                    positions.discard(position)
+
+    def advance_to_unlabeled(self):
+        position = self.get_unlabeled().next(0)
+        if position is None:
+            LOGGER.warning(
+                "All items have already been labeled. Starting from beginning."
+            )
+            position = 0
+        self.idx = self.sortedIdxs[position]
+        self.update(True)
+
+    def next_unlabeled(self):
+        """Go to the next unlabeled item after the current batch."""
+        position = self.get_unlabeled().next(
+            self.sortedIdxs.index(self.targets[-1]["idx"]) + 1
+        )
+        if position is None:
+            self.message = "No unlabeled items remaining."
+        else:
+            self.idx = self.sortedIdxs[position]
+        self.update(True)
+
+    def prev_unlabeled(self):
+        """Go to the previous unlabeled item before the current batch."""
+        position = self.get_unlabeled().prev(self.sortedIdxs.index(self.idx) - 1)
+        if position is None:
+            self.message = "No previous unlabeled items."
+        else:
+            self.idx = self.sortedIdxs[position]
+        self.update(True)
+
+    @property
+    def idxs(self):
+        includes_nonimage = False
+        sidx_initial = self.sortedIdxs.index(self.idx)
+        for count, sidx in enumerate(
+            range(
+                sidx_initial, min(sidx_initial + self.batchSize, len(self.sortedIdxs))
+            )
+        ):
+            includes_nonimage = (
+                includes_nonimage
+                or self.items[self.sortedIdxs[sidx]].get("type", "image") != "image"
+            )
+            if count == 0:
+                # We can always include at least one.
+                yield self.sortedIdxs[sidx]
+            elif not includes_nonimage:
+                # We can include an arbitrary number of non-videos.
+                yield self.sortedIdxs[sidx]
+            else:
+                # We've hit a video in a batch. Do not allow this.
+                break
+
+    @property
+    def targets_and_items(self):
+        for tIdx, iIdx in enumerate(self.idxs):
+            yield self.targets[tIdx], self.items[iIdx]
+
+    def get_index_state(self, reset_page=False):
+        rowsPerPage = round(self.maxViewHeight / 70)
+        # Recompute sortedIdxs if we have to (which may recompute
+        # page as a side effect).
+        sortedIdxs = self.sortedIdxs
+        page = (
+            math.floor(sortedIdxs.index(self.idx) / rowsPerPage)
+            if reset_page
+            else self.indexState["page"]
+        )
+        startIdx = page * rowsPerPage
+        endIdx = startIdx + rowsPerPage
+        idxs = sortedIdxs[startIdx:endIdx]
+        self.load_items(idxs)
+        items = [self.items[idx] for idx in idxs]
+
+        rows, metadata_keys = items2rows(
+            idxs=idxs,
+            items=items,
+        )
+        numeric_keys = (
+            self.items.numeric_columns(metadata_keys)
+            if isinstance(self.items, store.SQLiteItems)
+            else {
+                k
+                for k in metadata_keys
+                if self.get_stats_tracker().get_schema().get(k) == "number"
+            }
+        )
+        reserved_keys = ["target", "labeled", "ignored", "labels"]
+        used_reserved_keys = set(metadata_keys).intersection(reserved_keys)
+        assert (
+            not used_reserved_keys
+        ), f"The following metadata keys are not permitted, because they are reserved: {used_reserved_keys}"
+        return {
+            **self.indexState,
+            "page": page,
+            "rowCount": len(self.items),
+            "rowsPerPage": rowsPerPage,
+            "rows": rows,
+            "columns": [
+                {
+                    "field": "target",
+                    "type": "string",
+                    "flex": 1,
+                    "headerName": "Target",
+                },
+                {"field": "labeled", "type": "string", "headerName": "Labeled"},
+                {"field": "ignored", "type": "string", "headerName": "Ignored"},
+                {"field": "labels", "type": "string", "headerName": "Labels"},
+            ]
+            + [
+                {
+                    "field": k,
+                    "type": "number" if k in numeric_keys else "string",
+                    "flex": 1,
+                }
+                for k in metadata_keys
+            ],
+        }
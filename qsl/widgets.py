@@ -1,8 +1,24 @@
 # pylint: disable=too-many-ancestors,missing-function-docstring,unused-argument,too-many-return-statements
+import typing
+import collections
 import importlib.resources
 import anywidget
 import traitlets as t
-from qsl import common
+from qsl import common, delta, media
+
+try:
+    # A private ipywidgets helper, used to send patches (see send_state).
+    from ipywidgets.widgets.widget import _remove_buffers
+except ImportError:
+    _remove_buffers = None  # type: ignore
+
+# Traits that are sent to the frontend as patches against the
+# last value the frontend received, rather than in full.
+PATCHED_TRAITS = ("states", "labels")
+# The size of the chunks in which media is sent to the frontend
+# (see send_media) and the number of media files it keeps.
+MEDIA_CHUNK_SIZE = 1 << 22
+MEDIA_CACHE_SIZE = 64
 
 
 class MediaLabeler(common.BaseMediaLabeler, anywidget.AnyWidget):
@@ -21,6 +37,40 @@ class MediaLabeler(common.BaseMediaLabeler, anywidget.AnyWidget):
         - batchSize: The image labeling batch size.
         - jsonpath: The path to which we will save the configuration.
         - basePath: The path where we will look for images.
+        - journal: Whether to append label changes to a journal alongside jsonpath
+          instead of rewriting the whole project file on every save.
+        - asyncWrites: Whether to write label files on a background thread. Use
+          `labeler.flush()` to wait for pending writes to complete.
+        - loadConcurrency: The number of threads used to read item-level jsonpath files.
+        - lazyLoad: Whether to defer reading item-level jsonpath files until
+          the items are viewed. Only the existence of each file is checked at startup.
+        - jsonIndent: The indentation for JSON files. Use None for minified JSON. The
+          jsonpath extension selects the format (*.json or *.jsonl, one item per line)
+          and compression (*.gz or *.zst).
+        - compactMasks: Whether to store mask counts as compact strings (using
+          the COCO API's compressed RLE scheme) when saving. Both forms are read
+          when loading and masks are always lists of counts in memory.
+        - cacheDir: A directory (within the notebook server root) in which to cache
+          downloaded, copied and encoded media across sessions. Defaults to a
+          temporary directory.
+        - cacheSize: The maximum size of the media cache in bytes. The least
+          recently used files are evicted first.
+        - prefetchAhead: The number of upcoming images to download (e.g., from S3)
+          in the background and preload in the browser.
+        - prefetchBehind: The number of previous images to keep downloaded in the background.
+        - prefetchConcurrency: The number of threads used to download images in the background.
+        - arrayFormat: The format in which array targets are encoded for display, one
+          of "png", "jpeg" or "webp".
+        - arrayQuality: The quality (0 to 100) for encoding arrays as JPEG or WebP.
+        - downscaleArrays: Whether to downscale arrays larger than maxCanvasSize for display.
+        - encodeConcurrency: The number of threads used to encode arrays.
+        - tileThreshold: If set, images whose width or height exceeds this many pixels
+          are shown using a cached tile pyramid when labeling one image at a time.
+        - tileSize: The size of the tiles in a tile pyramid.
+        - thumbnailSize: If set, batches of images are shown as thumbnails that fit
+          within this many pixels, until one is focused.
+        - thumbnailConcurrency: The number of processes used to render thumbnails.
+        - maxPreload: Deprecated. Use prefetchAhead instead.
     """
 
     _esm = importlib.resources.files("qsl").joinpath(
@@ -32,7 +82,10 @@ class MediaLabeler(common.BaseMediaLabeler, anywidget.AnyWidget):
     config = t.Dict(default_value={"image": [], "regions": []}, allow_none=True).tag(
         sync=True
     )
-    states = t.List(default_value=[]).tag(sync=True)
+    # The frontend's own edits to states and labels are not echoed back
+    # to it since they can be large (see send_state), nor are actions,
+    # which are reset in the same message that applies them.
+    states = t.List(default_value=[]).tag(sync=True, echo_update=False)
     urls = t.List(default_value=[]).tag(sync=True)
     type = t.Unicode(default_value="image").tag(sync=True)
     idx = t.Int(default_value=0).tag(sync=True)
@@ -62,8 +115,8 @@ class MediaLabeler(common.BaseMediaLabeler, anywidget.AnyWidget):
             ),
             t.List(default_value=[]),
         ]
-    ).tag(sync=True)
-    action = t.Unicode("").tag(sync=True)
+    ).tag(sync=True, echo_update=False)
+    action = t.Unicode("").tag(sync=True, echo_update=False)
     message = t.Unicode("").tag(sync=True)
     base = t.Dict(
         default_value={
@@ -73,9 +126,11 @@ class MediaLabeler(common.BaseMediaLabeler, anywidget.AnyWidget):
         allow_none=True,
     ).tag(sync=True)
     preload = t.List(trait=t.Unicode(), allow_none=True).tag(sync=True)
+    thumbnails = t.List(trait=t.Unicode(allow_none=True)).tag(sync=True)
     maxCanvasSize = t.Int(default_value=512).tag(sync=True)
     maxViewHeight = t.Int(default_value=512).tag(sync=True)
     progress = t.Float(-1).tag(sync=True)
+    stats = t.Dict(allow_none=True, default_value=None).tag(sync=True)
     mode = t.Unicode("light").tag(sync=True)
     buttons = t.Dict(
         default_value={
@@ -101,7 +156,38 @@ class MediaLabeler(common.BaseMediaLabeler, anywidget.AnyWidget):
         batchSize=1,
         jsonpath=None,
         basePath=None,
+        *,
+        journal=False,
+        asyncWrites=False,
+        loadConcurrency=16,
+        lazyLoad=False,
+        jsonIndent=4,
+        compactMasks=False,
+        cacheDir=None,
+        cacheSize=None,
+        prefetchAhead=3,
+        prefetchBehind=0,
+        prefetchConcurrency=4,
+        arrayFormat="png",
+        arrayQuality=None,
+        downscaleArrays=False,
+        encodeConcurrency=4,
+        tileThreshold=None,
+        tileSize=512,
+        thumbnailSize=None,
+        thumbnailConcurrency=4,
+        maxPreload=None,
     ):
+        if maxPreload is not None:
+            common.deprecate("maxPreload", "prefetchAhead")
+            prefetchAhead = maxPreload
+        # The last value of each patched trait that the frontend has.
+        self._synced: dict = {}
+        self._patchCount = 0
+        # The loaders for media that has been sent to the frontend.
+        self._media: "collections.OrderedDict[str, typing.Callable]" = (
+            collections.OrderedDict()
+        )
         super().__init__(
             items=items,
             config=config,
@@ -113,25 +199,144 @@ class MediaLabeler(common.BaseMediaLabeler, anywidget.AnyWidget):
             mode=mode,
             jsonpath=jsonpath,
             basePath=basePath,
+            journal=journal,
+            asyncWrites=asyncWrites,
+            loadConcurrency=loadConcurrency,
+            lazyLoad=lazyLoad,
+            jsonIndent=jsonIndent,
+            compactMasks=compactMasks,
+            cacheDir=cacheDir,
+            cacheSize=cacheSize,
+            prefetchAhead=prefetchAhead,
+            prefetchBehind=prefetchBehind,
+            prefetchConcurrency=prefetchConcurrency,
+            arrayFormat=arrayFormat,
+            arrayQuality=arrayQuality,
+            downscaleArrays=downscaleArrays,
+            encodeConcurrency=encodeConcurrency,
+            tileThreshold=tileThreshold,
+            tileSize=tileSize,
+            thumbnailSize=thumbnailSize,
+            thumbnailConcurrency=thumbnailConcurrency,
         )
         self.observe(self.handle_base_change, ["base"])
         self.observe(self.handle_action_change, ["action"])
         self.observe(self.handle_states_change, ["states"])
+        self.on_msg(self.handle_custom_message)
 
     def handle_states_change(self, change):
-        self.targets = [
-            {**state, "target": target.get("target")}
-            for target, state in zip(self.targets, self.states)
-        ]
-        self.set_buttons()
+        self.apply_states()
+
+    def set_state(self, sync_data):
+        """Apply state from the frontend, batching any resulting changes
+        into a single message."""
+        for name in PATCHED_TRAITS:
+            if name in sync_data:
+                self._synced[name] = delta.snapshot(sync_data[name])
+        with self.hold_sync():
+            super().set_state(sync_data)
+
+    def send_state(self, key=None):
+        """Send state to the frontend. Patched traits that the frontend
+        already has are sent as a list of operations under the
+        "patches" key of the same update message. If the ipywidgets
+        internals this relies on are missing, state is sent in full."""
+        if _remove_buffers is None or not hasattr(self, "_send"):
+            super().send_state(key)
+            return
+        keys = (
+            list(self.keys)
+            if key is None
+            else [key] if isinstance(key, str) else list(key)
+        )
+        patches = {}
+        for name in PATCHED_TRAITS:
+            if name not in keys:
+                continue
+            current = delta.snapshot(getattr(self, name))
+            if key is not None and name in self._synced:
+                operations = delta.encode(self._synced[name], current)
+                if operations is not None:
+                    keys.remove(name)
+                    if operations:
+                        patches[name] = operations
+            self._synced[name] = current
+        state = self.get_state(key=keys)
+        if patches:
+            self._patchCount += 1
+            state["patches"] = {"sequence": self._patchCount, "traits": patches}
+        if len(state) > 0:
+            propertyLock = getattr(self, "_property_lock", None)
+            if propertyLock:
+                for name, value in state.items():
+                    if name in propertyLock:
+                        propertyLock[name] = value
+            state, buffer_paths, buffers = _remove_buffers(state)
+            self._send(
+                {"method": "update", "state": state, "buffer_paths": buffer_paths},
+                buffers=buffers,
+            )
+
+    def get_media_sender(self):
+        return self.send_media
+
+    def has_media(self, key, extension):
+        return key in self._media or super().has_media(key, extension)
+
+    def send_media(self, key, load):
+        """Send media to the frontend as binary buffers (unless it has
+        already been sent) and get the URL the frontend uses for it."""
+        if key in self._media:
+            self._media.move_to_end(key)
+        else:
+            self._media[key] = load
+            self.transmit_media(key)
+            released = []
+            while len(self._media) > max(
+                MEDIA_CACHE_SIZE, 2 * (self.batchSize + self.prefetchAhead)
+            ):
+                released.append(self._media.popitem(last=False)[0])
+            if released:
+                self.send({"type": "release", "keys": released})
+        return media.MEDIA_SCHEME + key
+
+    def transmit_media(self, key):
+        data, mime = self._media[key]()
+        view = memoryview(data)
+        chunks = max(1, -(-len(view) // MEDIA_CHUNK_SIZE))
+        for chunk in range(chunks):
+            self.send(
+                {
+                    "type": "media",
+                    "key": key,
+                    "mime": mime,
+                    "chunk": chunk,
+                    "chunks": chunks,
+                },
+                buffers=[
+                    view[chunk * MEDIA_CHUNK_SIZE : (chunk + 1) * MEDIA_CHUNK_SIZE]
+                ],
+            )
+
+    def handle_custom_message(self, widget, content, buffers):
+        """Handles requests from the frontend for media that it is
+        missing (e.g., after the page is reloaded)."""
+        if content.get("type") == "media":
+            for key in content.get("missing", []):
+                if key in self._media:
+                    self.transmit_media(key)
 
     def handle_base_change(self, change):
         """Handles setting a correct URL for a local file, if and when
         the the page base configuration is received."""
-        self.set_urls_and_type()
+        with self.hold_sync():
+            self.set_urls_and_type()
+            if self.base:
+                self.preload = self.prefetch(self.sortedIdxs.index(self.idx))
 
     def handle_action_change(self, change):
         """Handles changes to the action state."""
         if not change["new"]:
             return
-        self.apply_action(change["new"])
+        with self.hold_sync():
+            self.apply_action(change["new"])
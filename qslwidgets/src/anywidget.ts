@@ -1,24 +1,75 @@
 import type { AnyModel } from "@anywidget/types";
 import { buildAttributeStoreFactory } from "./widget";
+import { applyPatch } from "./library/common";
+import { createMediaResolver } from "./library/media";
 import Widget from "./components/Widget.svelte"
 
+// Shallow copies let the stores notice that a patched value changed.
+const refresh = (value: any) =>
+    Array.isArray(value) ? [...value] : value && typeof value === "object" ? { ...value } : value;
+
+// Traits that may reference media sent as binary buffers.
+const MEDIA_TRAITS = ["urls", "preload", "thumbnails"];
 
 const buildModelStateExtractor = (model: AnyModel) => {
-    return buildAttributeStoreFactory((name, set) => {
-        const sync = () => set(model.get(name));
+    const listeners = new Set<() => void>();
+    const media = createMediaResolver(
+        (keys) => model.send({ type: "media", missing: keys }),
+        () => listeners.forEach((listener) => listener())
+    );
+    model.on("msg:custom", media.receive);
+    const { extract, destroy } = buildAttributeStoreFactory((name, set) => {
+        const resolve = (value: any) =>
+            !MEDIA_TRAITS.includes(name)
+                ? value
+                : name === "preload"
+                    ? (media.resolve(value) || []).filter((url: string | null) => url)
+                    : media.resolve(value);
+        const sync = () => set(resolve(model.get(name)));
         const key = "change:" + name;
+        const patch = () => {
+            if ((model.get("patches")?.traits || {})[name]) {
+                set(refresh(model.get(name)));
+            }
+        };
         model.on(key, sync);
+        model.on("change:patches", patch);
+        if (MEDIA_TRAITS.includes(name)) listeners.add(sync);
         sync();
         return {
             set: (value) => {
                 model.set(name, value);
                 model.save_changes();
             },
-            destroy: () => model.off(key, sync),
+            destroy: () => {
+                model.off(key, sync);
+                model.off("change:patches", patch);
+                listeners.delete(sync);
+            },
         };
     });
+    return {
+        extract,
+        destroy: () => {
+            destroy();
+            model.off("msg:custom", media.receive);
+            media.destroy();
+        },
+    };
 };
 
+function initialize({ model }: { model: AnyModel }) {
+    // Patches are applied to the model's values in place, once per model,
+    // before any view is notified. This avoids echoing the patched values
+    // back to the kernel on the next save_changes().
+    model.on("change:patches", () => {
+        const { traits } = model.get("patches") || { traits: {} };
+        for (const [name, operations] of Object.entries(traits || {})) {
+            applyPatch(model.get(name), operations as any);
+        }
+    });
+}
+
 function render({ model, el }: { model: AnyModel, el: HTMLElement }) {
     const { extract, destroy } = buildModelStateExtractor(model);
     extract("base").set(
@@ -32,4 +83,4 @@ function render({ model, el }: { model: AnyModel, el: HTMLElement }) {
     return destroy
 }
 
-export default { render }
\ No newline at end of file
+export default { initialize, render }
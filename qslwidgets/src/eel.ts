@@ -29,12 +29,15 @@ const buildModelStateExtractor = () => {
   });
 };
 
-const pysync = <T extends keyof WidgetState>(key: T, value: WidgetState[T]) => {
-  document.dispatchEvent(
-    new CustomEvent<SyncEvent>(`sync:${key}`, {
-      detail: { value },
-    })
-  );
+// The backend sends all of the changes resulting from an action at once.
+const pysync = (state: Partial<WidgetState>) => {
+  for (const [key, value] of Object.entries(state)) {
+    document.dispatchEvent(
+      new CustomEvent<SyncEvent>(`sync:${key}`, {
+        detail: { value },
+      })
+    );
+  }
 };
 window.eel.expose(pysync, "sync");
 
@@ -552,3 +552,32 @@ export const labels4timestamp = (
     exists: !!existing,
   };
 };
+
+// A patch operation sent by the widget backend (see qsl/delta.py).
+export type PatchOperation =
+  | ["set", (string | number)[], any]
+  | ["delete", (string | number)[]]
+  | ["truncate", (string | number)[], number];
+
+export const applyPatch = (value: any, operations: PatchOperation[]) => {
+  for (const operation of operations) {
+    const [kind, path] = operation;
+    if (kind === "set" && path.length === 0) {
+      value = operation[2];
+      continue;
+    }
+    let container = value;
+    for (const key of kind === "truncate" ? path : path.slice(0, -1)) {
+      container = container[key];
+    }
+    const last = path[path.length - 1];
+    if (operation[0] === "truncate") {
+      container.length = operation[2];
+    } else if (operation[0] === "delete") {
+      delete container[last];
+    } else {
+      container[last] = operation[2];
+    }
+  }
+  return value;
+};
@@ -0,0 +1,78 @@
+// Media sent by the widget backend as binary buffers (see send_media in
+// qsl/widgets.py) is referenced using URLs of the form qsl-media:<key>.
+export const MEDIA_SCHEME = "qsl-media:";
+
+interface MediaMessage {
+  type: "media" | "release";
+  key?: string;
+  keys?: string[];
+  mime?: string;
+  chunk?: number;
+  chunks?: number;
+}
+
+export const createMediaResolver = (
+  request: (keys: string[]) => void,
+  onReady: () => void
+) => {
+  const urls: { [key: string]: string } = {};
+  const pending: {
+    [key: string]: { parts: (ArrayBuffer | ArrayBufferView)[]; received: number };
+  } = {};
+  const requested = new Set<string>();
+  const receive = (
+    content: MediaMessage,
+    buffers?: (ArrayBuffer | ArrayBufferView)[]
+  ) => {
+    if (content.type === "release") {
+      for (const key of content.keys || []) {
+        if (urls[key]) URL.revokeObjectURL(urls[key]);
+        delete urls[key];
+        requested.delete(key);
+      }
+    } else if (content.type === "media" && content.key && buffers) {
+      const key = content.key;
+      if (urls[key]) return;
+      const entry = pending[key] || (pending[key] = { parts: [], received: 0 });
+      entry.parts[content.chunk!] = buffers[0];
+      entry.received += 1;
+      if (entry.received === content.chunks) {
+        urls[key] = URL.createObjectURL(
+          new Blob(entry.parts, { type: content.mime })
+        );
+        delete pending[key];
+        requested.delete(key);
+        onReady();
+      }
+    }
+  };
+  // Replace media URLs (including those nested in objects) with
+  // object URLs, or null if the media has not arrived yet.
+  const resolve = (value: any): any => {
+    const missing: string[] = [];
+    const inner = (value: any): any => {
+      if (typeof value === "string") {
+        if (!value.startsWith(MEDIA_SCHEME)) return value;
+        const key = value.slice(MEDIA_SCHEME.length);
+        if (urls[key]) return urls[key];
+        if (!pending[key] && !requested.has(key)) {
+          requested.add(key);
+          missing.push(key);
+        }
+        return null;
+      }
+      if (Array.isArray(value)) return value.map(inner);
+      if (value && typeof value === "object") {
+        return Object.fromEntries(
+          Object.entries(value).map(([k, v]) => [k, inner(v)])
+        );
+      }
+      return value;
+    };
+    const resolved = inner(value);
+    if (missing.length > 0) request(missing);
+    return resolved;
+  };
+  const destroy = () => Object.values(urls).map((url) => URL.revokeObjectURL(url));
+  return { receive, resolve, destroy };
+};
@@ -0,0 +1,53 @@
+import type { PyramidManifest, PyramidTile, TiledView } from "./types.js";
+
+// Get the tiles (positioned in full-resolution pixels) that cover the
+// visible part of a pyramid, at the coarsest level that still has at
+// least one image pixel per device pixel. The view's x and y are
+// fractions of the image, as used by MediaViewer.
+export const pyramidTiles = (
+  manifest: PyramidManifest,
+  view: TiledView | undefined,
+  pixelRatio: number = 1
+): PyramidTile[] => {
+  const { width, height, tileSize, maxLevel } = manifest;
+  const overview = Math.max(
+    0,
+    maxLevel - Math.max(0, Math.ceil(Math.log2(Math.max(width, height) / tileSize)))
+  );
+  const scale = (view ? view.zoom : 1) * pixelRatio;
+  const level = Math.min(
+    maxLevel,
+    Math.max(overview, maxLevel - Math.floor(Math.log2(1 / scale)))
+  );
+  if (level === overview) return [];
+  const factor = 2 ** (maxLevel - level);
+  const span = tileSize * factor;
+  let [x0, y0, x1, y1] = [0, 0, width, height];
+  if (view && view.width && view.height && !view.rotation) {
+    x0 = view.x * width;
+    y0 = view.y * height;
+    x1 = x0 + view.width / view.zoom;
+    y1 = y0 + view.height / view.zoom;
+  }
+  const tiles: PyramidTile[] = [];
+  for (
+    let row = Math.max(0, Math.floor(y0 / span));
+    row < Math.min(Math.ceil(height / span), Math.ceil(y1 / span));
+    row++
+  ) {
+    for (
+      let col = Math.max(0, Math.floor(x0 / span));
+      col < Math.min(Math.ceil(width / span), Math.ceil(x1 / span));
+      col++
+    ) {
+      tiles.push({
+        path: `${manifest.tiles}/${level}/${col}_${row}${manifest.extension}`,
+        x: col * span,
+        y: row * span,
+        width: Math.min(span, width - col * span),
+        height: Math.min(span, height - row * span),
+      });
+    }
+  }
+  return tiles;
+};
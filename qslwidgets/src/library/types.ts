@@ -273,10 +273,21 @@ export interface IndexState<T extends string | number> {
   rowCount: number;
   rowsPerPage: number;
   sortModel: { field: string; sort: "asc" | "desc" }[];
-  filterModel: { field: string; value?: string }[];
+  filterModel: FilterClause[] | FilterGroup;
   page: number;
 }
 
+export interface FilterClause {
+  field: string;
+  operator?: string;
+  value?: any;
+}
+
+export interface FilterGroup {
+  items: (FilterClause | FilterGroup)[];
+  logicOperator?: "and" | "or";
+}
+
 export interface ImageEnhancements {
   brightness: number;
   contrast: number;
@@ -308,6 +319,8 @@ export type WidgetActions = {
   save?: boolean;
   next?: boolean;
   prev?: boolean;
+  nextUnlabeled?: boolean;
+  prevUnlabeled?: boolean;
   delete?: boolean;
   ignore?: boolean;
   unignore?: boolean;
@@ -338,6 +351,8 @@ export interface ToastEntry {
 export type ActionType =
   | "next"
   | "prev"
+  | "nextUnlabeled"
+  | "prevUnlabeled"
   | "delete"
   | "ignore"
   | "unignore"
@@ -362,6 +377,7 @@ interface BaseWidgetState<Type, LabelType, UrlType> {
   labels: LabelType;
   action: ActionType;
   preload: string[];
+  thumbnails: (string | null)[];
   maxCanvasSize: number;
   maxViewHeight: number;
   idx: number;
@@ -381,9 +397,18 @@ interface BaseWidgetState<Type, LabelType, UrlType> {
     url: string;
   };
   progress: number;
+  stats: LabelStats | null;
   mode: "light" | "dark";
 }
 
+export interface LabelStats {
+  total: number;
+  labeled: number;
+  ignored: number;
+  classes: { [name: string]: { [value: string]: number } };
+  regions: { [region: string]: number };
+}
+
 type ImageGroupWidgetState = BaseWidgetState<
   "image-group",
   Labels,
@@ -449,3 +474,30 @@ export type StackContentState = {
   size: Dimensions;
   layers: StackContentLayer[];
 };
+
+export type PyramidManifest = {
+  width: number;
+  height: number;
+  tileSize: number;
+  maxLevel: number;
+  tiles: string;
+  extension: string;
+  overview: string;
+};
+
+export type TiledView = {
+  x: number;
+  y: number;
+  zoom: number;
+  width?: number;
+  height?: number;
+  rotation: number;
+};
+
+export type PyramidTile = {
+  path: string;
+  x: number;
+  y: number;
+  width: number;
+  height: number;
+};
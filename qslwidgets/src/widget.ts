@@ -17,6 +17,7 @@ const defaultWidgetState: WidgetState = {
     labels: { image: {}, polygons: [], masks: [], boxes: [] } as Labels,
     action: "",
     preload: [] as string[],
+    thumbnails: [] as (string | null)[],
     maxCanvasSize: 512 as number,
     maxViewHeight: 512 as number,
     idx: 0,
@@ -44,6 +45,7 @@ const defaultWidgetState: WidgetState = {
         url: "",
     },
     progress: -1,
+    stats: null,
     mode: "light" as "light" | "dark",
 };
 
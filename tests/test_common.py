@@ -0,0 +1,380 @@
+import numpy as np
+import pytest
+
+from qsl import common, index, rle, stats, views
+
+
+def test_merge_items_dict_targets():
+    exists = common.merge_items(
+        exists=[],
+        insert=[
+            {"target": {"images": [{"target": "a.jpg"}], "name": "a"}},
+            {"target": "b.jpg"},
+        ],
+    )
+    assert "digest" in exists[0] and "digest" not in exists[1]
+    exists[0]["labels"] = {"image": {}}
+    merged = common.merge_items(
+        exists=exists,
+        insert=[
+            # Key order should not matter.
+            {"target": {"name": "a", "images": [{"target": "a.jpg"}]}},
+            {"target": "c.jpg"},
+        ],
+    )
+    assert [common.entry2hash(item) for item in merged] == [
+        common.entry2hash(exists[0]),
+        "b.jpg",
+        "c.jpg",
+    ]
+    assert merged[0]["labels"] == {"image": {}}
+    assert merged[0]["digest"] == common.json2digest(exists[0]["target"])
+
+
+def test_media_index_matches_python_sort_and_filter():
+    items = [
+        {
+            "target": f"image{idx % 4}.jpg",
+            "metadata": {"score": (idx * 7) % 5, "split": ["train", "val"][idx % 2]},
+            **({"labels": {"image": {"cls": ["cat"]}}} if idx % 3 == 0 else {}),
+        }
+        for idx in range(20)
+    ]
+    mediaIndex = index.MediaIndex(
+        items, getters=views.ROW_GETTERS, mutable=views.LABEL_COLUMNS
+    )
+    idxs = np.arange(len(items))
+    for column in ["target", "score", "split"]:
+        for reverse in [False, True]:
+            assert mediaIndex.sort(column, reverse).tolist() == views.sort_idxs(
+                items, column, reverse
+            )
+    contains = lambda column, value: np.flatnonzero(
+        mediaIndex.match({"field": column, "operator": "contains", "value": value})
+    ).tolist()
+    for column, value in [("target", "2"), ("score", 3), ("labels", "cat")]:
+        assert contains(column, value) == views.filter_idxs(
+            items, list(idxs), column, value
+        )
+    assert np.flatnonzero(
+        mediaIndex.evaluate(
+            {
+                "items": [
+                    {"field": "split", "operator": "equals", "value": "val"},
+                    {"field": "score", "operator": ">", "value": 2},
+                ],
+                "logicOperator": "and",
+            }
+        )
+    ).tolist() == [
+        idx
+        for idx, item in enumerate(items)
+        if item["metadata"]["split"] == "val" and item["metadata"]["score"] > 2
+    ]
+
+    # Label columns are updated incrementally.
+    items[1]["labels"] = {"image": {"cls": ["dog"]}}
+    mediaIndex.update([1])
+    assert contains("labels", "dog") == [1]
+    assert contains("labeled", "Yes") == [
+        0,
+        1,
+        3,
+        6,
+        9,
+        12,
+        15,
+        18,
+    ]
+
+
+def test_media_index_multisort_and_compound_filters():
+    items = [
+        {
+            "target": f"image{idx}.jpg",
+            "metadata": {
+                "score": [1.5, None, 3, 0.5][idx % 4],
+                "split": ["train", "val", "test"][idx % 3],
+            },
+            **({"labels": {"image": {"cls": ["cat"]}}} if idx % 5 == 0 else {}),
+        }
+        for idx in range(30)
+    ]
+    mediaIndex = index.MediaIndex(
+        items, getters=views.INDEX_GETTERS, mutable=views.LABEL_COLUMNS
+    )
+    for keys in [
+        [("split", False), ("score", True)],
+        [("score", True), ("labeled", False), ("split", True)],
+    ]:
+        sortModel = [
+            {"field": field, "sort": "desc" if reverse else "asc"}
+            for field, reverse in keys
+        ]
+        assert mediaIndex.multisort(keys).tolist() == views.multisort_idxs(
+            items, sortModel
+        )
+    group = index.parse_filter(
+        {
+            "logicOperator": "or",
+            "items": [
+                {"field": "score", "operator": "between", "value": [1, 3]},
+                {
+                    "items": [
+                        {"field": "split", "operator": "equals", "value": "val"},
+                        {
+                            "field": index.CLASSES,
+                            "operator": "hasClass",
+                            "value": "cat",
+                        },
+                        {"field": "target", "value": ""},
+                    ]
+                },
+            ],
+        }
+    )
+    assert group is not None and len(group["items"][1]["items"]) == 2
+    expected = [
+        idx
+        for idx, item in enumerate(items)
+        if item["metadata"]["score"] in (1.5, 3)
+        or (item["metadata"]["split"] == "val" and idx % 5 == 0)
+    ]
+    assert np.flatnonzero(mediaIndex.evaluate(group)).tolist() == expected
+    assert (
+        sorted(
+            index.evaluate_filter(
+                group,
+                lambda clause: views.match_idxs(items, clause),
+                conjunction=lambda sets: set.intersection(*sets),
+                disjunction=lambda sets: set.union(*sets),
+            )
+        )
+        == expected
+    )
+    with pytest.raises(ValueError):
+        index.matches(1, "approximately", 1)
+
+
+def test_labeler_views():
+    labeler = common.BaseMediaLabeler(
+        items=[
+            {"target": f"{idx}.jpg", "metadata": {"size": idx % 3, "rank": -idx}}
+            for idx in range(9)
+        ]
+    )
+    labeler.set_view(
+        sortModel=[{"field": "size", "sort": "desc"}, {"field": "rank", "sort": "asc"}],
+        filterModel=[{"field": "size", "operator": ">=", "value": 1}],
+    )
+    view = labeler.sortedIdxs
+    assert list(view) == [8, 5, 2, 7, 4, 1] and labeler.idx == 8
+    labeler.set_view()
+    assert list(labeler.sortedIdxs) == list(range(9))
+    labeler.set_view(
+        sortModel=[{"field": "size", "sort": "desc"}, {"field": "rank", "sort": "asc"}],
+        filterModel=[{"field": "size", "operator": ">=", "value": 1}],
+    )
+    # Switching back to a view reuses the cached ordering.
+    assert labeler.sortedIdxs is view
+    labeler.set_view(filterModel=[{"field": "size", "operator": ">", "value": 5}])
+    assert len(labeler.sortedIdxs) == 9
+    assert labeler.message == "No rows matched the filter criteria."
+
+
+def test_media_index_missing_values():
+    items = [{"metadata": {"a": 2}}, {"metadata": {}}, {"metadata": {"a": 1}}]
+    mediaIndex = index.MediaIndex(items, getters=views.ROW_GETTERS, mutable=[])
+    assert mediaIndex.sort("a", False).tolist() == [1, 2, 0]
+    assert mediaIndex.sort("a", True).tolist() == [0, 2, 1]
+
+
+def test_search_index():
+    texts = ["cats/001.jpg", "dogs/010.jpg", "ab", None, "cats/dogs.png"]
+    searchIndex = index.SearchIndex(texts)
+    searchIndex.add("birds/100.jpg")
+    for query in ["cats", "dogs", "01", "0", "a", "ab", ".jpg", "s/1", "zzz", "ö"]:
+        assert np.flatnonzero(searchIndex.search(query)).tolist() == [
+            key
+            for key, text in enumerate(texts + ["birds/100.jpg"])
+            if text and query in text
+        ], query
+    # Without any trigrams, queries check the strings directly.
+    shortIndex = index.SearchIndex(["ab", None, "cd"])
+    shortIndex.add("abcd")
+    for query in ["a", "cd", "abc", "zzz"]:
+        assert np.flatnonzero(shortIndex.search(query)).tolist() == [
+            key
+            for key, text in enumerate(["ab", None, "cd", "abcd"])
+            if text and query in text
+        ], query
+    assert not index.SearchIndex([None, None]).search("a").any()
+    labeler = common.BaseMediaLabeler(
+        items=[
+            {"target": f"{idx}.jpg", "metadata": {"cls": cls}}
+            for idx, cls in enumerate(["ab", "cd", None])
+        ]
+    )
+    labeler.set_view(filterModel=[{"field": "cls", "value": "a"}])
+    assert list(labeler.sortedIdxs) == [0]
+
+
+def test_ordering():
+    ordering = index.Ordering([3, 0, 2], 5)
+    assert ordering.index(2) == 2 and ordering[0] == 3 and ordering[1:] == [0, 2]
+    assert list(ordering) == [3, 0, 2] and 1 not in ordering
+    with pytest.raises(ValueError):
+        ordering.index(1)
+    with pytest.raises(ValueError):
+        ordering.index(3, 1)
+
+
+def test_label_stats():
+    items = [
+        {"labels": {"image": {"cls": ["cat"]}, "boxes": [{}, {}]}},
+        {"ignore": True},
+        {"labels": [{"timestamp": 0, "labels": {"image": {"cls": ["dog"]}}}]},
+        {"metadata": {"size": 1, "name": "a"}},
+        {"metadata": {"size": 2.5, "name": 3}},
+    ]
+    tracker = stats.LabelStats(items, unloaded={3})
+    assert tracker.get() == {
+        "total": 5,
+        "labeled": 4,
+        "ignored": 1,
+        "classes": {"cls": {"cat": 1, "dog": 1}},
+        "regions": {"boxes": 2},
+    }
+    items[0]["labels"] = {"image": {"cls": ["dog"]}}
+    items[1]["ignore"] = False
+    tracker.update([0, 1])
+    assert tracker.get()["classes"] == {"cls": {"dog": 2}}
+    assert tracker.get()["regions"] == {} and tracker.labeled == 3
+    assert tracker.get_schema() == {"size": "number", "name": "string"}
+
+
+def test_position_set():
+    mask = np.random.default_rng(42).random(100) < 0.2
+    positions = index.PositionSet(mask.tolist())
+    members = set(np.flatnonzero(mask).tolist())
+    for position in [5, 17, 17, 60]:
+        positions.add(position)
+        members.add(position)
+    for position in [0, 1, 99]:
+        positions.discard(position)
+        members.discard(position)
+    assert len(positions) == len(members)
+    for position in range(-1, 101):
+        after = [m for m in members if m >= position]
+        before = [m for m in members if m <= position]
+        assert positions.next(position) == (min(after) if after else None)
+        assert positions.prev(position) == (max(before) if before else None)
+
+
+def test_unlabeled_navigation():
+    labeler = common.BaseMediaLabeler(
+        items=[{"target": f"{idx}.jpg"} for idx in range(6)]
+    )
+    labeler.items[0]["labels"] = {"image": {}}
+    labeler.items[1]["ignore"] = True
+    labeler.items[2]["labels"] = {"image": {"cls": ["cat"]}}
+    labeler.commit_changes([0, 1, 2])
+    labeler.advance_to_unlabeled()
+    assert labeler.idx == 3
+    labeler.apply_action("nextUnlabeled")
+    assert labeler.idx == 4
+    labeler.apply_action("prevUnlabeled")
+    assert labeler.idx == 3
+    labeler.labels = {"image": {"cls": ["dog"]}}
+    labeler.apply_action("save")
+    labeler.idx = 5
+    labeler.apply_action("prevUnlabeled")
+    assert labeler.idx == 4
+    labeler.apply_action("prevUnlabeled")
+    assert labeler.idx == 4 and labeler.message == "No previous unlabeled items."
+
+
+def test_empty_labels_count_as_labeled():
+    labeler = common.BaseMediaLabeler(
+        items=[{"target": f"{idx}.jpg"} for idx in range(3)]
+    )
+    labeler.items[1]["labels"] = {}
+    labeler.commit_changes([1])
+    labeler.advance_to_unlabeled()
+    assert labeler.idx == 0
+    labeler.apply_action("nextUnlabeled")
+    # Progress and navigation agree that the item is labeled.
+    assert labeler.idx == 2 and labeler.get_label_stats()["labeled"] == 1
+    assert views.ROW_GETTERS["labeled"](labeler.items[1]) == "Yes"
+
+
+def test_rle_roundtrip():
+    rng = np.random.default_rng(0)
+    bitmaps = (rng.random((6, 13, 17)) < 0.3).astype("uint8")
+    bitmaps[0] = 0
+    bitmaps[1] = 1
+    bitmaps[2, 0, 0] = 1
+    masks = common.bitmaps2counts(bitmaps * 255)
+    assert masks[0]["counts"] == [0, 13 * 17] and masks[1]["counts"] == [13 * 17, 0]
+    # A naive, pixel-by-pixel reference encoding.
+    for mask, bitmap in zip(masks, bitmaps):
+        counts = [0]
+        for value in bitmap.ravel():
+            if (len(counts) % 2 == 1) == bool(value):
+                counts[-1] += 1
+            else:
+                counts.append(1)
+        assert mask["counts"][: len(counts)] == counts
+        assert common.bitmap2counts(bitmap, chunkSize=10) == mask
+        for chunkSize in [None, 1, 7, 1000]:
+            assert (
+                common.counts2bitmap(mask["counts"], mask["dimensions"], chunkSize)
+                == bitmap * 255
+            ).all()
+    out = np.empty_like(bitmaps)
+    assert common.counts2bitmaps(masks, out=out) is out
+    assert (out == bitmaps * 255).all()
+    with pytest.raises(ValueError):
+        common.counts2bitmap([1, 2], {"width": 2, "height": 2})
+
+
+def test_rle_operations():
+    rng = np.random.default_rng(1)
+    bitmaps = rng.random((4, 9, 11)) < 0.4
+    bitmaps[1, :, :5] = True
+    bitmaps[2] = False
+    bitmaps[3, 2:4, 3:8] = True
+    masks = common.bitmaps2counts(bitmaps)
+
+    def decode(mask):
+        return common.counts2bitmap(mask["counts"], mask["dimensions"]) > 0
+
+    for mask, bitmap in zip(masks, bitmaps):
+        assert rle.area(mask) == bitmap.sum()
+        ys, xs = np.nonzero(bitmap)
+        assert rle.bbox(mask) == (
+            (xs.min(), ys.min(), xs.max() - xs.min() + 1, ys.max() - ys.min() + 1)
+            if len(xs)
+            else None
+        )
+        for dimensions in [{"width": 5, "height": 4}, {"width": 30, "height": 17}]:
+            rows = (
+                (np.arange(dimensions["height"]) + 0.5) * 9 / dimensions["height"]
+            ).astype(int)
+            cols = (
+                (np.arange(dimensions["width"]) + 0.5) * 11 / dimensions["width"]
+            ).astype(int)
+            resized = rle.resize(mask, dimensions)
+            assert resized == common.bitmap2counts(bitmap[rows][:, cols])
+    assert rle.merge(masks) == common.bitmap2counts(bitmaps.any(axis=0))
+    assert rle.intersect(masks[:2]) == common.bitmap2counts(bitmaps[0] & bitmaps[1])
+    assert (decode(rle.subtract(masks[0], masks[1])) == bitmaps[0] & ~bitmaps[1]).all()
+    ious = rle.iou_matrix(masks, masks[::-1])
+    for i, bitmap in enumerate(bitmaps):
+        for j, other in enumerate(bitmaps[::-1]):
+            union = (bitmap | other).sum()
+            assert ious[i, j] == pytest.approx(
+                (bitmap & other).sum() / union if union else 0
+            )
+    with pytest.raises(ValueError):
+        rle.merge([masks[0], rle.resize(masks[0], {"width": 3, "height": 3})])
@@ -0,0 +1,504 @@
+import io
+import os
+import json
+import hashlib
+import pathlib
+import threading
+
+import cv2
+import numpy as np
+import pytest
+
+from qsl import files, media, pyramid, store, views, widgets
+
+
+def test_journal_roundtrip(tmp_path):
+    jsonpath = str(tmp_path / "project.json")
+    items = [{"target": f"image{i}.jpg"} for i in range(5)]
+    labeler = widgets.MediaLabeler(items=items, jsonpath=jsonpath, journal=True)
+    snapshot = pathlib_text(jsonpath)
+    labeler.labels = {"image": {"Type": ["Cat"]}}
+    labeler.save()
+    labeler.ignore()
+
+    # The snapshot is untouched and the changes live in the journal.
+    assert pathlib_text(jsonpath) == snapshot
+    assert len(files.read_journal(files.journal_paths(jsonpath)[0])) == 2
+
+    reloaded = widgets.MediaLabeler(items=items, jsonpath=jsonpath, journal=True)
+    assert reloaded.items[0]["labels"] == {"image": {"Type": ["Cat"]}}
+    assert reloaded.items[1]["ignore"]
+    assert reloaded.idx == 2
+
+    # Reloading triggers compaction, which folds the journal into the snapshot.
+    reloaded._journal.wait()
+    assert not any(os.path.isfile(p) for p in files.journal_paths(jsonpath))
+    assert json.loads(pathlib_text(jsonpath))["items"][0]["labels"] == {
+        "image": {"Type": ["Cat"]}
+    }
+
+
+def test_journal_truncated_record(tmp_path):
+    journal = str(tmp_path / "project.json.journal")
+    files.append_journal([{"idx": 0, "item": {"target": "a"}}], journal)
+    with open(journal, "a", encoding="utf8") as f:
+        f.write('{"idx": 1, "it')
+    assert files.read_journal(journal) == [{"idx": 0, "item": {"target": "a"}}]
+
+
+def pathlib_text(filepath):
+    with open(filepath, "r", encoding="utf8") as f:
+        return f.read()
+
+
+def test_sqlite_project(tmp_path):
+    jsonpath = str(tmp_path / "project.sqlite")
+    items = [
+        {"target": f"image{i}.jpg", "metadata": {"rank": 5 - i, "name": f"n{i}"}}
+        for i in range(5)
+    ]
+    labeler = widgets.MediaLabeler(items=items, jsonpath=jsonpath)
+    labeler.labels = {"image": {"Type": ["Cat"]}}
+    labeler.save()
+    assert labeler.progress == 20
+
+    reloaded = widgets.MediaLabeler(
+        items=items + [{"target": "image5.jpg"}], jsonpath=jsonpath
+    )
+    assert len(reloaded.items) == 6
+    assert reloaded.items[0]["labels"] == {"image": {"Type": ["Cat"]}}
+    assert reloaded.idx == 1
+    assert views.sort_idxs(reloaded.items, "rank", reverse=False)[:5] == [
+        5,
+        4,
+        3,
+        2,
+        1,
+    ]
+    assert views.filter_idxs(reloaded.items, [0, 1, 2, 3], "labeled", "Yes") == [0]
+    assert views.filter_idxs(reloaded.items, [0, 1, 2, 3], "labels", "Cat") == [0]
+
+    # Changes are committed even if the items were evicted from the cache.
+    sqlite = store.SQLiteItems(jsonpath, cacheSize=2)
+    changed = sqlite[1]
+    changed["labels"] = {"image": {"Type": ["Dog"]}}
+    sqlite[2], sqlite[3], sqlite[4]
+    assert 1 not in sqlite.cache
+    sqlite.commit([1], [changed])
+    assert store.SQLiteItems(jsonpath)[1]["labels"] == changed["labels"]
+
+
+def test_background_writer(tmp_path):
+    filepath = str(tmp_path / "nested" / "labels.json")
+    writer = files.BackgroundWriter()
+    for version in range(50):
+        writer.write({"version": version}, filepath)
+    writer.flush()
+    assert json.loads(pathlib_text(filepath)) == {"version": 49}
+    stats = writer.get_stats()
+    assert stats["queueDepth"] == 0
+    assert stats["written"] + stats["coalesced"] == 50
+    writer.remove(filepath)
+    writer.close()
+    assert not os.path.isfile(filepath)
+    assert os.listdir(tmp_path / "nested") == []
+
+
+def test_async_item_jsonpaths(tmp_path):
+    items = [
+        {"target": f"image{i}.jpg", "jsonpath": str(tmp_path / f"{i}.json")}
+        for i in range(3)
+    ]
+    labeler = widgets.MediaLabeler(items=items, asyncWrites=True)
+    labeler.labels = {"image": {"Type": ["Dog"]}}
+    labeler.save()
+    labeler.flush()
+    assert json.loads(pathlib_text(items[0]["jsonpath"]))["labels"] == {
+        "image": {"Type": ["Dog"]}
+    }
+    assert labeler.get_write_stats()["written"] == 1
+    labeler.close()
+
+
+def test_lazy_item_jsonpaths(tmp_path):
+    items = [
+        {"target": f"image{i}.jpg", "jsonpath": str(tmp_path / f"{i}.json")}
+        for i in range(20)
+    ]
+    for item in [items[0], items[1], items[15]]:
+        files.labels2json(
+            {**item, "labels": {"image": {"Type": ["Dog"]}}}, item["jsonpath"]
+        )
+    labeler = widgets.MediaLabeler(items=items, lazyLoad=True, loadConcurrency=4)
+    assert labeler.progress == 100 * 3 / 20
+    assert labeler.idx == 2
+    # Only the first page of the index has been read.
+    assert labeler._unloaded == {15}
+    labeler.idx = 15
+    labeler.update(True)
+    assert labeler.labels == {"image": {"Type": ["Dog"]}}
+    assert not labeler._unloaded
+
+
+def test_lazy_item_jsonpaths_unignore(tmp_path):
+    items = [
+        {"target": f"image{i}.jpg", "jsonpath": str(tmp_path / f"{i}.json")}
+        for i in range(50)
+    ]
+    labeler = widgets.MediaLabeler(items=items)
+    labeler.idx = 40
+    labeler.update(True)
+    labeler.ignore()
+    assert os.path.isfile(items[40]["jsonpath"])
+    # Ignored items count toward progress, but are only known to be
+    # ignored once their label files have been read.
+    labeler = widgets.MediaLabeler(items=items, lazyLoad=True)
+    assert labeler.progress == 2.0 and labeler.get_label_stats()["ignored"] == 0
+    labeler.idx = 40
+    labeler.update(True)
+    assert labeler.get_label_stats()["ignored"] == 1
+    labeler.unignore()
+    assert not os.path.isfile(items[40]["jsonpath"])
+    for lazyLoad in [False, True]:
+        labeler = widgets.MediaLabeler(items=items, lazyLoad=lazyLoad)
+        assert labeler.progress == 0.0 and len(labeler.get_unlabeled()) == 50
+
+
+def test_project_formats(tmp_path):
+    project = {
+        "items": [
+            {"target": f"image{i}.jpg", "labels": {"masks": [{"counts": [1, 2, 3]}]}}
+            for i in range(10)
+        ],
+        "config": {"image": [], "regions": []},
+        "maxCanvasSize": 512,
+    }
+    source = str(tmp_path / "project.json")
+    files.labels2json(project, source)
+    assert json.loads(pathlib_text(source)) == project
+    for name, indent in [
+        ("project.min.json", None),
+        ("project.jsonl", None),
+        ("project.json.gz", 4),
+        ("project.jsonl.gz", None),
+    ]:
+        destination = files.convert_project(source, str(tmp_path / name), indent)
+        assert files.json_or_none(destination) == project
+    assert len(pathlib_text(str(tmp_path / "project.jsonl")).splitlines()) == 11
+
+
+def test_written_file_modes(tmp_path):
+    # New files get the default permissions and existing files keep theirs.
+    filepath = tmp_path / "project.json"
+    files.labels2json({"items": []}, str(filepath))
+    assert filepath.stat().st_mode & 0o777 == 0o666 & ~files.UMASK
+    filepath.chmod(0o664)
+    files.labels2json({"items": [{"target": "a.jpg"}]}, str(filepath))
+    assert filepath.stat().st_mode & 0o777 == 0o664
+    cache = media.MediaCache(str(tmp_path / "cache"))
+    cached = cache.fetch("a", ".txt", lambda path: pathlib.Path(path).write_text("a"))
+    assert os.stat(cached).st_mode & 0o777 == 0o666 & ~files.UMASK
+
+
+def test_read_json_stream():
+    value = {"a": 123456, "items": [{"b": [1.5, "}"]}, {}, 7], "c": {"d": None}}
+    text = json.dumps(value, indent=2)
+    for chunkSize in [1, 3, 7, 1000]:
+        assert files.read_json_stream(io.StringIO(text), chunkSize=chunkSize) == value
+    assert files.read_json_stream(io.StringIO("[1, 2]"), chunkSize=1) == [1, 2]
+
+
+def test_media_cache(tmp_path):
+    cache = media.MediaCache(str(tmp_path / "cache"), maxSize=250)
+
+    def fill(text):
+        return lambda path: pathlib.Path(path).write_text(text, encoding="utf8")
+
+    first = cache.fetch("a", ".txt", fill("a" * 100))
+    assert cache.fetch("a", ".txt", fill("unused")) == first
+    os.utime(first, (0, 0))
+    cache.fetch("b", ".txt", fill("b" * 100))
+    cache.fetch("c", ".txt", fill("c" * 100))
+    # "a" was the least recently used, so it was evicted.
+    assert not os.path.isfile(first)
+    assert cache.stats == {"hits": 1, "misses": 3, "evictions": 1}
+
+    # A second cache over the same directory reuses the files.
+    other = media.MediaCache(str(tmp_path / "cache"))
+    assert other.fetch("c", ".txt", fill("unused")).endswith("c.txt")
+    assert other.stats["hits"] == 1
+
+
+def test_array_encoder():
+    rng = np.random.default_rng(42)
+    array = rng.integers(0, 255, size=(400, 600, 3), dtype="uint8")
+    # The digest hashes the array in place and does not depend
+    # on the memory layout.
+    legacy = files.str2digest(
+        hashlib.blake2b(array.tobytes(), digest_size=16).hexdigest(),
+        array.shape,
+        array.dtype,
+    )
+    assert media.array2digest(array) == legacy
+    assert media.array2digest(np.asfortranarray(array)) == legacy
+    assert media.ArrayEncoder().digest(array) == legacy
+
+    encoder = media.ArrayEncoder(format="jpeg", quality=50, maxSize=300)
+    assert encoder.digest(array) != legacy
+    encoder.submit([(array, encoder.digest(array))])
+    data, mime = encoder.encode(array)
+    assert mime == "image/jpeg"
+    decoded = cv2.imdecode(np.frombuffer(data, dtype="uint8"), cv2.IMREAD_COLOR)
+    assert decoded.shape == (200, 300, 3)
+    assert len(data) < len(media.ArrayEncoder().encode(array)[0])
+    encoder.close()
+    with pytest.raises(ValueError):
+        media.ArrayEncoder(format="gif")
+
+
+def test_tile_pyramid(tmp_path):
+    root = tmp_path / "root"
+    root.mkdir()
+    image = np.random.default_rng(42).integers(0, 255, (1000, 1500, 3), "uint8")
+    cv2.imwrite(str(root / "large.png"), image)
+    cv2.imwrite(str(root / "large.jpg"), image)
+    cv2.imwrite(str(root / "small.png"), image[:100, :150])
+    assert pyramid.image_dimensions(str(root / "large.png")) == (1500, 1000)
+    assert pyramid.image_dimensions(str(root / "large.jpg")) == (1500, 1000)
+    cache = media.MediaCache(str(root / "cache"))
+    base = {"url": "http://localhost:8888/", "serverRoot": str(root)}
+    build = lambda target: media.build_url(
+        str(root / target),
+        base=base,
+        get_cache=lambda: cache,
+        tileThreshold=1000,
+        tileSize=512,
+    )
+
+    # Small images are served as is and large ones as a pyramid.
+    assert build("small.png") == "http://localhost:8888/files/small.png"
+    url = build("large.png")
+    assert url.endswith(pyramid.SUFFIX) and build("large.png") == url
+    manifest = os.path.join(cache.directory, url.split("/")[-1])
+    with open(manifest, encoding="utf8") as f:
+        contents = json.load(f)
+    assert contents["maxLevel"] == 11 and contents["overview"].endswith("/9/0_0.jpg")
+    tiles = pyramid.tile_directory(manifest)
+    assert sorted(os.listdir(os.path.join(tiles, "11"))) == [
+        f"{col}_{row}.jpg" for col in range(3) for row in range(2)
+    ]
+    assert os.listdir(os.path.join(tiles, "0")) == ["0_0.jpg"]
+    assert cache.entry_size(manifest) > pyramid.directory_size(tiles)
+
+    # Images that cannot be tiled are served as is.
+    with open(root / "large.png", "rb") as f:
+        (root / "truncated.png").write_bytes(f.read(1000))
+    assert build("truncated.png") == "http://localhost:8888/files/truncated.png"
+
+    # Evicting the manifest removes the tiles.
+    cache.maxSize = 1
+    cache.evict()
+    assert not os.path.exists(manifest) and not os.path.exists(tiles)
+
+
+def test_thumbnails(tmp_path):
+    image = np.random.default_rng(42).integers(0, 255, (600, 900, 3), "uint8")
+    for name in ["a", "b"]:
+        cv2.imwrite(str(tmp_path / f"{name}.jpg"), image)
+    cv2.imwrite(str(tmp_path / "small.png"), image[:50, :50])
+    items = [{"target": str(tmp_path / n)} for n in ["a.jpg", "b.jpg", "small.png"]]
+    labeler = widgets.MediaLabeler(
+        items=items,
+        batchSize=3,
+        thumbnailSize=128,
+        thumbnailConcurrency=2,
+        cacheDir=str(tmp_path / "cache"),
+    )
+    labeler.base = {"url": "http://localhost:8888/", "serverRoot": str(tmp_path)}
+    try:
+        # Large images are shown as cached thumbnails.
+        assert len(labeler.thumbnails) == 3
+        assert labeler.thumbnails[2] == labeler.urls[2]
+        for url in labeler.thumbnails[:2]:
+            assert url.startswith("http://localhost:8888/files/cache/")
+            thumbnail = cv2.imread(str(tmp_path / url.split("files/")[1]))
+            assert thumbnail.shape == (85, 128, 3)
+    finally:
+        labeler.close()
+
+
+def test_build_url_out_of_root(tmp_path, caplog):
+    root, outside = tmp_path / "root", tmp_path / "outside"
+    root.mkdir()
+    outside.mkdir()
+    (outside / "image.jpg").write_bytes(b"image")
+    cache = media.MediaCache(str(root / "cache"))
+    base = {"url": "http://localhost:8888/", "serverRoot": str(root)}
+    urls = [
+        media.build_url(str(outside / "image.jpg"), base=base, get_cache=lambda: cache)
+        for _ in range(2)
+    ]
+    assert urls[0] == urls[1]
+    assert urls[0].startswith("http://localhost:8888/files/cache/")
+    assert cache.stats == {"hits": 1, "misses": 1, "evictions": 0}
+
+    # A cacheDir outside the server root cannot be served.
+    labeler = widgets.MediaLabeler(
+        items=[{"target": str(outside / "image.jpg")}], cacheDir=str(outside / "cache")
+    )
+    labeler.base = base
+    assert "outside the notebook server root" in caplog.text
+    labeler.close()
+
+
+def test_prefetcher():
+    prefetcher = media.Prefetcher(concurrency=1)
+    release = threading.Event()
+    prefetcher.schedule([("a", lambda: release.wait() and "a-url"), ("b", lambda: "b")])
+    assert prefetcher.result("a") is None
+    # Jumping elsewhere cancels "b" (which is still queued) but
+    # lets the running "a" download complete.
+    prefetcher.schedule([("c", lambda: "c-url")])
+    release.set()
+    assert prefetcher.result("c", wait=True) == "c-url"
+    assert prefetcher.result("b", wait=True) is None
+    assert prefetcher.stats["cancelled"] == 1
+    prefetcher.close()
+
+
+def test_build_url_injected_s3_client(tmp_path):
+    class FakeS3:
+        def __init__(self):
+            self.downloads = 0
+
+        def head_object(self, Bucket, Key):
+            return {"ETag": '"etag"'}
+
+        def download_file(self, Bucket, Key, Filename):
+            self.downloads += 1
+            pathlib.Path(Filename).write_text(f"{Bucket}/{Key}", encoding="utf8")
+
+    client = FakeS3()
+    files.configure_s3(client=client)
+    try:
+        assert files.get_s3() is client
+        cache = media.MediaCache(str(tmp_path / "cache"))
+        base = {"url": "http://localhost:8888/", "serverRoot": str(tmp_path)}
+        urls = [
+            media.build_url("s3://bucket/Path/Image.jpg", base, lambda: cache)
+            for _ in range(2)
+        ]
+        assert urls[0] == urls[1] and urls[0].endswith(".jpg")
+        assert client.downloads == 1
+    finally:
+        files.configure_s3(client=None)
+
+
+def test_iter_s3_files_for_pattern(caplog):
+    keys = sorted(
+        [
+            "a/2023/1.jpg",
+            "a/2024/1.jpg",
+            "a/2024/2.png",
+            "a/2024/deep/3.jpg",
+            "b/2024/4.jpg",
+            "c/2024/",
+            "root.jpg",
+            "skip/2024/5.jpg",
+        ]
+    )
+    listed = []
+
+    class FakePaginator:
+        def paginate(self, Bucket, Prefix, Delimiter=None):
+            listed.append(Prefix)
+            matches = [key for key in keys if key.startswith(Prefix)]
+            if Delimiter is None:
+                yield {"Contents": [{"Key": key} for key in matches]}
+                return
+            children = sorted(
+                set(
+                    key[: key.index("/", len(Prefix)) + 1]
+                    for key in matches
+                    if "/" in key[len(Prefix) :]
+                )
+            )
+            yield {
+                "Contents": [
+                    {"Key": key} for key in matches if "/" not in key[len(Prefix) :]
+                ],
+                "CommonPrefixes": [{"Prefix": child} for child in children],
+            }
+
+    class FakeS3:
+        def get_paginator(self, name):
+            return FakePaginator()
+
+    def expand(pattern):
+        return list(files.iter_s3_files_for_pattern(FakeS3(), pattern))
+
+    assert expand("s3://bucket/[abc]*/2024/*.jpg") == [
+        "s3://bucket/a/2024/1.jpg",
+        "s3://bucket/b/2024/4.jpg",
+    ]
+    # Prefixes that do not match a segment are never listed.
+    assert "skip/2024/" not in listed
+    assert expand("s3://bucket/a/**/*.jpg") == [
+        "s3://bucket/a/2023/1.jpg",
+        "s3://bucket/a/2024/1.jpg",
+        "s3://bucket/a/2024/deep/3.jpg",
+    ]
+    assert expand("s3://bucket/a/2024/1.jpg") == ["s3://bucket/a/2024/1.jpg"]
+    # A trailing ** matches keys at any depth and ** may match no segments.
+    assert expand("s3://bucket/a/**") == [
+        "s3://bucket/a/2023/1.jpg",
+        "s3://bucket/a/2024/1.jpg",
+        "s3://bucket/a/2024/2.png",
+        "s3://bucket/a/2024/deep/3.jpg",
+    ]
+    assert len(expand("s3://bucket/**")) == 7
+    assert expand("s3://bucket/**/*.jpg") == [
+        "s3://bucket/a/2023/1.jpg",
+        "s3://bucket/a/2024/1.jpg",
+        "s3://bucket/a/2024/deep/3.jpg",
+        "s3://bucket/b/2024/4.jpg",
+        "s3://bucket/root.jpg",
+        "s3://bucket/skip/2024/5.jpg",
+    ]
+    assert expand("s3://bucket/a/2024/**/*.jpg") == [
+        "s3://bucket/a/2024/1.jpg",
+        "s3://bucket/a/2024/deep/3.jpg",
+    ]
+    # A single * does not match nested keys, which is worth a warning.
+    assert expand("s3://bucket/a/*") == []
+    assert "use ** to match nested keys" in caplog.text
+
+
+def test_compact_masks(tmp_path):
+    mask = {"dimensions": {"width": 4, "height": 3}, "counts": [0, 5, 3, 4]}
+    labels = {"image": {}, "masks": [{"labels": {}, **mask}]}
+    items = [{"target": f"image{i}.jpg"} for i in range(3)]
+    for jsonpath, journal in [
+        (str(tmp_path / "project.json"), False),
+        (str(tmp_path / "journaled.json"), True),
+        (str(tmp_path / "project.sqlite"), False),
+    ]:
+        labeler = widgets.MediaLabeler(
+            items=items, jsonpath=jsonpath, journal=journal, compactMasks=True
+        )
+        labeler.labels = labels
+        labeler.save()
+        labeler.close()
+        if not jsonpath.endswith(".sqlite"):
+            project, _ = files.load_project(jsonpath)
+            assert project["items"][0]["labels"]["masks"][0]["counts"] == "053O"
+        # Masks are always lists in memory.
+        reloaded = widgets.MediaLabeler(items=items, jsonpath=jsonpath)
+        assert reloaded.items[0]["labels"] == labels
+        reloaded.close()
+
+    # Existing projects can be migrated in either direction.
+    source = str(tmp_path / "project.json")
+    destination = str(tmp_path / "expanded.json")
+    files.convert_project(source, destination, compactMasks=False)
+    assert json.loads(pathlib_text(destination))["items"][0]["labels"] == labels
@@ -1,3 +1,138 @@
+import copy
+
+import eel
+import pytest
+
+from qsl import app, delta, media, widgets
+
+
 def test_trivial():
     # Someday we'll write some actual tests.
     assert 2 + 2 == 4
+
+
+def test_delta_roundtrip():
+    old = {
+        "image": {"Type": ["Cat"]},
+        "masks": [
+            {"labels": {}, "map": {"counts": [0, 5, 3], "dimensions": {}}},
+            {"labels": {}, "map": {"counts": [1, 2], "dimensions": {}}},
+        ],
+        "boxes": [],
+    }
+    new = copy.deepcopy(old)
+    new["masks"][0]["map"]["counts"] = [0, 4, 4]
+    new["masks"].pop()
+    new["polygons"] = []
+    del new["boxes"]
+    operations = delta.diff(old, new)
+    assert ["set", ["masks", 0, "map", "counts"], [0, 4, 4]] in operations
+    assert ["truncate", ["masks"], 1] in operations
+    assert delta.apply(copy.deepcopy(old), operations) == new
+    assert delta.diff(new, new) == []
+    assert delta.encode({"a": 1}, [1]) is None
+
+
+def test_max_preload_alias():
+    with pytest.warns(DeprecationWarning):
+        labeler = widgets.MediaLabeler(items=[{"target": "image.jpg"}], maxPreload=5)
+    assert labeler.prefetchAhead == 5
+    with pytest.warns(DeprecationWarning):
+        labeler.maxPreload = 2
+    assert labeler.prefetchAhead == 2
+
+
+def test_action_sends_single_patch(monkeypatch):
+    messages = []
+    items = [
+        {
+            "target": f"image{i}.jpg",
+            "labels": {
+                "image": {},
+                "masks": [{"labels": {}, "map": {"counts": [0] + [1] * 200}}],
+            },
+        }
+        for i in range(4)
+    ]
+    labeler = widgets.MediaLabeler(items=items, batchSize=2)
+    labeler._send = lambda msg, buffers=None: messages.append(msg)
+    labeler.send_state()
+    messages.clear()
+
+    # Deselecting a target in the UI only patches its state.
+    states = copy.deepcopy(labeler.states)
+    states[1]["selected"] = False
+    labeler.set_state({"states": states})
+    assert not labeler.targets[1]["selected"]
+    assert all("states" not in m["state"] for m in messages)
+
+    # An action results in a single update in which the labels
+    # and states are patched rather than sent in full.
+    messages.clear()
+    labeler.set_state({"action": "next"})
+    assert len(messages) == 1
+    state = messages[0]["state"]
+    assert state["action"] == "" and state["idx"] == 2
+    assert "labels" not in state and "states" not in state
+    assert set(state["patches"]["traits"]) == {"states"}
+    synced = delta.apply(states, state["patches"]["traits"]["states"])
+    assert synced == delta.snapshot(labeler.states)
+
+    # Without the ipywidgets internals, state is sent in full.
+    monkeypatch.setattr(widgets, "_remove_buffers", None)
+    messages.clear()
+    labeler.set_state({"action": "prev"})
+    assert all("patches" not in m["state"] for m in messages)
+    assert any(m["state"].get("states") == labeler.states for m in messages)
+
+
+def test_app_sync(monkeypatch, tmp_path):
+    messages = []
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(eel, "sync", messages.append, raising=False)
+    monkeypatch.setattr(eel, "expose", lambda f: f)
+    items = [{"target": f"image{i}.jpg"} for i in range(4)]
+    for item in items:
+        (tmp_path / item["target"]).touch()
+    labeler = app.MediaLabeler(items=items)
+
+    # Only frontend-visible fields are sent.
+    assert messages and all(set(m).issubset(app.SYNCED_FIELDS) for m in messages)
+    assert not any("items" in m or "_targets" in m for m in messages)
+
+    # An action results in a single message.
+    messages.clear()
+    labeler.sync("action", "next")
+    assert len(messages) == 1
+    assert messages[0]["idx"] == 1 and messages[0]["action"] == ""
+    assert labeler.get_sync_stats()["next"]["messages"] == 1
+    with pytest.raises(ValueError):
+        labeler.sync("items", [])
+
+
+def test_media_buffers(monkeypatch, tmp_path):
+    monkeypatch.setattr(widgets, "MEDIA_CHUNK_SIZE", 1000)
+    filepath = tmp_path / "image.png"
+    filepath.write_bytes(b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 100)
+    labeler = widgets.MediaLabeler(items=[{"target": str(filepath)}])
+    messages = []
+    labeler._send = lambda msg, buffers=None: messages.append((msg, buffers))
+
+    # Without a notebook server configuration, the file is sent in
+    # chunks and referenced using a media URL.
+    labeler.base = {"url": None, "serverRoot": None}
+    key = labeler.urls[0][len(media.MEDIA_SCHEME) :]
+    assert labeler.urls[0].startswith(media.MEDIA_SCHEME)
+    chunks = [
+        (msg["content"], buffers) for msg, buffers in messages if "content" in msg
+    ]
+    assert [c["chunk"] for c, _ in chunks] == list(range(26))
+    assert {c["mime"] for c, _ in chunks} == {"image/png"}
+    assert b"".join(b[0] for _, b in chunks) == filepath.read_bytes()
+
+    # Media is not sent again unless the frontend asks for it.
+    messages.clear()
+    labeler.set_urls_and_type()
+    assert not messages
+    labeler.handle_custom_message(labeler, {"type": "media", "missing": [key]}, [])
+    assert len(messages) == 26